@@ -35,6 +35,7 @@ Options:
 	-p 	Input directory(and output dir); [default = pwd directory]
 	-t  Input Bzero threshold; [default = 10]; 
 	-d  Run drifting correction
+	-n  Number of processes for drifting correction brain masks; [default = 1]
 EOF
 exit 1
 }
@@ -48,9 +49,10 @@ arg=-1
 OriDir=$(pwd)
 Bzerothr=10
 drift=
+driftjobs=1
 
 # Parse options
-while getopts "hp:t:d" optionName;
+while getopts "hp:t:dn:" optionName;
 do
 	#echo "-$optionName is present [$OPTARG]"
 	case $optionName in
@@ -62,6 +64,8 @@ do
 		Bzerothr=$OPTARG;;
 	d)
 		drift=1;;
+	n)
+		driftjobs=$OPTARG;;
 	\?)
 		exit 42;;
 	*)
@@ -201,7 +205,7 @@ B0index=$(mrinfo ${File_degibbs}.nii.gz -fslgrad ${File_bvec} ${File_bval} -shel
 if [[ "${drift}" -eq "1" ]]; then
 	if [[ "${B0num}" -gt "3" ]]; then
 		echo "Calling python script for Drifting Correction"
-		python3 ${iDIO_HOME}/python/driftco.py ${OriDir}/2_BiasCo/${File_degibbs}.nii.gz ${B0index} ${OriDir}/2_BiasCo/${File_degibbs}-DriftCo.nii.gz
+		python3 ${iDIO_HOME}/python/driftco.py ${OriDir}/2_BiasCo/${File_degibbs}.nii.gz ${B0index} ${OriDir}/2_BiasCo/${File_degibbs}-DriftCo.nii.gz --jobs ${driftjobs}
 	else
 		echo "Not enough number of b0 (null scans), drifting correction skipped"
 	fi
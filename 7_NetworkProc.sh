@@ -6,6 +6,7 @@
 ## Version 2.0 /2020/02/08
 ## 20210208 replace matlab with python3 (argparse,pandas)
 ## 20210423 using ANTs to replace FSL(fnirt)
+## 20261018 scale connectomes with mu for all atlases in one python3 run
 ##########################################################################################################################
 
 
@@ -172,7 +173,8 @@ for i in *; do
     tck2connectome ${OriDir}/7_NetworkProc/Track_DynamicSeed_${tckNum}.tck ${OriDir}/Connectivity_Matrix/Atlas/${AtName}_inDWI.nii.gz ${OriDir}/Connectivity_Matrix/Mat_Length/${AtName}_Length.csv -symmetric -zero_diagonal -scale_length -stat_edge mean
 done
 
-for i in *; do
-    AtName=$(echo ${i}|cut -f1 -d'_')
-    python3 ${iDIO_HOME}/python/scale_mu.py ${OriDir}/Connectivity_Matrix/Mat_SIFT2Wei/${AtName}_SIFT2.csv ${OriDir}/7_NetworkProc/SIFT_mu.txt ${OriDir}/Connectivity_Matrix/Mat_ScaleMu/${AtName}_ScaleMu.csv
-done
+## mu-scaled connectome (all atlases in one run)
+python3 ${iDIO_HOME}/python/scale_mu.py ${OriDir}/Connectivity_Matrix/Mat_SIFT2Wei ${OriDir}/7_NetworkProc/SIFT_mu.txt ${OriDir}/Connectivity_Matrix/Mat_ScaleMu
+
+## binary upper-triangle copies (float32) of all connectomes, next to the csv files
+python3 ${iDIO_HOME}/python/connectome.py csv2bin --force ${OriDir}/Connectivity_Matrix/Mat_SIFT2Wei ${OriDir}/Connectivity_Matrix/Mat_Length ${OriDir}/Connectivity_Matrix/Mat_ScaleMu
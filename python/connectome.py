@@ -0,0 +1,152 @@
+#!/usr/bin/python
+# version 2026/10/18
+import argparse
+import glob
+import json
+import os
+import numpy as np
+from scale_mu import load_csv
+
+# Binary connectome: symmetric matrix with zero diagonal (tck2connectome -symmetric -zero_diagonal),
+# only the upper triangle (row-major, without diagonal) stored as little-endian float32
+#   magic (8 bytes) | header length (uint32) | json header {atlas, n_roi, dtype} | padding | upper triangle
+CONN_MAGIC = b'iDIOCONN'
+CONN_EXT = '.conn'
+# bin2csv output suffix (X.conn -> X_f32.csv), so that the float32 values never replace the original csv files
+CSV_SUFFIX = '_f32'
+CONN_ALIGN = 64
+
+def parseArguments():
+    # Create argument parser
+
+    parser = argparse.ArgumentParser(description='This script converts connectivity matrices between csv and the binary upper-triangle format')
+
+    # Positional mandatory arguments
+    parser.add_argument("Mode", help="conversion direction", choices=['csv2bin', 'bin2csv'])
+    parser.add_argument("Input", help="input matrix file(s), or directories with *.csv (csv2bin) / *"+CONN_EXT+" (bin2csv, written as *"+CSV_SUFFIX+".csv) files", type=str, nargs='+')
+
+    # Optional arguments
+    parser.add_argument('-o','--output', help="output directory [default = next to the input]", type=str, default=None)
+    parser.add_argument('-a','--atlas', help="atlas name stored in the binary header [default = file name up to the first '_']", type=str, default=None)
+    parser.add_argument('-f','--force', help="overwrite existing output files", action='store_true')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    return args
+
+def save_conn(mat, path, atlas=None):
+    # save a symmetric connectivity matrix as binary upper triangle
+    # Inputs:
+    # - mat: n x n connectivity matrix
+    # - path: output file
+    # - atlas: atlas name kept in the header
+    ##
+    mat = np.asarray(mat)
+    if mat.ndim != 2 or mat.shape[0] != mat.shape[1]:
+        raise ValueError('connectivity matrix must be square, got shape ' + str(mat.shape))
+    # only the upper triangle is stored: anything else would be silently altered
+    if not np.array_equal(mat, mat.T, equal_nan=True):
+        raise ValueError('connectivity matrix must be symmetric (tck2connectome -symmetric)')
+    if np.any(np.diagonal(mat) != 0):
+        raise ValueError('connectivity matrix must have a zero diagonal (tck2connectome -zero_diagonal)')
+    n_roi = mat.shape[0]
+    hdr = json.dumps({'atlas': atlas, 'n_roi': n_roi, 'dtype': '<f4'}).encode()
+    offset = len(CONN_MAGIC) + 4 + len(hdr)
+    offset += -offset % CONN_ALIGN
+    with open(path, 'wb') as fobj:
+        fobj.write(CONN_MAGIC)
+        fobj.write(np.uint32(len(hdr)).astype('<u4').tobytes())
+        fobj.write(hdr)
+        fobj.write(b'\0' * (offset - fobj.tell()))
+        fobj.write(mat[np.triu_indices(n_roi, 1)].astype('<f4').tobytes())
+
+def conn_info(path):
+    # read the header of a binary connectome
+    # Outputs:
+    # - header dictionary (atlas, n_roi, dtype, offset of the upper triangle)
+    ##
+    with open(path, 'rb') as fobj:
+        if fobj.read(len(CONN_MAGIC)) != CONN_MAGIC:
+            raise ValueError(path + ' is not a binary connectome')
+        hdr_len = int(np.frombuffer(fobj.read(4), dtype='<u4')[0])
+        info = json.loads(fobj.read(hdr_len).decode())
+    offset = len(CONN_MAGIC) + 4 + hdr_len
+    info['offset'] = offset + (-offset % CONN_ALIGN)
+    return info
+
+def load_triu(path, mmap=True):
+    # load the upper triangle (row-major, without diagonal) of a binary connectome
+    # Inputs:
+    # - mmap: memory-map the file instead of reading it
+    # Outputs:
+    # - upper triangle vector (float32), header dictionary
+    ##
+    info = conn_info(path)
+    n_edge = info['n_roi']*(info['n_roi']-1)//2
+    if mmap:
+        triu = np.memmap(path, dtype=info['dtype'], mode='r', offset=info['offset'], shape=(n_edge,))
+    else:
+        with open(path, 'rb') as fobj:
+            fobj.seek(info['offset'])
+            triu = np.fromfile(fobj, dtype=info['dtype'], count=n_edge)
+    return triu, info
+
+def triu_to_mat(triu, n_roi):
+    # rebuild the full symmetric matrix (zero diagonal) from its upper triangle
+    mat = np.zeros((n_roi, n_roi), dtype=triu.dtype)
+    iu = np.triu_indices(n_roi, 1)
+    mat[iu] = triu
+    mat.T[iu] = triu
+    return mat
+
+def load_conn(path, mmap=True):
+    # load a binary connectome as full matrix
+    # Outputs:
+    # - n x n connectivity matrix (float32), header dictionary
+    ##
+    triu, info = load_triu(path, mmap)
+    return triu_to_mat(triu, info['n_roi']), info
+
+def save_conn_csv(mat, path):
+    # save a (float32) connectivity matrix as csv, values written as shortest float32 strings
+    with open(path, 'w') as fobj:
+        fobj.writelines(','.join(map(str, row)) + '\n' for row in mat)
+
+def _atlas_name(path):
+    # atlas name as used in 7_NetworkProc (file name up to the first '_')
+    return os.path.basename(path).split('_')[0]
+
+def _out_path(path, ext, out_dir):
+    # output file with a new extension, next to the input or in out_dir
+    out = os.path.splitext(path)[0] + ext
+    if out_dir is not None:
+        out = os.path.join(out_dir, os.path.basename(out))
+    return out
+
+# ouput arguments
+if __name__ == '__main__':
+    # for help function
+    args = parseArguments()
+    in_ext = '.csv' if args.Mode == 'csv2bin' else CONN_EXT
+    files = []
+    for path in args.Input:
+        if os.path.isdir(path):
+            # csv files written by bin2csv are not converted back
+            files += [f for f in sorted(glob.glob(os.path.join(path, '*' + in_ext))) if not f.endswith(CSV_SUFFIX + '.csv')]
+        else:
+            files.append(path)
+    out_ext = CONN_EXT if args.Mode == 'csv2bin' else CSV_SUFFIX + '.csv'
+    out_files = [_out_path(path, out_ext, args.output) for path in files]
+    existing = [out for out in out_files if os.path.exists(out)]
+    if existing and not args.force:
+        raise FileExistsError('{} output file(s) exist, e.g. {} (use --force to overwrite)'.format(len(existing), existing[0]))
+
+    # Run function
+    for path, out in zip(files, out_files):
+        if args.Mode == 'csv2bin':
+            atlas = args.atlas if args.atlas is not None else _atlas_name(path)
+            save_conn(load_csv(path), out, atlas)
+        else:
+            mat, info = load_conn(path, mmap=False)
+            save_conn_csv(mat, out)
@@ -3,11 +3,12 @@
 # Edit: conditional expression in mask generation
 
 import argparse, os, scipy.ndimage
+from multiprocessing import Pool, shared_memory
 from skimage import measure
+from skimage.morphology import reconstruction
 import numpy as np
 import scipy as sp
 import nibabel as nib
-import matplotlib.pyplot as plt #visualization 
 
 
 def parseArguments():
@@ -20,6 +21,11 @@ def parseArguments():
     parser.add_argument("B0_info", help="corresponding b0 image volume number(separated with comma), which are utilize in drift-estimation and correction",type=str)
     # parser.add_argument("Bzerothr", help="input Bzero threshold to identified the null images")
     parser.add_argument("Output", help="Output file name", type=str)
+    parser.add_argument('-j','--jobs', help="number of processes used to estimate the b0 brain masks [default = 1]", type=int, default=1)
+    parser.add_argument('-s','--stream', help="read and correct one volume at a time, writing the output incrementally (low memory)", action='store_true')
+    parser.add_argument('--stream_dtype', help="on-disk data type in streaming mode: keep the input type (integer inputs are rescaled with scl_slope) or float32 [default = input]", choices=['input', 'float32'], default='input')
+    parser.add_argument('--shared_mask', help="estimate one brain mask from the mean b0 and use it for every b0 (stable acquisitions)", action='store_true')
+    parser.add_argument('--no_plot', help="skip rendering the drift correction figures", action='store_true')
     parser.add_argument('-v','--version', action='version', version='driftco v1.0')
 
     # Parse arguments
@@ -27,64 +33,102 @@ def parseArguments():
 
     return args
 
-def drift_brainmask(im,thr,k,er_k):
-	# function to get brain mask for b- image for signal drift
-	# Inputs:
-	# - im: 3d data set (b0 image)
-	# - thr: manual tuning factor, typical [0.5 1]
-	# - k: morphological kernel size (odd integer)
-	# - er_k: erosion kernel, typical [3]
-	##
-    def flood_fill(test_array, four_way=False):
-        input_array = np.copy(test_array)
-        # Set h_max to a value larger than the array maximum to ensure that the while loop will terminate
-        h_max = np.max(input_array * 2.0)
-        # Build mask of cells with data not on the edge of the image
-        # Use 3x3 square structuring element
-        data_mask = np.isfinite(input_array)
+def flood_fill(test_array, four_way=False):
+    # Reference (slice-wise, iterative) hole filling of a 2d image
+    # Kept to validate fill_holes, which gives identical results in a single call
+    input_array = np.copy(test_array)
+    # Set h_max to a value larger than the array maximum to ensure that the while loop will terminate
+    h_max = np.max(input_array * 2.0)
+    # Build mask of cells with data not on the edge of the image
+    # Use 3x3 square structuring element
+    data_mask = np.isfinite(input_array)
+    el = np.array([[1, 1, 1], [1, 1, 1], [1, 1, 1]]).astype(np.bool_)
+    inside_mask = sp.ndimage.binary_erosion(data_mask, structure=el)
+    edge_mask = (data_mask & ~inside_mask)
+
+    # Initialize output array as max value test_array except edges
+    output_array = np.copy(input_array)
+    output_array[inside_mask] = h_max
+
+    # Array for storing previous iteration
+    output_old_array = np.copy(input_array)
+    output_old_array.fill(0)
+
+    # Cross structuring element
+    if four_way:
+        el = np.array([[0, 1, 0], [1, 1, 1], [0, 1, 0]]).astype(np.bool_)
+    else:
         el = np.array([[1, 1, 1], [1, 1, 1], [1, 1, 1]]).astype(np.bool_)
-        inside_mask = sp.ndimage.binary_erosion(data_mask, structure=el)
-        edge_mask = (data_mask & ~inside_mask)
-
-        # Initialize output array as max value test_array except edges
-        output_array = np.copy(input_array)
-        output_array[inside_mask] = h_max
-
-        # Array for storing previous iteration
-        output_old_array = np.copy(input_array)
-        output_old_array.fill(0)
-
-        # Cross structuring element
-        if four_way:
-            el = np.array([[0, 1, 0], [1, 1, 1], [0, 1, 0]]).astype(np.bool_)
-        else:
-            el = np.array([[1, 1, 1], [1, 1, 1], [1, 1, 1]]).astype(np.bool_)
-
-        # Iterate until marker array doesn't change
-        while not np.array_equal(output_old_array, output_array):
-            output_old_array = np.copy(output_array)
-            output_array = np.maximum(input_array, sp.ndimage.grey_erosion(output_array, footprint=el))
-        return output_array
 
-    def erode_kernel(k):
-        se = np.zeros([k, k, k])
-        se[(k+1)//2-1, (k+1)//2-1, (k+1)//2-1]=1
-        se = np.around(scipy.ndimage.gaussian_filter(se, 1, mode='constant'),decimals=4)
-        se = (se>=se[(k+1)//2-1,(k+1)//2-1,-1])*1
-        return se
-
-    # Get mask and erode once for each image
+    # Iterate until marker array doesn't change
+    while not np.array_equal(output_old_array, output_array):
+        output_old_array = np.copy(output_array)
+        output_array = np.maximum(input_array, sp.ndimage.grey_erosion(output_array, footprint=el))
+    return output_array
+
+def fill_holes(im, four_way=False):
+    # function to fill in-plane holes of every slice of a 3d image in a single call
+    # (morphological reconstruction by erosion, seeded from the border of each slice)
+    # Inputs:
+    # - im: 3d data set (grey-level image, or boolean mask for the binary fast path)
+    # - four_way: use the cross (4-connected) element instead of the 3x3 square
+    ##
+    if four_way:
+        el = np.array([[0, 1, 0], [1, 1, 1], [0, 1, 0]]).astype(np.bool_)
+    else:
+        el = np.array([[1, 1, 1], [1, 1, 1], [1, 1, 1]]).astype(np.bool_)
+    # in-plane element only, so that slices never exchange values
+    el = el[:, :, np.newaxis]
+
+    if im.dtype == np.bool_:
+        # binary image: holes are background regions not connected to the slice border
+        return scipy.ndimage.binary_fill_holes(im, structure=el)
+
+    # marker: input on the slice border, per-slice h_max (as flood_fill) inside;
+    # built in float64, as 2x the maximum does not fit integer images (e.g. int16 above 16383)
+    im = im.astype(np.float64)
+    data_mask = np.isfinite(im)
+    inside_mask = scipy.ndimage.binary_erosion(data_mask, structure=np.ones([3, 3, 1]))
+    h_max = np.max(im * 2.0, axis=(0, 1))
+    seed = np.copy(im)
+    seed[inside_mask] = np.broadcast_to(h_max, im.shape)[inside_mask]
+
+    # reconstruction needs marker >= image, which fails for slices with a negative
+    # maximum (h_max below the data) or non-finite values: use the reference there
+    ref = ~np.all(data_mask, axis=(0, 1)) | np.any(seed < im, axis=(0, 1))
+    im_fill = np.zeros(im.shape)
+    if not np.all(ref):
+        ok = np.where(~ref)[0]
+        im_fill[:, :, ok] = reconstruction(seed[:, :, ok], im[:, :, ok], 'erosion', el)
+    for x in np.where(ref)[0]:
+        im_fill[:, :, x] = flood_fill(im[:, :, x], four_way=four_way)
+    return im_fill
+
+def _sorted_median(s):
+    # median of an ascending sorted 1d array, same arithmetic as np.median
+    m = s.shape[0]
+    if m == 0:
+        return np.nan
+    return np.mean(s[(m-1)//2:m//2+1])
+
+def drift_threshold(im, ref_median=False):
+    # function to get the iterative intensity threshold of a b0 image
+    # Inputs:
+    # - im: 3d data set (b0 image)
+    # - ref_median: recompute the medians on the voxel array in every iteration
+    #   (reference path); by default the voxels are sorted once and each
+    #   iteration only bisects the sorted array
+    ##
     #bound at 99th percentile
-    im_fill = np.zeros([im.shape[0],im.shape[1],im.shape[2]])
-    for x in range(0, im.shape[2]):
-        im_fill[:,:,x] = flood_fill(im[:,:,x])
-
-    B = im_fill
     im = im.reshape(im.shape[0]*im.shape[1]*im.shape[2],1)
     im = np.delete(im,np.where(im<0))
     y = np.percentile(im,99)
     im = np.delete(im,np.where(im>y))
-    T = np.median(im)
+    if ref_median:
+        T = np.median(im)
+    else:
+        im = np.sort(im)
+        T = _sorted_median(im)
 
     # thresholding
     crit = True
@@ -92,37 +136,64 @@ def drift_brainmask(im,thr,k,er_k):
 
     while crit and N<100:
         N= N+1
-        T_new = np.median(im[im<=T]) + np.median(im[im>T])/2
+        if ref_median:
+            T_new = np.median(im[im<=T]) + np.median(im[im>T])/2
+        else:
+            n_le = np.searchsorted(im, T, side='right')
+            T_new = _sorted_median(im[:n_le]) + _sorted_median(im[n_le:])/2
         crit = T_new !=T
         T=T_new
+    return T
+
+def largest_component(mask):
+    # function to get the largest (6-connected) component of a binary mask
+    # Outputs:
+    # - boolean mask of the largest component (empty if there is none), number of components
+    ##
+    [L,NUM] = measure.label(mask, connectivity=1,return_num=True)
+    if NUM == 0:
+        return np.zeros_like(mask, dtype=np.bool_), NUM
+    sd = np.bincount(L.ravel())
+    sd[0] = 0
+    return L == np.argmax(sd), NUM
+
+def drift_brainmask(im,thr,k,er_k,ref_median=False):
+	# function to get brain mask for b- image for signal drift
+	# Inputs:
+	# - im: 3d data set (b0 image)
+	# - thr: manual tuning factor, typical [0.5 1]
+	# - k: morphological kernel size (odd integer)
+	# - er_k: erosion kernel, typical [3]
+	# - ref_median: use the reference (exact median per iteration) threshold, see drift_threshold
+	##
+    def erode_kernel(k):
+        se = np.zeros([k, k, k])
+        se[(k+1)//2-1, (k+1)//2-1, (k+1)//2-1]=1
+        se = np.around(scipy.ndimage.gaussian_filter(se, 1, mode='constant'),decimals=4)
+        se = (se>=se[(k+1)//2-1,(k+1)//2-1,-1])*1
+        return se
+
+    # Get mask and erode once for each image
+    B = fill_holes(im)
+    T = drift_threshold(im, ref_median)
     mask = B>T*thr*1
 
     # Get largest connected component
-    [L,NUM] = measure.label(mask, connectivity=1,return_num=True)
-    SL = L[L!=0];
-    [sd, binedge] = np.histogram(SL, bins=np.max(SL)-1)
-    [I] = np.where(sd==np.max(sd));
-    mask=mask*(L==binedge[I[0]])*1
-    mask_fill = np.zeros([mask.shape[0],mask.shape[1],mask.shape[2]])
-    for x in range(0, mask.shape[2]):
-        mask_fill[:,:,x] = flood_fill(mask[:,:,x],four_way=True)
+    mask, NUM = largest_component(mask)
+    mask_fill = fill_holes(mask.astype(np.bool_), four_way=True)
 
     # Erode mask with predefined kernel size
     se_2 = erode_kernel(k)
     mask_fill = scipy.ndimage.binary_erosion(mask_fill, se_2)
 
     #Get largest connected component again (if image only one component, pass this part)
-    [L,NUM] = measure.label(mask_fill, connectivity=1,return_num=True)
-    if np.max(L) != 1:
-        SL = L[L!=0];
-        [sd, binedge] = np.histogram(SL, bins=np.max(SL)-1)
-        [I] = np.where(sd==np.max(sd));
-        mask_fill=mask_fill*(L==binedge[I[0]])*1
+    lcc, NUM = largest_component(mask_fill)
+    if NUM != 1:
+        mask_fill = lcc
         mask_fill = scipy.ndimage.binary_dilation(mask_fill, se_2) #dilate with same kernel
 
         #fill all in-plan holes in the mask
-        for x in range(0, mask_fill.shape[2]):
-            mask_fill[:,:,x] = flood_fill(mask_fill[:,:,x],four_way=True)
+        mask_fill = fill_holes(mask_fill.astype(np.bool_), four_way=True)
 
         # create gaussian kernal first for last erosion
         se = erode_kernel(er_k)
@@ -130,6 +201,250 @@ def drift_brainmask(im,thr,k,er_k):
 
     return mask_fill
 
+def drift_masks(ims, thr, k, er_k, jobs=1, shared=False):
+    # function to get brain masks for all b0 images, optionally with a process pool
+    # Inputs:
+    # - ims: 4d data set (b0 images along the 4th axis)
+    # - thr, k, er_k: see drift_brainmask
+    # - jobs: number of processes; the b0 stack is placed once in shared memory
+    #   and every worker reads its b0 from there instead of receiving a copy
+    # - shared: compute a single mask from the mean b0 and use it for every b0
+    ##
+    mask = np.zeros(ims.shape)
+    if shared:
+        mask[:] = drift_brainmask(np.mean(ims, axis=3),thr,k,er_k)[..., np.newaxis]
+        return mask
+    if jobs <= 1 or ims.shape[3] == 1:
+        for x in range(0, ims.shape[3]):
+            mask[:,:,:,x] = drift_brainmask(ims[:,:,:,x],thr,k,er_k)
+        return mask
+
+    shm = shared_memory.SharedMemory(create=True, size=ims.nbytes)
+    try:
+        stack = np.ndarray(ims.shape, dtype=ims.dtype, buffer=shm.buf)
+        stack[:] = ims
+        tasks = [(x, thr, k, er_k) for x in range(0, ims.shape[3])]
+        with Pool(processes=min(jobs, ims.shape[3]), initializer=_attach_stack, initargs=(shm.name, ims.shape, ims.dtype.str)) as pool:
+            for x, m in enumerate(pool.imap(_stack_brainmask, tasks)):
+                mask[:,:,:,x] = m
+        del stack
+    finally:
+        shm.close()
+        shm.unlink()
+    return mask
+
+def mask_indices(mask):
+    # function to flatten every b0 mask once into a compact voxel index vector
+    # Inputs:
+    # - mask: 4d masks (b0 images along the 4th axis)
+    # Outputs:
+    # - list of flat (Fortran order, as the voxel x volume layout) indices of each mask
+    ##
+    return [np.flatnonzero(mask[:,:,:,j].reshape(-1, order='F') == 1) for j in range(0, mask.shape[3])]
+
+def masked_means(data, mask_ind, mask_idx):
+    # function to get the masked mean intensity of every volume of a 4d data set
+    # Inputs:
+    # - data: 4d data set
+    # - mask_ind: compact mask index vectors (see mask_indices)
+    # - mask_idx: mask used for each volume
+    # Outputs:
+    # - mean intensity of each volume within its mask
+    ##
+    nvox = data.shape[0]*data.shape[1]*data.shape[2]
+    mask_idx = np.asarray(mask_idx)
+    means = np.zeros(data.shape[3])
+    for j in np.unique(mask_idx):
+        # volumes sharing a mask are consecutive: one weighted sum over their
+        # voxel x volume block (a view of the Fortran-ordered series)
+        vols = np.flatnonzero(mask_idx == j)
+        vols = slice(vols[0], vols[-1]+1)
+        ind = mask_ind[j]
+        w = np.full(len(ind), 1.0/len(ind))
+        X = data[:,:,:,vols].reshape(nvox, -1, order='F')
+        means[vols] = w @ X[ind].astype(np.float64)
+    return means
+
+def stream_correct(raw_info, corr_fac, out_file, mask_ind, mask_idx, out_dtype=None):
+    # function to apply the drift correction volume by volume and write it incrementally,
+    # so that only one volume of the series is held in memory
+    # Inputs:
+    # - raw_info: nibabel image of the drift-affected series (read through its array proxy)
+    # - corr_fac: correction factor of each volume
+    # - out_file: output nifti file (.nii or .nii.gz)
+    # - mask_ind, mask_idx: compact b0 masks and the mask used for each volume (intensity traces)
+    # - out_dtype: on-disk data type [default = input data type]
+    # Outputs:
+    # - masked mean intensity of each volume before correction
+    ##
+    nr_ims = raw_info.shape[3]
+    in_dtype = raw_info.get_data_dtype()
+    if out_dtype is None:
+        out_dtype = in_dtype
+    out_dtype = np.dtype(out_dtype)
+
+    hdr = raw_info.header.copy()
+    hdr.set_data_dtype(out_dtype)
+    if np.issubdtype(out_dtype, np.integer):
+        # integer output: one scl_slope for the whole series, fitted to the range of the
+        # corrected data (first pass over the volumes), so that the quantization step
+        # is as fine as nibabel's scaling of the in-memory output
+        out_max = 0.0
+        for d in range(0, nr_ims):
+            t = np.asanyarray(raw_info.dataobj[..., d])
+            out_max = max(out_max, np.max(np.abs(t))*abs(corr_fac[d]))
+        slope = out_max / np.iinfo(out_dtype).max if out_max > 0 else 1.0
+    else:
+        slope = 1.0
+    if slope == 1.0:
+        hdr.set_slope_inter(None, None)
+    else:
+        hdr.set_slope_inter(slope, 0.0)
+
+    ints_raw = np.zeros(nr_ims)
+    with nib.openers.ImageOpener(out_file, 'wb') as fobj:
+        hdr.write_to(fobj)
+        fobj.write(b'\x00' * (int(hdr.get_data_offset()) - fobj.tell()))
+        for d in range(0, nr_ims):
+            t = np.asanyarray(raw_info.dataobj[..., d])
+            ind = mask_ind[mask_idx[d]]
+            ints_raw[d] = np.mean(t.reshape(-1, order='F')[ind], dtype=np.float64)
+            nib.volumeutils.array_to_file(t*corr_fac[d], fobj, out_dtype, offset=None, divslope=slope)
+    return ints_raw
+
+def drift_fit(b_to_use, ints, nr_ims):
+    # function to fit the (linear) signal drift of the b0 intensities
+    # Inputs:
+    # - b_to_use: b0 volume numbers
+    # - ints: mean intensity of each b0 within its mask
+    # - nr_ims: number of volumes in the series
+    # Outputs:
+    # - dictionary with the fit, the fitted intensity and correction factor of each volume,
+    #   the baseline and the estimated signal loss (%) from first to last volume
+    ##
+    x = range(1,nr_ims+1)
+    drift_fit_l = np.polyfit(b_to_use,ints,1)
+    corr_l = x*drift_fit_l[0]+drift_fit_l[1]
+    decr_prc = (1-corr_l[nr_ims-1]/corr_l[0])*100
+    norm_val = drift_fit_l[1]
+    # get correction for each image
+    corr_fac = norm_val/corr_l
+
+    fit_dict = {
+        'drift_fit': drift_fit_l,
+        'corr_l': corr_l,
+        'corr_fac': corr_fac,
+        'norm_val': norm_val,
+        'decr_prc': decr_prc
+    }
+    return fit_dict
+
+def drift_traces(b_to_use, ints, intsall, fit_dict):
+    # function to gather the intensity traces before and after correction
+    # (masked means are linear: corrected intensities follow from the correction factors)
+    corr_fac = fit_dict['corr_fac']
+    trace_dict = {
+        'ints': ints,
+        'intsall': intsall,
+        'mean_corr_int': ints*corr_fac[b_to_use],
+        'mean_corr_intsall': intsall*corr_fac
+    }
+    return trace_dict
+
+def drift_correct(array, b0_indices, thr=0.8, k=5, er_k=3, jobs=1, shared_mask=False):
+    # function to estimate and correct the signal drift of a 4d DWI data set
+    # Inputs:
+    # - array: 4d data set (drift-affected DWI)
+    # - b0_indices: b0 volume numbers, utilized in drift estimation and correction
+    # - thr, k, er_k: brain mask parameters (see drift_brainmask)
+    # - jobs, shared_mask: number of processes for the b0 brain masks, single mask from the mean b0 (see drift_masks)
+    # Outputs:
+    # - corrected 4d data set, fit dictionary (see drift_fit), trace dictionary (see drift_traces)
+    ##
+    b_to_use = list(b0_indices)
+    nr_ims = array.shape[3]
+
+    # Get mask for each b0 and mean intensities within the masks
+    mask = drift_masks(array[:,:,:,b_to_use], thr, k, er_k, jobs=jobs, shared=shared_mask)
+    mask_ind = mask_indices(mask)
+    ints = masked_means(array[:,:,:,b_to_use], mask_ind, range(0, len(b_to_use)))
+    intsall = masked_means(array, mask_ind, _mask_index(b_to_use, nr_ims))
+
+    # do linear fit correction and apply it to each volume
+    fit_dict = drift_fit(b_to_use, ints, nr_ims)
+    DWI_corr = array*fit_dict['corr_fac']
+
+    return DWI_corr, fit_dict, drift_traces(b_to_use, ints, intsall, fit_dict)
+
+def drift_plot(b_to_use, fit_dict, trace_dict, out_dir):
+    # function to render the drift correction figures (matplotlib only imported here, Agg backend)
+    # Outputs:
+    # - Drifting_Correction_B0only.png and Drifting_Correction_allData.png in out_dir
+    ##
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    nr_ims = len(trace_dict['intsall'])
+    x = range(1,nr_ims+1)
+    norm_val = fit_dict['norm_val']
+
+    # show corrected intensities of b0
+    f = Figure(figsize=(10,8))
+    FigureCanvasAgg(f)
+    ax = f.add_subplot()
+    # plot raw intensities
+    ax.plot(b_to_use, trace_dict['ints'], 'ro',label='Uncorrected')
+    # plot corrected intensities and the fit line
+    ax.plot(b_to_use, trace_dict['mean_corr_int'],'bo',label='Corrected')
+    ax.plot(fit_dict['corr_l'],'b',label='Linear fit')
+    #add dashed line at 100%
+    ax.plot([0, nr_ims],[norm_val, norm_val],'k--', label='baseline')
+    ax.legend(loc='best', fontsize='large')
+    ax.set_xlim([-2, nr_ims+2])
+    ax.set_ylabel('Signal intensity')
+    ax.set_xlabel('DWI volume')
+    ax.set_title("An estimated " + str(round(fit_dict['decr_prc'],2)) +"% signal loss from first to last image")
+    f.savefig(os.path.join(out_dir, 'Drifting_Correction_B0only.png'))
+
+    # show corrected intensities of all images
+    f = Figure(figsize=(10,8))
+    FigureCanvasAgg(f)
+    ax = f.add_subplot()
+    ax.plot(b_to_use, trace_dict['ints'], 'ro',label='Uncorrected B0')
+    ax.plot(x, trace_dict['intsall'],'r-',label='Uncorrected')
+    ax.plot(b_to_use, trace_dict['mean_corr_int'], 'bo', label='Corrected B0')
+    ax.plot(x, trace_dict['mean_corr_intsall'], 'b-', label='Corrected')
+    ax.plot([0, nr_ims],[norm_val, norm_val],'k--', label='baseline')
+    ax.set_xlim([-2, nr_ims+2])
+    ax.set_ylabel('Signal intensity')
+    ax.set_xlabel('DWI volume')
+    ax.set_title("Drifting_Corrected_Data")
+    ax.legend(loc='best', fontsize='large')
+    f.savefig(os.path.join(out_dir, 'Drifting_Correction_allData.png'))
+
+# Helper function
+def _mask_index(b_to_use, nr_ims):
+    # mask (b0) used for the intensity trace of each volume
+    mask_idx = []
+    j=0
+    for i in range(0,nr_ims):
+        mask_idx.append(j)
+        if j<len(b_to_use)-1 and i>= b_to_use[j+1]:
+            j=j+1
+    return mask_idx
+
+# Helper function (pool workers)
+_shared_stack = {}
+
+def _attach_stack(name, shape, dtype):
+    shm = shared_memory.SharedMemory(name=name)
+    _shared_stack['shm'] = shm
+    _shared_stack['ims'] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+def _stack_brainmask(task):
+    x, thr, k, er_k = task
+    return drift_brainmask(_shared_stack['ims'][:,:,:,x],thr,k,er_k)
+
 # ouput arguments
 if __name__ == '__main__':
     args = parseArguments()
@@ -139,100 +454,40 @@ if __name__ == '__main__':
     # Load Grad Info
     # grad_info = np.loadtxt(args.Grad_info_path)
 
-    # Load image
-    raw_info = nib.load(args.Input)
-    raw = np.array(nib.load(args.Input).dataobj)
-    nr_ims = raw.shape[3]
-
     # Fix parameters for generating brain mask
     er_k = 3
     k = 5
     mask_thr = 0.8
 
-    # Get all selected images
-    ims_to_use = raw[:,:,:,b_to_use]
-
-    # Get mask for each image
-    mask = np.zeros([raw.shape[0],raw.shape[1],raw.shape[2],len(b_to_use)])
-    for x in range(0,len(b_to_use)):
-        mask[:,:,:,x]=drift_brainmask(ims_to_use[:,:,:,x],mask_thr,k,er_k)
-
-    # Get mean intensities of each b0 within the mask
-    ints = np.zeros([len(b_to_use)])
-    n = len(b_to_use)
-    x = range(1,nr_ims+1)
-    for i in range(0, len(b_to_use)):
-        t = ims_to_use[:,:,:,i]
-        ints[i] = np.mean(t[np.where(mask[:,:,:,i]==1)])
-    j=0
-    intsall = np.zeros(nr_ims)
-    for i in range(0,nr_ims):
-        t = raw[:,:,:,i]
-        intsall[i] = np.mean(t[np.where(mask[:,:,:,j]==1)])
-        if j<len(b_to_use)-1 and i>= b_to_use[j+1]:
-            j=j+1    
-
-    # do linear fit correction
-    drift_fit_l = np.polyfit(b_to_use,ints,1)
-    corr_l = x*drift_fit_l[0]+drift_fit_l[1]
-    decr_prc = (1-corr_l[nr_ims-1]/corr_l[0])*100
-    norm_val = drift_fit_l[1]
-    # get correction for each image
-    corr_fac = norm_val/corr_l
-    # apply correction to each volume
-    DWI_corr = np.zeros(raw.shape)
-    for d in range(0, DWI_corr.shape[3]):
-        DWI_corr[:,:,:,d] = raw[:,:,:,d]*corr_fac[d]
-    #get b0 from corrected data
-    mean_corr_int = np.zeros([len(b_to_use)])
-    for i in range(0, len(b_to_use)):
-        t = DWI_corr[:,:,:,b_to_use[i]]
-        mean_corr_int[i] = np.mean(t[np.where(mask[:,:,:,i]==1)])
-    j=0
-    mean_corr_intsall = np.zeros(nr_ims)
-    for i in range(0,nr_ims):
-        t = DWI_corr[:,:,:,i]
-        mean_corr_intsall[i] = np.mean(t[np.where(mask[:,:,:,j]==1)])
-        if j<len(b_to_use)-1 and i>= b_to_use[j+1]:
-            j=j+1
-
-    # save to image
-    SaveDWI = nib.Nifti1Image(DWI_corr,raw_info.affine, raw_info.header)
-    nib.save(SaveDWI, args.Output)
+    if args.stream:
+        # Load image: keep the file open so that volumes are read sequentially through the proxy
+        raw_info = nib.load(args.Input, keep_file_open=True)
+        nr_ims = raw_info.shape[3]
+
+        # Get all selected images, mask for each image and mean intensities within the mask
+        ims_to_use = np.stack([np.asanyarray(raw_info.dataobj[..., i]) for i in b_to_use], axis=3)
+        mask = drift_masks(ims_to_use, mask_thr, k, er_k, jobs=args.jobs, shared=args.shared_mask)
+        mask_ind = mask_indices(mask)
+        ints = masked_means(ims_to_use, mask_ind, range(0, len(b_to_use)))
+
+        # do linear fit correction, then apply it and save to image, one volume at a time
+        fit_dict = drift_fit(b_to_use, ints, nr_ims)
+        out_dtype = np.float32 if args.stream_dtype == 'float32' else None
+        intsall = stream_correct(raw_info, fit_dict['corr_fac'], args.Output, mask_ind, _mask_index(b_to_use, nr_ims), out_dtype=out_dtype)
+        trace_dict = drift_traces(b_to_use, ints, intsall, fit_dict)
+    else:
+        # Load image
+        raw_info = nib.load(args.Input)
+        raw = np.array(raw_info.dataobj)
+        DWI_corr, fit_dict, trace_dict = drift_correct(raw, b_to_use, mask_thr, k, er_k, jobs=args.jobs, shared_mask=args.shared_mask)
+
+        # save to image
+        SaveDWI = nib.Nifti1Image(DWI_corr,raw_info.affine, raw_info.header)
+        nib.save(SaveDWI, args.Output)
 
     Savepath = os.path.split(args.Output)
-    # show corrected intensities of b0
-    f=plt.figure(figsize=(10,8))
-    # plot raw intensities
-    plt.plot(b_to_use, ints, 'ro',label='Uncorrected')
-    # plot corrected intensities and the fit line
-    plt.plot(b_to_use, mean_corr_int,'bo',label='Corrected')
-    plt.plot(corr_l,'b',label='Linear fit')
-    #add dashed line at 100%
-    plt.plot([0, nr_ims],[norm_val, norm_val],'k--', label='baseline')
-    plt.legend(loc='best', fontsize='large')
-    plt.xlim([-2, nr_ims+2])
-    plt.ylabel('Signal intensity')
-    plt.xlabel('DWI volume')
-    plt.title("An estimated " + str(round(decr_prc,2)) +"% signal loss from first to last image")
-    # plt.show()
-    plt.savefig(Savepath[0]+'/Drifting_Correction_B0only.png')
-
     with open(Savepath[0]+'/Drifting_val.csv', 'w') as str_fobj:
-        str_fobj.write(str(round(decr_prc,4)))
+        str_fobj.write(str(round(fit_dict['decr_prc'],4)))
 
-
-    # show corrected intensities of all images
-    f=plt.figure(figsize=(10,8))
-    plt.plot(b_to_use, ints, 'ro',label='Uncorrected B0')
-    plt.plot(x,intsall,'r-',label='Uncorrected')
-    plt.plot(b_to_use, mean_corr_int, 'bo', label='Corrected B0')
-    plt.plot(x, mean_corr_intsall, 'b-', label='Corrected')
-    plt.plot([0, nr_ims],[norm_val, norm_val],'k--', label='baseline')
-    plt.xlim([-2, nr_ims+2])
-    plt.ylabel('Signal intensity')
-    plt.xlabel('DWI volume')
-    plt.title("Drifting_Corrected_Data")
-    plt.legend(loc='best', fontsize='large')
-    # plt.show()
-    plt.savefig(Savepath[0]+'/Drifting_Correction_allData.png')
\ No newline at end of file
+    if not args.no_plot:
+        drift_plot(b_to_use, fit_dict, trace_dict, Savepath[0])
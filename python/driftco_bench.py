@@ -0,0 +1,159 @@
+#!/usr/bin/python
+# version 2026/10/18
+import argparse
+import json
+import os
+import resource
+import tempfile
+import time
+from multiprocessing import get_context
+import numpy as np
+import nibabel as nib
+import driftco
+
+def parseArguments():
+    # Create argument parser
+
+    parser = argparse.ArgumentParser(description='This script benchmarks driftco.py on synthetic 4D DWI phantoms with an injected linear signal drift')
+
+    # Optional arguments
+    parser.add_argument('--sizes', help="in-plane matrix sizes, separated with comma [default = 96,128,200]", type=str, default='96,128,200')
+    parser.add_argument('--slices', help="slice counts, separated with comma [default = 60]", type=str, default='60')
+    parser.add_argument('--b0s', help="b0 counts, separated with comma [default = 5]", type=str, default='5')
+    parser.add_argument('--vols', help="total number of volumes of each phantom [default = 64]", type=int, default=64)
+    parser.add_argument('--drift', help="injected signal loss from first to last volume in %% [default = 5]", type=float, default=5.0)
+    parser.add_argument('--stages', help="stages to time, separated with comma (mask, fill, trace, write, stream) [default = mask,trace,write,stream]", type=str, default='mask,trace,write,stream')
+    parser.add_argument('-j','--jobs', help="number of processes for the b0 brain masks [default = 1]", type=int, default=1)
+    parser.add_argument('-o','--output', help="output json file [default = print to stdout]", type=str, default=None)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    return args
+
+def drift_phantom(n, nz, nr_b0, nr_ims, drift, seed=0):
+    # function to generate a synthetic 4d DWI data set with a linear signal drift
+    # Inputs:
+    # - n, nz: in-plane matrix size and number of slices
+    # - nr_b0: number of b0 volumes, spread evenly over the series (first and last included)
+    # - nr_ims: number of volumes
+    # - drift: signal loss from first to last volume (%)
+    # Outputs:
+    # - 4d data set (int16), b0 volume numbers
+    ##
+    rng = np.random.default_rng(seed)
+    x, y, z = np.meshgrid(np.linspace(-1,1,n), np.linspace(-1,1,n), np.linspace(-1,1,nz), indexing='ij')
+    r = (x/0.7)**2 + (y/0.8)**2 + (z/0.9)**2
+    b0 = np.where(r < 1, 800.0, 0.0)
+    b0 += np.where((x/0.15)**2 + (y/0.3)**2 + (z/0.4)**2 < 1, 1200.0, 0.0)
+    b0 -= np.where(((x-0.3)/0.1)**2 + (y/0.1)**2 < 1, 700.0, 0.0) * (r < 1)
+    # bright specks outside the head, so that the masks have more than one component
+    b0[-4:-2, -4:-2, :] += 1500.0
+    b0[-4:-2, 2:4, ::4] += 1500.0
+
+    b_to_use = [int(b) for b in np.round(np.linspace(0, nr_ims-1, nr_b0))]
+    loss = 1 - drift/100*np.arange(nr_ims)/(nr_ims-1)
+    dwi = np.empty(b0.shape + (nr_ims,), dtype=np.int16)
+    for i in range(0, nr_ims):
+        att = 1.0 if i in b_to_use else rng.uniform(0.2, 0.5)
+        dwi[...,i] = np.abs(b0*att*loss[i] + rng.normal(0, 20, b0.shape))
+    return dwi, b_to_use
+
+def _peak_rss():
+    # peak resident set size of this process (MB)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+def _run_stage(task):
+    # one stage of one case, executed in a fresh process so that the peak RSS is its own
+    case, stage, jobs = task
+    dwi, b_to_use = drift_phantom(case['size'], case['slices'], case['b0s'], case['vols'], case['drift'])
+    ims_to_use = dwi[:,:,:,b_to_use]
+    nr_ims = dwi.shape[3]
+    result = {'stage': stage}
+    rss_in = _peak_rss()
+
+    if stage == 'mask':
+        t0 = time.perf_counter()
+        driftco.drift_masks(ims_to_use, 0.8, 5, 3, jobs=jobs)
+        result['wall_s'] = time.perf_counter() - t0
+    elif stage == 'fill':
+        # grey-level hole filling of the first b0: fill_holes against the slice-wise flood_fill reference
+        b0 = ims_to_use[:,:,:,0]
+        t0 = time.perf_counter()
+        im_fill = driftco.fill_holes(b0)
+        result['wall_s'] = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        im_ref = np.stack([driftco.flood_fill(b0[:,:,z].astype(np.float64)) for z in range(0, b0.shape[2])], axis=2)
+        result['ref_wall_s'] = time.perf_counter() - t0
+        result['identical'] = bool(np.array_equal(im_fill, im_ref))
+    else:
+        mask = driftco.drift_masks(ims_to_use, 0.8, 5, 3, jobs=jobs)
+        rss_in = _peak_rss()
+        t0 = time.perf_counter()
+        mask_ind = driftco.mask_indices(mask)
+        ints = driftco.masked_means(ims_to_use, mask_ind, range(0, len(b_to_use)))
+        fit_dict = driftco.drift_fit(b_to_use, ints, nr_ims)
+        if stage == 'trace':
+            driftco.masked_means(dwi, mask_ind, driftco._mask_index(b_to_use, nr_ims))
+            result['wall_s'] = time.perf_counter() - t0
+            result['drift_prc'] = float(fit_dict['decr_prc'])
+        else:
+            with tempfile.TemporaryDirectory() as tmp:
+                in_file = os.path.join(tmp, 'dwi.nii.gz')
+                out_file = os.path.join(tmp, 'dwi_corr.nii.gz')
+                nib.save(nib.Nifti1Image(dwi, np.eye(4)), in_file)
+                del dwi, ims_to_use, mask
+                t0 = time.perf_counter()
+                if stage == 'write':
+                    raw_info = nib.load(in_file)
+                    DWI_corr = np.asanyarray(raw_info.dataobj)*fit_dict['corr_fac']
+                    nib.save(nib.Nifti1Image(DWI_corr, raw_info.affine, raw_info.header), out_file)
+                else:
+                    raw_info = nib.load(in_file, keep_file_open=True)
+                    driftco.stream_correct(raw_info, fit_dict['corr_fac'], out_file, mask_ind, driftco._mask_index(b_to_use, nr_ims))
+                result['wall_s'] = time.perf_counter() - t0
+
+    result['peak_rss_mb'] = _peak_rss()
+    result['setup_rss_mb'] = rss_in
+    return result
+
+def bench(cases, stages, jobs=1):
+    # function to time the driftco stages on every phantom case
+    # Outputs:
+    # - list of dictionaries: case parameters, recovered drift and per-stage wall time / peak RSS
+    ##
+    ctx = get_context('spawn')
+    report = []
+    for case in cases:
+        entry = dict(case)
+        entry['stages'] = {}
+        for stage in stages:
+            with ctx.Pool(processes=1) as pool:
+                result = pool.map(_run_stage, [(case, stage, jobs)])[0]
+            if 'drift_prc' in result:
+                entry['drift_prc'] = result.pop('drift_prc')
+                entry['drift_err'] = entry['drift_prc'] - case['drift']
+            entry['stages'][result.pop('stage')] = result
+        report.append(entry)
+    return report
+
+# ouput arguments
+if __name__ == '__main__':
+    args = parseArguments()
+    cases = [{'size': n, 'slices': nz, 'b0s': nb, 'vols': args.vols, 'drift': args.drift}
+             for n in [int(v) for v in args.sizes.split(",")]
+             for nz in [int(v) for v in args.slices.split(",")]
+             for nb in [int(v) for v in args.b0s.split(",")]]
+    stages = args.stages.split(",")
+
+    report = {
+        'driftco': 'driftco v1.0',
+        'jobs': args.jobs,
+        'cases': bench(cases, stages, args.jobs)
+    }
+    out = json.dumps(report, indent=2)
+    if args.output is None:
+        print(out)
+    else:
+        with open(args.output, 'w') as fobj:
+            fobj.write(out)
@@ -4,7 +4,7 @@
 # iDIO QC vis function
 
 # Set Up
-import os, glob
+import os
 
 from io import StringIO
 
@@ -16,6 +16,7 @@ import matplotlib.cm as mcm
 import matplotlib.image as mpimg
 import matplotlib.text as mtext
 from matplotlib.transforms import Affine2D
+from matplotlib.collections import PolyCollection
 
 # import mpl_toolkits.axisartist as axisartist
 from skimage import measure
@@ -36,13 +37,12 @@ def vis_pedir(dwi_files, bvecs_files, bvals_files, pe_axis, pe_dirs, vis_dir, B0
     dwi_prefixes = []
     dwi_pe_strs = []
 
-    tmp, _, tmp_hdr = utils.load_nii(dwi_files[0])
-    tmp_vd=tmp_hdr.get_zooms()
+    tmp_shape, tmp_vd, _, _ = utils.load_nii_info(dwi_files[0])
 
     if num_dwi == 1:
-        fig, ax = plt.subplots(nrows=3, ncols=num_dwi, gridspec_kw={ 'width_ratios': [1], 'height_ratios': [tmp.shape[2]/tmp_vd[1], tmp.shape[2]/tmp_vd[1], tmp.shape[1]/tmp_vd[2]]})
+        fig, ax = plt.subplots(nrows=3, ncols=num_dwi, gridspec_kw={ 'width_ratios': [1], 'height_ratios': [tmp_shape[2]/tmp_vd[1], tmp_shape[2]/tmp_vd[1], tmp_shape[1]/tmp_vd[2]]})
     else:
-        fig, ax = plt.subplots(nrows=3, ncols=num_dwi, gridspec_kw={ 'width_ratios': [1,1], 'height_ratios': [tmp.shape[2]/tmp_vd[1], tmp.shape[2]/tmp_vd[1], tmp.shape[1]/tmp_vd[2]]})
+        fig, ax = plt.subplots(nrows=3, ncols=num_dwi, gridspec_kw={ 'width_ratios': [1,1], 'height_ratios': [tmp_shape[2]/tmp_vd[1], tmp_shape[2]/tmp_vd[1], tmp_shape[1]/tmp_vd[2]]})
 
     for i in range(num_dwi):
 
@@ -52,9 +52,9 @@ def vis_pedir(dwi_files, bvecs_files, bvals_files, pe_axis, pe_dirs, vis_dir, B0
 
         bvals, _, _ = utils.shell_bvals(dwi_files[i], bvecs_files[i], bvals_files[i], B0thr)
 
-        b0_file, _, _ = utils.dwi_extract_iDIO(dwi_file, bvals, temp_dir, target_bval=0, first_only=True)
-        b0_img, b0_aff, _ = utils.load_nii(b0_file)
-        b0_slices, b0_vox_dim, b0_min, b0_max = utils.slice_nii(b0_file, min_intensity=0, max_percentile=SHARED_VARS.VIS_PERCENTILE_MAX)
+        dwi_img, b0_aff, _ = utils.load_nii(dwi_file, ndim=4)
+        b0_img, _, _ = utils.dwi_extract_img(dwi_img, b0_aff, bvals, target_bval=0, first_only=True)
+        b0_slices, b0_vox_dim, b0_min, b0_max = utils.slice_img(b0_img, b0_aff, min_intensity=0, max_percentile=SHARED_VARS.VIS_PERCENTILE_MAX)
         
         dwi_prefixes.append(utils.get_prefix(dwi_file))
         dwi_pe_strs.append(utils.pescheme2axis(pe_axis[i], pe_dirs[i], b0_aff))
@@ -108,8 +108,7 @@ def vis_pedir(dwi_files, bvecs_files, bvals_files, pe_axis, pe_dirs, vis_dir, B0
     fig.set_size_inches(SHARED_VARS.PAGESIZE)
 
     pedir_vis_file = os.path.join(vis_dir, 'pedir.pdf')
-    plt.savefig(pedir_vis_file)#, dpi=SHARED_VARS.PDF_DPI)
-    plt.close()
+    pedir_vis_file = utils.save_page(pedir_vis_file)#, dpi=SHARED_VARS.PDF_DPI)
 
     # utils.remove_dir(temp_dir)
 
@@ -119,61 +118,46 @@ def vis_degibbs(dwi_files, bvals, dwi_degibbs_files, gains, vis_dir):
 
     temp_dir = utils.make_dir(vis_dir, 'TMP')
 
-    # Scale all inputs by prenormalization gains
+    # Running mean of the b0 residuals (postgibbs - pregibbs), each pair scaled by its prenormalization gain.
+    # Only the b0 volumes are read; volumes are indexed in the merged (concatenated) series, as bvals.
 
-    dwi_scaled_files = []
-    dwi_degibbs_scaled_files = []
+    res_sum = None
+    vol_offset = 0
     for i in range(len(dwi_files)):
-        # Pregibbs
-        dwi_prefix = utils.get_prefix(dwi_files[i], file_ext='nii')
-        dwi_img, dwi_aff, _ = utils.load_nii(dwi_files[i])
-        dwi_scaled_img = dwi_img * gains[i]
-        dwi_scaled_file = os.path.join(temp_dir, '{}_scaled.nii.gz'.format(dwi_prefix))
-        utils.save_nii(dwi_scaled_img, dwi_aff, dwi_scaled_file)
-        dwi_scaled_files.append(dwi_scaled_file)
-        
-        # Postgibbs
-        dwi_degibbs_prefix = utils.get_prefix(dwi_degibbs_files[i], file_ext='nii')
-        dwi_degibbs_img, dwi_degibbs_aff, _ = utils.load_nii(dwi_degibbs_files[i])
-        dwi_degibbs_scaled_img = dwi_degibbs_img * gains[i]
-        dwi_degibbs_scaled_file = os.path.join(temp_dir, '{}_scaled.nii.gz'.format(dwi_degibbs_prefix))
-        utils.save_nii(dwi_degibbs_scaled_img, dwi_degibbs_aff, dwi_degibbs_scaled_file)
-        dwi_degibbs_scaled_files.append(dwi_degibbs_scaled_file)
-
-    # Load common bvals
-    # gibbs_bval_file = utils.bvals_merge(bvals_files, 'gibbs', temp_dir)
-
-    # Load pregibbs b0s, scaled by prenorm gains
-
-    pregibbs_prefix = 'pregibbs_scaled'
-    pregibbs_dwi_file = utils.dwi_merge(dwi_scaled_files, pregibbs_prefix, temp_dir)
-    pregibbs_b0s_file, _, _ = utils.dwi_extract_iDIO(pregibbs_dwi_file, bvals, temp_dir, target_bval=0, first_only=False)
-    pregibbs_b0s_img, gibbs_b0s_aff, _ = utils.load_nii(pregibbs_b0s_file, ndim=4)
-
-    # Load postgibbs b0s, scaled by prenorm gains
-
-    postgibbs_prefix = 'postgibbs_scaled'
-    postgibbs_dwi_file = utils.dwi_merge(dwi_degibbs_scaled_files, postgibbs_prefix, temp_dir)
-    postgibbs_b0s_file, _, _ = utils.dwi_extract_iDIO(postgibbs_dwi_file, bvals, temp_dir, target_bval=0, first_only=False)
-    postgibbs_b0s_img, _, _ = utils.load_nii(postgibbs_b0s_file, ndim=4)
+        dwi_nii = nib.load(dwi_files[i], keep_file_open=True)
+        dwi_degibbs_nii = nib.load(dwi_degibbs_files[i], keep_file_open=True)
+        if len(dwi_nii.shape) == 3:
+            dwi_nii = dwi_nii.slicer[..., np.newaxis]
+            dwi_degibbs_nii = dwi_degibbs_nii.slicer[..., np.newaxis]
+        if i == 0:
+            res_aff = dwi_nii.affine
+        num_vols = dwi_nii.shape[3]
 
-    # Calculate average absolute residuals
+        for j in np.flatnonzero(bvals[vol_offset:vol_offset + num_vols] == 0):
+            pregibbs_b0 = np.asarray(dwi_nii.dataobj[..., j], dtype=np.float64) * gains[i]
+            postgibbs_b0 = np.asarray(dwi_degibbs_nii.dataobj[..., j], dtype=np.float64) * gains[i]
+            res_b0 = postgibbs_b0 - pregibbs_b0
+            if res_sum is None:
+                res_sum = np.zeros(res_b0.shape)
+                res_num = np.zeros(res_b0.shape)
+            res_valid = ~np.isnan(res_b0)
+            res_sum[res_valid] += res_b0[res_valid]
+            res_num += res_valid
+        vol_offset += num_vols
 
-    # res_img = np.nanmean(np.abs(postgibbs_b0s_img - pregibbs_b0s_img), axis=3)
-    res_img = np.nanmean(postgibbs_b0s_img - pregibbs_b0s_img, axis=3)
+    # Calculate average residuals (nanmean over all b0s)
 
-    res_aff = gibbs_b0s_aff
-    res_file = os.path.join(temp_dir, 'gibbs_residuals.nii.gz')
-    utils.save_nii(res_img, res_aff, res_file, ndim=3)
+    res_img = np.divide(res_sum, res_num, out=np.full(res_sum.shape, np.nan), where=res_num > 0)
 
     # Plot 5 central triplanar views
 
     # res_slices, res_vox_dim, res_min, res_max = utils.slice_nii(res_file, offsets=[-10, -5, 0, 5, 10], min_intensity=0, max_percentile=99)
     # temp_vis_file = vis_vol(res_slices, res_vox_dim, res_min, res_max, temp_dir, name='Gibbs_Deringing,_Averaged_Residuals_of_b_=_0_Volumes', comment='Residuals should be larger at high-contrast interfaces', colorbar=False)
-    res_slices, res_vox_dim, res_min, res_max = utils.slice_nii(res_file, offsets=[-10, -5, 0, 5, 10], min_percentile=2, max_percentile=98)
+    res_slices, res_vox_dim, res_min, res_max = utils.slice_img(res_img, res_aff, offsets=[-10, -5, 0, 5, 10], min_percentile=2, max_percentile=98)
     temp_vis_file = vis_vol(res_slices, res_vox_dim, res_min, res_max, temp_dir, name='Gibbs_Deringing,_Averaged_Residuals_of_b_=_0_Volumes', colorbar=True, cmap='jet')
 
-    degibbs_vis_file = utils.rename_file(temp_vis_file, os.path.join(vis_dir, 'degibbs.pdf'))
+    degibbs_vis_file = temp_vis_file
+    degibbs_vis_file.set_label('degibbs')
 
     # Finish Up
 
@@ -234,8 +218,7 @@ def vis_vol(slices, vox_dim, min, max, vis_dir, name='?', comment='', colorbar=F
         plt.colorbar(im, cax=cbar_ax, orientation='horizontal')
 
     vis_file = os.path.join(vis_dir, '{}.pdf'.format(name))
-    plt.savefig(vis_file, dpi=SHARED_VARS.PDF_DPI)
-    plt.close()
+    vis_file = utils.save_page(vis_file, dpi=SHARED_VARS.PDF_DPI)
 
     return vis_file
 
@@ -250,13 +233,12 @@ def vis_preproc_mask(dwi_files, bvecs_files, bvals_files, dwi_preproc_file, bval
     dwi_pe_strs = []
     # plt.figure(0, figsize=SHARED_VARS.PAGESIZE)
 
-    tmp, _, tmp_hdr = utils.load_nii(dwi_files[0])
-    tmp_vd=tmp_hdr.get_zooms()
+    tmp_shape, tmp_vd, _, _ = utils.load_nii_info(dwi_files[0])
 
     if num_dwi == 1:
-        fig, ax = plt.subplots(nrows=4, ncols=num_dwi+1, gridspec_kw={ 'width_ratios': [1, 1], 'height_ratios': [tmp.shape[2]/tmp_vd[1], tmp.shape[2]/tmp_vd[1], tmp.shape[1]/tmp_vd[2], 5/tmp_vd[1]]})
+        fig, ax = plt.subplots(nrows=4, ncols=num_dwi+1, gridspec_kw={ 'width_ratios': [1, 1], 'height_ratios': [tmp_shape[2]/tmp_vd[1], tmp_shape[2]/tmp_vd[1], tmp_shape[1]/tmp_vd[2], 5/tmp_vd[1]]})
     else:
-        fig, ax = plt.subplots(nrows=4, ncols=num_dwi+1, gridspec_kw={ 'width_ratios': [1, 1, 1], 'height_ratios': [tmp.shape[2]/tmp_vd[1], tmp.shape[2]/tmp_vd[1], tmp.shape[1]/tmp_vd[2], 5/tmp_vd[1]]})
+        fig, ax = plt.subplots(nrows=4, ncols=num_dwi+1, gridspec_kw={ 'width_ratios': [1, 1, 1], 'height_ratios': [tmp_shape[2]/tmp_vd[1], tmp_shape[2]/tmp_vd[1], tmp_shape[1]/tmp_vd[2], 5/tmp_vd[1]]})
 
     for i in range(num_dwi):
 
@@ -266,10 +248,10 @@ def vis_preproc_mask(dwi_files, bvecs_files, bvals_files, dwi_preproc_file, bval
 
         bvals, _, _ = utils.shell_bvals(dwi_file, bvecs_file, bvals_file, B0thr)
 
-        b0_file, _, _ = utils.dwi_extract_iDIO(dwi_file, bvals, temp_dir, target_bval=0, first_only=True)
-        b0_img, b0_aff, _ = utils.load_nii(b0_file)
+        dwi_img, b0_aff, _ = utils.load_nii(dwi_file, ndim=4)
+        b0_img, _, _ = utils.dwi_extract_img(dwi_img, b0_aff, bvals, target_bval=0, first_only=True)
 
-        b0_slices, b0_vox_dim, b0_min, b0_max = utils.slice_nii(b0_file, min_intensity=0, max_percentile=SHARED_VARS.VIS_PERCENTILE_MAX)
+        b0_slices, b0_vox_dim, b0_min, b0_max = utils.slice_img(b0_img, b0_aff, min_intensity=0, max_percentile=SHARED_VARS.VIS_PERCENTILE_MAX)
 
         dwi_prefixes.append(utils.get_prefix(dwi_file))
         dwi_pe_strs.append(utils.pescheme2axis(pe_axis[i], pe_dirs[i], b0_aff))
@@ -330,8 +312,7 @@ def vis_preproc_mask(dwi_files, bvecs_files, bvals_files, dwi_preproc_file, bval
     plt.suptitle('Preprocessing Masks', fontsize=SHARED_VARS.TITLE_FONTSIZE, fontweight='bold')
 
     preproc_vis_file = os.path.join(vis_dir, 'preproc_masks.pdf')
-    plt.savefig(preproc_vis_file, dpi=SHARED_VARS.PDF_DPI)
-    plt.close()
+    preproc_vis_file = utils.save_page(preproc_vis_file, dpi=SHARED_VARS.PDF_DPI)
 
     # utils.remove_dir(temp_dir)
 
@@ -425,8 +406,7 @@ def vis_gradcheck(bvals_files, bvecs_files, bvals_preproc_file, bvecs_preproc_fi
     plt.subplots_adjust(top=0.9)
     plt.suptitle('Gradient Check', fontsize=SHARED_VARS.TITLE_FONTSIZE, fontweight='bold')
     gradcheck_vis_file = os.path.join(vis_dir, 'gradcheck.pdf')
-    plt.savefig(gradcheck_vis_file, dpi=SHARED_VARS.PDF_DPI)
-    plt.close()
+    gradcheck_vis_file = utils.save_page(gradcheck_vis_file, dpi=SHARED_VARS.PDF_DPI)
 
     # utils.remove_dir(temp_dir)
 
@@ -440,12 +420,14 @@ def vis_dwi(dwi_file, bvals_shelled, cnr_mask, cnr_dict, vis_dir):
     bvals = np.sort(np.unique(bvals_shelled))
     stats_out_list = []
 
+    dwi_img, dwi_aff, _ = utils.load_nii(dwi_file, ndim=4)
+
     for i in range(len(bvals)):
 
         bX = bvals[i]
-        bXs_file, num_bXs, _ = utils.dwi_extract_iDIO(dwi_file, bvals_shelled, temp_dir, target_bval=bX, first_only=False)
-        bXs_avg_file = utils.dwi_avg(bXs_file, temp_dir)
-        bXs_avg_slices, bXs_avg_vox_dim, bXs_avg_min, bXs_avg_max = utils.slice_nii(bXs_avg_file, offsets=[-10, -5, 0, 5, 10], min_intensity=0, max_percentile=SHARED_VARS.VIS_PERCENTILE_MAX)
+        bXs_img, num_bXs, _ = utils.dwi_extract_img(dwi_img, dwi_aff, bvals_shelled, target_bval=bX, first_only=False)
+        bXs_avg_img = utils.dwi_avg_img(bXs_img)
+        bXs_avg_slices, bXs_avg_vox_dim, bXs_avg_min, bXs_avg_max = utils.slice_img(bXs_avg_img, dwi_aff, offsets=[-10, -5, 0, 5, 10], min_intensity=0, max_percentile=SHARED_VARS.VIS_PERCENTILE_MAX)
         
         cnr = '{:.3f}'.format(cnr_dict[bX])
         cnr_label = 'SNR' if bX == 0 else 'CNR'
@@ -460,13 +442,8 @@ def vis_dwi(dwi_file, bvals_shelled, cnr_mask, cnr_dict, vis_dir):
             if num_bXs == 1:
                 stats_out_list.append('b{}_median_{},{}'.format(int(bX), 'snr' , 'only one b0 image were acquired'))
             else:
-                std_cmd = 'fslmaths {} -Tstd {}'.format(bXs_file, temp_dir + '/b0std.nii.gz')
-                utils.run_cmd(std_cmd)
-                snr_cmd = 'fslmaths {} -div {} {}'.format(bXs_avg_file, temp_dir + '/b0std.nii.gz', temp_dir + '/SNR.nii.gz')
-                utils.run_cmd(snr_cmd)
-                snr_img, _, _ = utils.load_nii(temp_dir + '/SNR.nii.gz', ndim=3)
                 mask_img, _, _ = utils.load_nii(cnr_mask, dtype='bool', ndim=3)
-                snr = np.nanmedian(snr_img[mask_img])
+                _, snr, _ = utils.dwi_snr(dwi_img, bvals_shelled, mask_img=mask_img, target_bval=bX)
                 # plot
                 bXs_vis_file = vis_vol(bXs_avg_slices, bXs_avg_vox_dim, bXs_avg_min, bXs_avg_max, vis_dir, name='Preprocessed_b_=_{},_{}_scan_average,_{}_=_{:.3f}'.format(int(bX), num_bXs, cnr_label, snr), colorbar=False)
                 dwi_vis_files.append(bXs_vis_file)
@@ -477,12 +454,9 @@ def vis_dwi(dwi_file, bvals_shelled, cnr_mask, cnr_dict, vis_dir):
     # utils.remove_dir(temp_dir)
     return dwi_vis_files, stats_out_list
 
-def vis_stats(dwi_file, bvals_file, motion_dict, EC_dict, eddy_dir, vis_dir):
-
-    # Load data
-    eddy_outlier_map_file = glob.glob(eddy_dir + '/*.eddy_outlier_map')[0]
-    eddy_num_std_file = glob.glob(eddy_dir + '/*.eddy_outlier_n_stdev_map')[0]        
+def vis_stats(dwi_file, bvals_file, motion_dict, EC_dict, eddy, vis_dir):
 
+    # Load data (eddy: utils.EddyResults)
     bvals = np.array(bvals_file)
     # Configure figure
     fig = plt.figure(0, figsize=SHARED_VARS.PAGESIZE)
@@ -591,13 +565,14 @@ def vis_stats(dwi_file, bvals_file, motion_dict, EC_dict, eddy_dir, vis_dir):
     # Visualize outlier map
     Outlier_warning = []
     o_n = 0
-    raw_outlier_map = _get_outlier_map(eddy_outlier_map_file)
+    raw_outlier_map = eddy.outlier_map
     outlier_map = np.transpose(raw_outlier_map)
     outlier_percentage = len(np.where(raw_outlier_map[bvals!=0,:]==1)[0])/outlier_map.shape[0]/len(np.where(bvals!=0)[0])
 
+    outlier_slices = np.sum(outlier_map, axis=0, dtype=int)
     for vol in range(outlier_map.shape[1]):
-        if sum(outlier_map)[vol]/outlier_map.shape[0] > 0.05:
-            Outlier_warning.append('    {} out of {} slices shown as outliers in volume {}'.format(sum(outlier_map)[vol], outlier_map.shape[0], vol))
+        if outlier_slices[vol]/outlier_map.shape[0] > 0.05:
+            Outlier_warning.append('    {} out of {} slices shown as outliers in volume {}'.format(outlier_slices[vol], outlier_map.shape[0], vol))
             o_n += 1
 
     o_n_percentage = o_n/len(np.where(bvals!=0)[0])
@@ -617,7 +592,7 @@ def vis_stats(dwi_file, bvals_file, motion_dict, EC_dict, eddy_dir, vis_dir):
         ax.axvline(xnew-0.5, color='gray', linewidth=0.5)
 
     # Visualize Eddy outlier number of standard deviation
-    num_std_matrix = _get_eddy_num_std_map(eddy_num_std_file)
+    num_std_matrix = eddy.outlier_n_stdev_map
     num_std_matrix = np.transpose(num_std_matrix)
     matrix_slices = np.nanmedian(num_std_matrix, axis=1)
     matrix_vols = np.nanmedian(num_std_matrix, axis=0)
@@ -663,8 +638,7 @@ def vis_stats(dwi_file, bvals_file, motion_dict, EC_dict, eddy_dir, vis_dir):
     # Finish Up Figure
 
     stats_vis_file = os.path.join(vis_dir, 'stats.pdf')
-    plt.savefig(stats_vis_file, dpi=SHARED_VARS.PDF_DPI)
-    plt.close()
+    stats_vis_file = utils.save_page(stats_vis_file, dpi=SHARED_VARS.PDF_DPI)
 
     return stats_vis_file, outlier_percentage, Outlier_warning, o_n_percentage, bvol
 
@@ -692,8 +666,7 @@ def vis_drift(png_path, vis_dir):
 
     drift_vis_file = os.path.join(vis_dir, 'drift.pdf')
     plt.subplots_adjust(hspace=0, wspace=0.05)
-    plt.savefig(drift_vis_file, dpi=SHARED_VARS.PDF_DPI)
-    plt.close()
+    drift_vis_file = utils.save_page(drift_vis_file, dpi=SHARED_VARS.PDF_DPI)
 
     return drift_vis_file
 
@@ -701,80 +674,48 @@ def vis_glyphs(fa_file, odf_file, cc_center_voxel, vis_dir, glyph_type='ODF'):
 
     temp_dir = utils.make_dir(vis_dir, 'TMP')
 
-    # Prepare mrview command: Location to visualize
-
-    cc_center_voxel_str = ','.join([str(np.round(loc)) for loc in cc_center_voxel])
-
-    # Prepare mrview command: Planes to visualize + correspondence with file names
+    # Planes to visualize + correspondence with file names, two FOVs (mm) per plane
 
     planes = {
         0: 'sagittal',
         1: 'coronal',
         2: 'axial'
     }
+    fovs = [160, 80]
 
-    # Prepare mrview command: Glyphs, either CSD
+    # Glyphs, either CSD
     if glyph_type == 'ODF':
         print('VISUALIZING fODF map')
-        fa_file = fa_file
-        glyph_file = odf_file
-        glyph_load_str = '-odf.load_sh'
         glyph_title_str = 'Fiber ODF'
-    
-    # Generate mrview commands and plot glyphs
-        for i in planes:
-            vis_cmd = 'mrview -load {} {} {} -mode 1 -plane {} -fov 160 -voxel {} -focus 0 -size 1200,1200 -colourbar 0 -config MRViewOdfScale 4 -config MRViewShowVoxelInformation false -config MRViewShowComments false -config MRViewShowOrientationLabel false -noannotations -capture.folder {} -capture.prefix {} -capture.grab -exit -nthreads {}'.format(
-                fa_file[0], glyph_load_str, glyph_file[0], i, cc_center_voxel_str, temp_dir, planes[i], SHARED_VARS.NUM_THREADS-1
-            )
-            utils.run_cmd(vis_cmd) # will save as '<planes[i]>0000.png'
-            vis_zoom_cmd = 'mrview -load {} {} {} -mode 1 -plane {} -fov 80 -voxel {} -focus 0 -size 1200,1200 -colourbar 0 -config MRViewOdfScale 4 -config MRViewShowVoxelInformation false -config MRViewShowComments false -config MRViewShowOrientationLabel false -noannotations -capture.folder {} -capture.prefix {} -capture.grab -exit -nthreads {}'.format(
-                fa_file[0], glyph_load_str, glyph_file[0], i, cc_center_voxel_str, temp_dir, '{}_zoom'.format(planes[i]), SHARED_VARS.NUM_THREADS-1 # will save as 'planes[i]_zoom0000.png'
-            )
-            utils.run_cmd(vis_zoom_cmd)
         glyph_vis_file = os.path.join(vis_dir, 'glyphs_ODF.pdf')
+        if SHARED_VARS.VIS_RENDERER == 'mrview':
+            glyph_files = _glyphs_mrview(fa_file, odf_file, '-odf.load_sh', cc_center_voxel, planes, temp_dir)
+        else:
+            glyph_panels = _glyphs_native(fa_file, odf_file, cc_center_voxel, planes, max(fovs))
+            if glyph_panels is None:
+                print('NO fODF AROUND THE CC CENTER, SKIPPING THE GLYPH PAGE')
+                return ''
 
     plt.figure(0, figsize=SHARED_VARS.PAGESIZE)
 
-    plt.subplot(2, 3, 1)
-    plt.imshow(plt.imread(os.path.join(temp_dir, 'sagittal0000.png')))
-    plt.xticks([], [])
-    plt.yticks([], [])
-    plt.ylabel('160 mm FOV', fontsize=SHARED_VARS.LABEL_FONTSIZE)
-
-    plt.subplot(2, 3, 4)
-    plt.imshow(plt.imread(os.path.join(temp_dir, 'sagittal_zoom0000.png')))
-    plt.xticks([], [])
-    plt.yticks([], [])
-    plt.ylabel('80 mm FOV', fontsize=SHARED_VARS.LABEL_FONTSIZE)
-    plt.xlabel('Sagittal', fontsize=SHARED_VARS.LABEL_FONTSIZE)
-
-    plt.subplot(2, 3, 2)
-    plt.imshow(plt.imread(os.path.join(temp_dir, 'coronal0000.png')))
-    plt.xticks([], [])
-    plt.yticks([], [])
-
-    plt.subplot(2, 3, 5)
-    plt.imshow(plt.imread(os.path.join(temp_dir, 'coronal_zoom0000.png')))
-    plt.xticks([], [])
-    plt.yticks([], [])
-    plt.xlabel('Coronal', fontsize=SHARED_VARS.LABEL_FONTSIZE)
-
-    plt.subplot(2, 3, 3)
-    plt.imshow(plt.imread(os.path.join(temp_dir, 'axial0000.png')))
-    plt.xticks([], [])
-    plt.yticks([], [])
-
-    plt.subplot(2, 3, 6)
-    plt.imshow(plt.imread(os.path.join(temp_dir, 'axial_zoom0000.png')))
-    plt.xticks([], [])
-    plt.yticks([], [])
-    plt.xlabel('Axial', fontsize=SHARED_VARS.LABEL_FONTSIZE)
+    for i in planes:
+        for j, fov in enumerate(fovs):
+            plt.subplot(2, 3, 3*j + i + 1)
+            if SHARED_VARS.VIS_RENDERER == 'mrview':
+                plt.imshow(plt.imread(glyph_files[(i, fov)]))
+            else:
+                _plot_glyph_panel(glyph_panels[i], fov)
+            plt.xticks([], [])
+            plt.yticks([], [])
+            if i == 0:
+                plt.ylabel('{} mm FOV'.format(fov), fontsize=SHARED_VARS.LABEL_FONTSIZE)
+            if j == len(fovs) - 1:
+                plt.xlabel(planes[i].capitalize(), fontsize=SHARED_VARS.LABEL_FONTSIZE)
 
     plt.tight_layout()
 
     plt.suptitle('{}'.format(glyph_title_str), fontsize=SHARED_VARS.TITLE_FONTSIZE, fontweight='bold')
-    plt.savefig(glyph_vis_file, dpi=SHARED_VARS.PDF_DPI)
-    plt.close()
+    glyph_vis_file = utils.save_page(glyph_vis_file, dpi=SHARED_VARS.PDF_DPI)
 
     # utils.remove_dir(temp_dir)
 
@@ -785,66 +726,38 @@ def vis_slice(input_file, vis_dir, map_type):
     temp_dir = utils.make_dir(vis_dir, 'TMP')
     temp_dir = utils.make_dir(temp_dir, 'VIS')
 
-    #Prepare mrview command
     print('VISUALIZING ' + map_type +' map')
 
-    # Extract voxel dimensions/center in radiological view
-    nii = nib.load(input_file)
-    img = nii.get_fdata()
-    axis_order = utils.radiological_order(nii.affine)
-    i0 = int(round(img.shape[axis_order[0]] / 2, 1))
-    i1 = int(round(img.shape[axis_order[1]] / 2, 1))
-    i2 = int(round((img.shape[axis_order[2]] - 60) / 2, 1))
-    i2_2 = i2 + 15
-    i2_3 = i2_2 + 15
-    i2_4 = i2_3 + 15
-
+    # Intensity range: fixed for DEC, 97th percentile of the non-zero voxels for SSE
     if map_type == 'DEC':
-        temp_dir = utils.make_dir(temp_dir, 'DEC')
         vis_file = os.path.join(vis_dir, 'dec.pdf')
-        imageinfo='-intensity_range 0,0.6'
+        vis_max = 0.6
     elif map_type == 'SSE':
-        temp_dir = utils.make_dir(temp_dir, 'SSE')
         vis_file = os.path.join(vis_dir, 'sse.pdf')
-        P97 = utils.run_cmd_output('fslstats {} -P 97'.format(input_file))
-        imageinfo='-intensity_range 0,{:.2f} -colourmap 2'.format(float(P97))
-
-
-    #Generate mrview command and plot light box
-    vis_cmd = 'mrview -load {} -mode 4 -plane 2 -voxel {},{},{} {} -size 1200,1200 -noannotations -colourbar 0 -focus 0 -voxelinfo 0 -config MRViewShowVoxelInformation false -config MRViewShowComments false -capture.folder {} -capture.prefix {} -capture.grab  -exit  -nthreads {}'.format(input_file, i0, i1, i2, imageinfo, temp_dir, 'S1', SHARED_VARS.NUM_THREADS-1)
-    utils.run_cmd(vis_cmd)
-
-    vis_cmd = 'mrview -load {} -mode 4 -plane 2 -voxel {},{},{} {} -size 1200,1200 -noannotations -colourbar 0 -focus 0 -voxelinfo 0 -config MRViewShowVoxelInformation false -config MRViewShowComments false -config MRViewShowOrientationLabel false -capture.folder {} -capture.prefix {} -capture.grab -exit -nthreads {}'.format(input_file, i0, i1, i2_2, imageinfo, temp_dir, 'S2', SHARED_VARS.NUM_THREADS-1)
-    utils.run_cmd(vis_cmd)
-
-    vis_cmd = 'mrview -load {} -mode 4 -plane 2 -voxel {},{},{} {} -size 1200,1200 -noannotations -colourbar 0 -focus 0 -voxelinfo 0 -config MRViewShowVoxelInformation false -config MRViewShowComments false -config MRViewShowOrientationLabel false -capture.folder {} -capture.prefix {} -capture.grab -exit -voxelinfo 0 -nthreads {}'.format(input_file, i0, i1, i2_3, imageinfo, temp_dir, 'S3', SHARED_VARS.NUM_THREADS-1)
-    utils.run_cmd(vis_cmd)
+        if SHARED_VARS.VIS_RENDERER == 'mrview':
+            vis_max = float(utils.run_cmd_output('fslstats {} -P 97'.format(input_file)))
+        else:
+            img, _, _ = utils.load_nii(input_file)
+            vis_max = float(np.percentile(img[img != 0], 97))
 
-    vis_cmd = 'mrview -load {} -mode 4 -plane 2 -voxel {},{},{} {} -size 1200,1200 -noannotations -colourbar 0 -focus 0 -voxelinfo 0 -config MRViewShowVoxelInformation false -config MRViewShowComments false -config MRViewShowOrientationLabel false -capture.folder {} -capture.prefix {} -capture.grab -exit -nthreads {}'.format(input_file, i0, i1, i2_4, imageinfo, temp_dir, 'S4', SHARED_VARS.NUM_THREADS-1)
-    utils.run_cmd(vis_cmd)
+    if SHARED_VARS.VIS_RENDERER == 'mrview':
+        slice_files = _lightbox_mrview(input_file, temp_dir, map_type, vis_max)
+    else:
+        panels = _lightbox_native(input_file, map_type, vis_max)
 
-    # Merge to PDF
+    # Merge to PDF (light box panels S1, S2 left and S3, S4 right)
     plt.figure(0, figsize=SHARED_VARS.PAGESIZE)
-    
-    plt.subplot(2,2,1)
-    plt.imshow(plt.imread(os.path.join(temp_dir, 'S10000.png')))
-    plt.xticks([], [])
-    plt.yticks([], [])
 
-    plt.subplot(2,2,3)
-    plt.imshow(plt.imread(os.path.join(temp_dir, 'S20000.png')))
-    plt.xticks([], [])
-    plt.yticks([], [])
-
-    plt.subplot(2,2,2)
-    plt.imshow(plt.imread(os.path.join(temp_dir, 'S30000.png')))
-    plt.xticks([], [])
-    plt.yticks([], [])
-
-    plt.subplot(2,2,4)
-    plt.imshow(plt.imread(os.path.join(temp_dir, 'S40000.png')))
-    plt.xticks([], [])
-    plt.yticks([], [])
+    for i, subplot_index in enumerate([1, 3, 2, 4]):
+        plt.subplot(2,2,subplot_index)
+        if SHARED_VARS.VIS_RENDERER == 'mrview':
+            plt.imshow(plt.imread(slice_files[i]))
+        else:
+            mosaic, aspect, cmap, panel_max = panels[i]
+            plt.imshow(mosaic, cmap=cmap, vmin=0, vmax=panel_max, aspect=aspect, interpolation='nearest')
+            plt.gca().set_facecolor('black')
+        plt.xticks([], [])
+        plt.yticks([], [])
 
     plt.tight_layout()
 
@@ -854,10 +767,9 @@ def vis_slice(input_file, vis_dir, map_type):
     if map_type == 'DEC': 
         plt.suptitle('DEC map \n (Intesity scaling: [0 0.6])', fontsize=SHARED_VARS.TITLE_FONTSIZE, fontweight='bold')
     elif map_type == 'SSE':
-        plt.suptitle('SSE map \n (Intesity scaling: [0 {:.2f}])'.format(float(P97)), fontsize=SHARED_VARS.TITLE_FONTSIZE, fontweight='bold')
+        plt.suptitle('SSE map \n (Intesity scaling: [0 {:.2f}])'.format(vis_max), fontsize=SHARED_VARS.TITLE_FONTSIZE, fontweight='bold')
     
-    plt.savefig(vis_file, dpi=SHARED_VARS.PDF_DPI)
-    plt.close()
+    vis_file = utils.save_page(vis_file, dpi=SHARED_VARS.PDF_DPI)
 
     # utils.remove_dir(temp_dir)
 
@@ -869,12 +781,11 @@ def vis_overlap_slice(input_file, mask_file, vis_dir, percent_improbable):
     temp_dir = utils.make_dir(temp_dir, 'OVERLAP')
 
     # Extract voxel dimensions/center in radiological view
-    nii = nib.load(input_file)
-    img = nii.get_fdata()
-    axis_order = utils.radiological_order(nii.affine)
-    i0 = int(round(img.shape[axis_order[0]] / 2, 1))
-    i1 = int(round(img.shape[axis_order[1]] / 2, 1))
-    i2 = int(round((img.shape[axis_order[2]] - 60) / 2, 1))
+    img_shape, _, img_aff, _ = utils.load_nii_info(input_file)
+    axis_order = utils.radiological_order(img_aff)
+    i0 = int(round(img_shape[axis_order[0]] / 2, 1))
+    i1 = int(round(img_shape[axis_order[1]] / 2, 1))
+    i2 = int(round((img_shape[axis_order[2]] - 60) / 2, 1))
     i2_2 = i2 + 15
     i2_3 = i2_2 + 15
     i2_4 = i2_3 + 15
@@ -927,8 +838,7 @@ def vis_overlap_slice(input_file, mask_file, vis_dir, percent_improbable):
     
     plt.suptitle('Improbable Voxels ({:.2f}%)'.format(percent_improbable), fontsize=SHARED_VARS.TITLE_FONTSIZE, fontweight='bold')
     
-    plt.savefig(vis_file, dpi=SHARED_VARS.PDF_DPI)
-    plt.close()
+    vis_file = utils.save_page(vis_file, dpi=SHARED_VARS.PDF_DPI)
 
     # utils.remove_dir(temp_dir)
 
@@ -936,23 +846,38 @@ def vis_overlap_slice(input_file, mask_file, vis_dir, percent_improbable):
 
 def vis_noise_comp(raw_file, res_file, denoise_file, bvals, vis_dir, shells=[]):
 
+    # res_file = '': residual statistics are streamed from raw_file and denoise_file (see utils.Residual_stats)
+
     temp_dir = utils.make_dir(vis_dir, 'TMP')
 
     bvals_unique = np.sort(np.unique(bvals))
 
     # extract b image
     noise_vis_file = []
+    if res_file == '':
+        # residuals streamed from raw and denoised series, no 4D residual image
+        res_stats, raw_aff, denoise_aff = utils.Residual_stats(raw_file, denoise_file, bvals)
+        res_aff = raw_aff
+    else:
+        raw_img, raw_aff, _ = utils.load_nii(raw_file, ndim=4)
+        denoise_img, denoise_aff, _ = utils.load_nii(denoise_file, ndim=4)
+        res_img, res_aff, _ = utils.load_nii(res_file, ndim=4)
     for i in range(len(bvals_unique)):
-        b0_file, _, _ = utils.dwi_extract_iDIO(raw_file, bvals, temp_dir, target_bval=bvals_unique[i], first_only=True)
-        b0_denoise_file, _, _ = utils.dwi_extract_iDIO(denoise_file, bvals, temp_dir, target_bval=bvals_unique[i], first_only=True)
-        res_file_shell, _, _ = utils.dwi_extract_iDIO(res_file, bvals, temp_dir, target_bval=bvals_unique[i])
-        # average shell res image
-        mean_res_file = utils.dwi_avg(res_file_shell,temp_dir)
+        if res_file == '':
+            b0_img = res_stats[bvals_unique[i]]['in_first']
+            b0_denoise_img = res_stats[bvals_unique[i]]['sub_first']
+            mean_res_img = res_stats[bvals_unique[i]]['res_mean']
+        else:
+            b0_img, _, _ = utils.dwi_extract_img(raw_img, raw_aff, bvals, target_bval=bvals_unique[i], first_only=True)
+            b0_denoise_img, _, _ = utils.dwi_extract_img(denoise_img, denoise_aff, bvals, target_bval=bvals_unique[i], first_only=True)
+            res_shell_img, _, _ = utils.dwi_extract_img(res_img, res_aff, bvals, target_bval=bvals_unique[i])
+            # average shell res image
+            mean_res_img = utils.dwi_avg_img(res_shell_img)
 
         # select plot slice
-        b0_slices, b0_vox_dim, b0_min, b0_max = utils.slice_nii(b0_file, min_intensity=0, max_percentile=SHARED_VARS.VIS_PERCENTILE_MAX)
-        res_field_slices, res_field_vox_dim, res_field_min, res_field_max = utils.slice_nii(mean_res_file)
-        b0_denoise_slices, b0_denoise_vox_dim, b0_denoise_min, b0_denoise_max = utils.slice_nii(b0_denoise_file, min_intensity=0, max_percentile=SHARED_VARS.VIS_PERCENTILE_MAX)
+        b0_slices, b0_vox_dim, b0_min, b0_max = utils.slice_img(b0_img, raw_aff, min_intensity=0, max_percentile=SHARED_VARS.VIS_PERCENTILE_MAX)
+        res_field_slices, res_field_vox_dim, res_field_min, res_field_max = utils.slice_img(mean_res_img, res_aff)
+        b0_denoise_slices, b0_denoise_vox_dim, b0_denoise_min, b0_denoise_max = utils.slice_img(b0_denoise_img, denoise_aff, min_intensity=0, max_percentile=SHARED_VARS.VIS_PERCENTILE_MAX)
 
         fig = plt.figure(0, figsize=SHARED_VARS.PAGESIZE)
 
@@ -1010,8 +935,7 @@ def vis_noise_comp(raw_file, res_file, denoise_file, bvals, vis_dir, shells=[]):
         plt.suptitle('Denoise ( b = {} )'.format(str(int(bvals_unique[i]))), fontsize=SHARED_VARS.TITLE_FONTSIZE, fontweight='bold')
 
         noise_vis_file.append(os.path.join(vis_dir, 'noise_{}.pdf'.format(str(int(bvals_unique[i])))))
-        plt.savefig(noise_vis_file[i], dpi=SHARED_VARS.PDF_DPI)
-        plt.close()
+        noise_vis_file[i] = utils.save_page(noise_vis_file[i], dpi=SHARED_VARS.PDF_DPI)
 
     # utils.remove_dir(temp_dir)
 
@@ -1021,12 +945,14 @@ def vis_bias(raw_file, biasField, unbiased_file, bvals, vis_dir):
 
     temp_dir = utils.make_dir(vis_dir, 'TMP')
 
-    b0_file, _, _ = utils.dwi_extract_iDIO(raw_file, bvals, temp_dir, target_bval=0, first_only=True)
-    b0_unbiased_file, _, _ = utils.dwi_extract_iDIO(unbiased_file, bvals, temp_dir, target_bval=0, first_only=True)
+    raw_img, raw_aff, _ = utils.load_nii(raw_file, ndim=4)
+    unbiased_img, unbiased_aff, _ = utils.load_nii(unbiased_file, ndim=4)
+    b0_img, _, _ = utils.dwi_extract_img(raw_img, raw_aff, bvals, target_bval=0, first_only=True)
+    b0_unbiased_img, _, _ = utils.dwi_extract_img(unbiased_img, unbiased_aff, bvals, target_bval=0, first_only=True)
 
-    b0_slices, b0_vox_dim, b0_min, b0_max = utils.slice_nii(b0_file, min_intensity=0, max_percentile=SHARED_VARS.VIS_PERCENTILE_MAX)
+    b0_slices, b0_vox_dim, b0_min, b0_max = utils.slice_img(b0_img, raw_aff, min_intensity=0, max_percentile=SHARED_VARS.VIS_PERCENTILE_MAX)
     bias_field_slices, bias_field_vox_dim, bias_field_min, bias_field_max = utils.slice_nii(biasField)
-    b0_unbiased_slices, b0_unbiased_vox_dim, b0_unbiased_min, b0_unbiased_max = utils.slice_nii(b0_unbiased_file, min_intensity=0, max_percentile=SHARED_VARS.VIS_PERCENTILE_MAX)
+    b0_unbiased_slices, b0_unbiased_vox_dim, b0_unbiased_min, b0_unbiased_max = utils.slice_img(b0_unbiased_img, unbiased_aff, min_intensity=0, max_percentile=SHARED_VARS.VIS_PERCENTILE_MAX)
 
     fig = plt.figure(0, figsize=SHARED_VARS.PAGESIZE)
 
@@ -1080,8 +1006,7 @@ def vis_bias(raw_file, biasField, unbiased_file, bvals, vis_dir):
     plt.suptitle('N4 Bias Field Correction', fontsize=SHARED_VARS.TITLE_FONTSIZE, fontweight='bold')
 
     bias_vis_file = os.path.join(vis_dir, 'bias.pdf')
-    plt.savefig(bias_vis_file, dpi=SHARED_VARS.PDF_DPI)
-    plt.close()
+    bias_vis_file = utils.save_page(bias_vis_file, dpi=SHARED_VARS.PDF_DPI)
 
     # utils.remove_dir(temp_dir)
 
@@ -1226,8 +1151,7 @@ def vis_title(iDIO_Output, outlier_warning, o_n_percentage, bvol, vis_dir):
     # t.set_fontfamily('monospace')
     t.set_fontsize(9)
     plt.axis('off')
-    plt.savefig(title_vis_file)
-    plt.close()
+    title_vis_file = utils.save_page(title_vis_file)
 
     # # Output Reference page
     if len(Reference_str) > 22:
@@ -1247,8 +1171,7 @@ def vis_title(iDIO_Output, outlier_warning, o_n_percentage, bvol, vis_dir):
         # t.set_fontfamily('monospace')
         t.set_fontsize(9)
         plt.axis('off')
-        plt.savefig(Ref_vis_files[0])
-        plt.close()
+        Ref_vis_files[0] = utils.save_page(Ref_vis_files[0])
         # p2 
         mergeRef_str = r'$\bf{Reference:}$' + '\n{}\n'.format('\n'.join(Reference_str[22:len(Reference_str)]))
         Ref_vis_files.append(os.path.join(vis_dir, 'Reference_2.pdf'))
@@ -1264,8 +1187,7 @@ def vis_title(iDIO_Output, outlier_warning, o_n_percentage, bvol, vis_dir):
         # t.set_fontfamily('monospace')
         t.set_fontsize(9)
         plt.axis('off')
-        plt.savefig(Ref_vis_files[1])
-        plt.close()
+        Ref_vis_files[1] = utils.save_page(Ref_vis_files[1])
     else:
         mergeRef_str = r'$\bf{Reference:}$' + '\n{}\n'.format('\n'.join((Reference_str)))
         Ref_vis_files = [os.path.join(vis_dir, 'Reference.pdf')]
@@ -1281,46 +1203,209 @@ def vis_title(iDIO_Output, outlier_warning, o_n_percentage, bvol, vis_dir):
         # t.set_fontfamily('monospace')
         t.set_fontsize(9)
         plt.axis('off')
-        plt.savefig(Ref_vis_files[0])
-        plt.close()
+        Ref_vis_files[0] = utils.save_page(Ref_vis_files[0])
 
     return title_vis_file, Ref_vis_files
 
 # Private function
-def _get_eddy_num_std_map(path):
-    
-    rows = []
-    with open(path,'r') as f:
-        txt = f.readlines()
-        for i in np.arange(1,len(txt)):
-            rows.append(_str2float(txt[i].strip('\n ').split(' ')))
-    outlier_array = np.array(rows)
-    return outlier_array
-
-def _str2float(string):
-
-    row = []
-    for i in range(len(string)):
-        row.append(float(string[i]))
-    return row
-
-def _get_outlier_map(path):
-
-    rows = []
-    with open(path,'r') as f:
-        txt = f.readlines()
-        for i in np.arange(1,len(txt)):
-            rows.append(_str2list(txt[i].strip('\n')))
-    outlier_array = np.array(rows)
-    return outlier_array
-
-def _str2list(string):
-
-    row = []
-    for i in range(len(string)):
-        if (not np.mod(i,2)):
-            row.append(int(string[i]))
-    return row
+def _glyphs_mrview(fa_file, glyph_file, glyph_load_str, cc_center_voxel, planes, temp_dir):
+
+    # Capture the glyph panels of vis_glyphs with mrview (160 and 80 mm FOV per plane)
+    # Outputs:
+    # - dictionary of (plane, fov) -> captured png file
+    ##
+
+    cc_center_voxel_str = ','.join([str(np.round(loc)) for loc in cc_center_voxel])
+
+    glyph_files = {}
+    for i in planes:
+        for fov, prefix in [(160, planes[i]), (80, '{}_zoom'.format(planes[i]))]:
+            vis_cmd = 'mrview -load {} {} {} -mode 1 -plane {} -fov {} -voxel {} -focus 0 -size 1200,1200 -colourbar 0 -config MRViewOdfScale 4 -config MRViewShowVoxelInformation false -config MRViewShowComments false -config MRViewShowOrientationLabel false -noannotations -capture.folder {} -capture.prefix {} -capture.grab -exit -nthreads {}'.format(
+                fa_file[0], glyph_load_str, glyph_file[0], i, fov, cc_center_voxel_str, temp_dir, prefix, SHARED_VARS.NUM_THREADS-1
+            )
+            utils.run_cmd(vis_cmd) # will save as '<prefix>0000.png'
+            glyph_files[(i, fov)] = os.path.join(temp_dir, '{}0000.png'.format(prefix))
+    return glyph_files
+
+def _glyphs_native(fa_file, odf_file, cc_center_voxel, planes, fov, num_dirs=1024, num_bins=36):
+
+    # Prepare the glyph panels of vis_glyphs in memory: per plane, the background slice through cc_center_voxel
+    # (radiological view, as plot_slice) and the outlines of the fODF glyphs within fov (mm) around it.
+    # Only the slab of SH coefficients under each panel is read; amplitudes of all its voxels are evaluated at once
+    # on a fixed sphere (num_dirs directions) and each glyph is drawn as its projection onto the plane (num_bins angles)
+    # Outputs:
+    # - dictionary of plane -> panel dictionary (slice, intensity range, center, pixel size, glyph polygons and colors),
+    #   None if the center is outside the image or there are no fODF voxels (positive l=0 term) within fov around it
+    ##
+
+    bg_img, bg_aff, _ = utils.load_nii(fa_file[0], ndim=3)
+    if odf_file[0].endswith('.mif'):
+        odf_img, odf_aff = utils.load_mif(odf_file[0])
+    else:
+        odf_nii = nib.load(odf_file[0])
+        odf_img, odf_aff = odf_nii.dataobj, odf_nii.affine
+    odf_inv_aff = np.linalg.inv(odf_aff)
+    bg_max = np.nanpercentile(bg_img, SHARED_VARS.VIS_PERCENTILE_MAX)
+
+    # background voxel indices in radiological view, to find the displayed voxel of every pixel
+    vox_dim = nib.affines.voxel_sizes(bg_aff)
+    rad_idx, _ = utils._radiological_view(np.moveaxis(np.indices(bg_img.shape, dtype=np.int32), 0, -1), bg_aff, vox_dim)
+    cc_vox = np.array([int(np.round(loc)) for loc in cc_center_voxel])
+    cc_rad = np.argwhere(np.all(rad_idx == cc_vox, axis=-1))
+    if len(cc_rad) == 0:
+        return None
+    cc_rad = cc_rad[0]
+
+    dirs = utils.sphere_dirs(num_dirs)
+    panels = {}
+    for i in planes:
+        disp_idx = np.rot90(np.take(rad_idx, cc_rad[i], axis=i))
+        center = np.argwhere(np.all(disp_idx == cc_vox, axis=-1))[0]
+        e_col = bg_aff[:3, :3] @ (disp_idx[0, 1] - disp_idx[0, 0]) # scanner direction of the image columns / rows
+        e_row = bg_aff[:3, :3] @ (disp_idx[1, 0] - disp_idx[0, 0])
+        pix_dim = np.array([np.linalg.norm(e_row), np.linalg.norm(e_col)])
+        half = np.ceil(fov / 2 / pix_dim).astype(int)
+        r0, c0 = np.maximum(center - half, 0)
+        r1, c1 = np.minimum(center + half + 1, disp_idx.shape[:2])
+
+        # SH coefficients of the pixels within fov, read as one slab
+        rows, cols = np.mgrid[r0:r1, c0:c1]
+        bg_vox = disp_idx[r0:r1, c0:c1].reshape(-1, 3)
+        odf_vox = np.rint(nib.affines.apply_affine(odf_inv_aff @ bg_aff, bg_vox)).astype(int)
+        inside = np.all((odf_vox >= 0) & (odf_vox < np.array(odf_img.shape[:3])), axis=1)
+        rows, cols, odf_vox = rows.ravel()[inside], cols.ravel()[inside], odf_vox[inside]
+        if len(odf_vox) == 0: # panel outside the fODF image: background only
+            coefs = np.zeros((0, odf_img.shape[3]), dtype=np.float32)
+        else:
+            slab_min = odf_vox.min(axis=0)
+            slab_max = odf_vox.max(axis=0) + 1
+            slab = np.asarray(odf_img[slab_min[0]:slab_max[0], slab_min[1]:slab_max[1], slab_min[2]:slab_max[2], :], dtype=np.float32)
+            coefs = slab[tuple((odf_vox - slab_min).T)]
+        keep = coefs[:, 0] > 0
+        rows, cols, coefs = rows[keep], cols[keep], coefs[keep]
+
+        # glyph amplitudes, negative lobes hidden
+        amps = np.maximum(coefs @ utils.sh_basis(dirs, utils.sh_lmax(coefs.shape[1])).T.astype(np.float32), 0)
+
+        # outline of the projected glyph: farthest projected point per angle bin (bins depend on the plane only)
+        proj = dirs @ np.column_stack((e_col/pix_dim[1], e_row/pix_dim[0]))
+        proj_bins = ((np.arctan2(proj[:, 1], proj[:, 0]) + np.pi) / (2*np.pi) * num_bins).astype(int) % num_bins
+        order = np.argsort(proj_bins, kind='stable')
+        starts = np.searchsorted(proj_bins[order], np.arange(num_bins))
+        radii = np.maximum.reduceat(amps[:, order] * np.linalg.norm(proj, axis=1)[order], starts, axis=1)
+        angles = (np.arange(num_bins) + 0.5) / num_bins * 2*np.pi - np.pi
+
+        panels[i] = {
+            'slice': bg_img[tuple(disp_idx.reshape(-1, 3).T)].reshape(disp_idx.shape[:2]),
+            'max': bg_max,
+            'center': center,
+            'pix_dim': pix_dim,
+            'rows': rows,
+            'cols': cols,
+            'radii': radii,
+            'angles': angles,
+            'amp_max': amps.max(axis=1),
+            'colors': np.abs(dirs[np.argmax(amps, axis=1)]) # direction encoded color of the largest lobe
+        }
+
+    # common glyph scale for all planes: largest lobes (99th percentile) reach half a voxel
+    amp_max = np.concatenate([panels[i]['amp_max'] for i in panels])
+    if len(amp_max) == 0 or not np.percentile(amp_max, 99) > 0:
+        return None
+    amp_ref = np.percentile(amp_max, 99)
+    scale = 0.5 * np.min(vox_dim) / amp_ref # mm per amplitude unit
+    for i in panels:
+        panel = panels[i]
+        radii = scale * panel['radii']
+        panel['verts'] = np.stack((panel['cols'][:, None] + radii * np.cos(panel['angles']) / panel['pix_dim'][1],
+                                   panel['rows'][:, None] + radii * np.sin(panel['angles']) / panel['pix_dim'][0]), axis=-1)
+    return panels
+
+def _plot_glyph_panel(panel, fov):
+
+    # Plot one native glyph panel (background slice + glyph outlines) cropped to fov (mm) around the center
+    half = fov / 2 / panel['pix_dim']
+    row, col = panel['center']
+    in_fov = (np.abs(panel['rows'] - row) <= half[0]) & (np.abs(panel['cols'] - col) <= half[1])
+
+    plt.imshow(panel['slice'], cmap='gray', vmin=0, vmax=panel['max'], aspect=panel['pix_dim'][0]/panel['pix_dim'][1], interpolation='nearest')
+    plt.gca().add_collection(PolyCollection(panel['verts'][in_fov], facecolors=panel['colors'][in_fov], linewidths=0, rasterized=True))
+    plt.xlim(col - half[1], col + half[1])
+    plt.ylim(row + half[0], row - half[0])
+    plt.gca().set_facecolor('black')
+
+def _lightbox_slices(img_shape, img_aff):
+
+    # First axial slice (in radiological view) of the four light box panels: 60 slices around the center, 15 per panel
+    axis_order = utils.radiological_order(img_aff)
+    i2 = int(round((img_shape[axis_order[2]] - 60) / 2, 1))
+    return [i2, i2 + 15, i2 + 30, i2 + 45]
+
+def _lightbox_native(input_file, map_type, vis_max, rows=3, cols=5):
+
+    # Render the four light box panels of vis_slice in memory (image loaded once)
+    # Outputs:
+    # - list of (mosaic, aspect ratio, colormap, max intensity) per panel; slices are tiled in rows x cols
+    #   from left to right and top to bottom, slices outside the image are left blank (NaN)
+    ##
+
+    img, img_aff, _ = utils.load_nii(input_file)
+    first_slices = _lightbox_slices(img.shape[:3], img_aff) # image voxel indices, as given to mrview
+    _, flips = utils._radiological_transform(img_aff)
+    img, vox_dim = utils._radiological_view(img, img_aff, nib.affines.voxel_sizes(img_aff)[:3])
+
+    if map_type == 'DEC':
+        img = np.clip(np.abs(img) / vis_max, 0, 1) # RGB scaled to the intensity range 0,0.6
+        cmap = None
+        vis_max = 1
+    else:
+        img = np.where(img != 0, img, np.nan) # zero (unfitted) voxels as background, like the intensity range
+        cmap = plt.get_cmap('cool').with_extremes(bad='black') # mrview colourmap 2
+
+    nx, ny = img.shape[0], img.shape[1]
+    panels = []
+    for first_slice in first_slices:
+        mosaic = np.full((rows*ny, cols*nx) + img.shape[3:], np.nan)
+        for k in range(rows*cols):
+            i2 = first_slice + k
+            if i2 < 0 or i2 >= img.shape[2]:
+                continue
+            if flips[2]: # same image slice in radiological view
+                i2 = img.shape[2] - 1 - i2
+            r, c = divmod(k, cols)
+            mosaic[r*ny:(r+1)*ny, c*nx:(c+1)*nx] = np.rot90(img[:, :, i2])
+        if map_type == 'DEC':
+            mosaic = np.nan_to_num(mosaic)
+        panels.append((mosaic, vox_dim[1]/vox_dim[0], cmap, vis_max))
+    return panels
+
+def _lightbox_mrview(input_file, temp_dir, map_type, vis_max):
+
+    # Capture the four light box panels of vis_slice with mrview
+    # Outputs:
+    # - list of captured png files
+    ##
+
+    # Extract voxel dimensions/center in radiological view
+    img_shape, _, img_aff, _ = utils.load_nii_info(input_file)
+    axis_order = utils.radiological_order(img_aff)
+    i0 = int(round(img_shape[axis_order[0]] / 2, 1))
+    i1 = int(round(img_shape[axis_order[1]] / 2, 1))
+
+    if map_type == 'DEC':
+        temp_dir = utils.make_dir(temp_dir, 'DEC')
+        imageinfo='-intensity_range 0,0.6'
+    elif map_type == 'SSE':
+        temp_dir = utils.make_dir(temp_dir, 'SSE')
+        imageinfo='-intensity_range 0,{:.2f} -colourmap 2'.format(vis_max)
+
+    #Generate mrview command and plot light box
+    slice_files = []
+    for i, i2 in enumerate(_lightbox_slices(img_shape, img_aff)):
+        vis_cmd = 'mrview -load {} -mode 4 -plane 2 -voxel {},{},{} {} -size 1200,1200 -noannotations -colourbar 0 -focus 0 -voxelinfo 0 -config MRViewShowVoxelInformation false -config MRViewShowComments false -config MRViewShowOrientationLabel false -capture.folder {} -capture.prefix {} -capture.grab -exit -nthreads {}'.format(input_file, i0, i1, i2, imageinfo, temp_dir, 'S{}'.format(i+1), SHARED_VARS.NUM_THREADS-1)
+        utils.run_cmd(vis_cmd)
+        slice_files.append(os.path.join(temp_dir, 'S{}0000.png'.format(i+1)))
+    return slice_files
 
 class WrapText(mtext.Text):
     """
@@ -24,20 +24,118 @@ def parseArguments():
     # Template directory which include JHU-ICBM-FA-1mm.nii.gz and JHU-ICBM-labels-1mm.nii.gz
     parser.add_argument('-a', '--template_dir', help='Path of the Template directory (include /MNI/QC/JHU-ICBM-FA-1mm.nii.gz and /MNI/QC/JHU-ICBM-labels-1mm.nii.gz)')
     parser.add_argument('-t','--Bzerothr', help = 'B0 threshold (shell Epsilon was fixed with 80)', default=10)
+    parser.add_argument('--keep_res', help='Write the 4D denoising residual (2_BiasCo/Res.nii.gz) instead of streaming the residual statistics', action='store_true')
+    parser.add_argument('-j', '--jobs', help='Number of processes generating the QC pages in parallel (default = 1)', type=int, default=1)
+    parser.add_argument('--report', help='QC report format: multi-page pdf (8_QC/QC.pdf) or static html index with png pages (8_QC/QC.html) (default = pdf)', choices=['pdf', 'html'], default='pdf')
+    parser.add_argument('--dpi', help='Resolution of the report pages (default = 300 for pdf, 100 for html)', type=int, default=None)
     # parser.add_argument('project_name', help='Project Name')
 
     args = parser.parse_args()
     # Parse arguments
     return args
 
+# Report order of the QC page tasks (after the title and reference pages): task -> item of its output holding the page(s)
+QC_PAGES = [('pedir', None), ('noise', None), ('degibbs', None), ('drift', None), ('stats', 0), ('bias', None), ('preproc', None),
+            ('gradcheck', None), ('dwi', 0), ('glyph', None), ('dec', None), ('sse', None), ('improbable_voxel', None)]
+
+# QC pages with their own preparation steps (run as tasks of iDIO_QC)
+def cc_center(subj_dir, template_dir, tmp_dir, fa_file, dwi_preproc_file):
+
+    # localize CC for the glyph page (using registration info when S7 is done)
+    # Outputs:
+    # - cc center voxel (None if neither FA nor CSD results are available, NaN if the CC labels are empty), tracking flag for iDIO_Output
+    ##
+
+    if os.path.exists(subj_dir + '/7_NetworkProc/Reg_matrix/T12MNI_1InverseWarp.nii.gz'):
+        warp_cmd = 'WarpImageMultiTransform 3 {} {} -R {} -i {} {} --use-NN'.format(template_dir + '/JHU-ICBM152-labels-1mm.nii.gz', tmp_dir + '/TractAtlas_inT1.nii.gz',subj_dir + '/Preprocessed_data/T1w_preprocessed.nii.gz', subj_dir + '/7_NetworkProc/Reg_matrix/T12MNI_0GenericAffine.mat', subj_dir + '/7_NetworkProc/Reg_matrix/T12MNI_1InverseWarp.nii.gz' )
+        utils.run_cmd(warp_cmd)
+        warp_cmd = 'mrtransform {} {} -linear {} -template {} -interp nearest -force'.format(tmp_dir + '/TractAtlas_inT1.nii.gz', tmp_dir + '/TractAtlas_inDWI.nii.gz', subj_dir + '/4_T1preproc/Reg_matrix/str2epi.txt', dwi_preproc_file)
+        utils.run_cmd(warp_cmd)
+        atlas2subj_img, _, _ = utils.load_nii(tmp_dir + '/TractAtlas_inDWI.nii.gz', ndim=3)
+        # cc_genu_val = 3;cc_splenium_val = 5 # taken from label.txt
+        cc_index = np.logical_or(atlas2subj_img == 3, atlas2subj_img == 5)
+        cc_locs = np.column_stack(np.where(cc_index))
+        cc_center_voxel = (np.nanmean(cc_locs[:, 0]), np.nanmean(cc_locs[:, 1]), np.nanmean(cc_locs[:, 2]))
+        return cc_center_voxel, True
+    elif len(fa_file) != 0:
+        atlas2subj_file, cc_center_voxel = stats.scalar_info(fa_file[0], tmp_dir, template_dir)
+        return cc_center_voxel, False
+    elif os.path.exists(subj_dir + '/6_CSDpreproc/S1_Response/odf_wm_norm.mif'):
+        # Generate DEC data and mean DEC
+        dec_file = subj_dir + '/6_CSDpreproc/S1_Response/DEC.nii.gz'
+        dec_cmd = 'fod2dec {} {}'.format(subj_dir + '/6_CSDpreproc/S1_Response/odf_wm_norm.mif -force', dec_file)
+        utils.run_cmd(dec_cmd)
+        mean_DEC_file = subj_dir + '/6_CSDpreproc/S1_Response/mean_DEC.nii.gz'
+        dec_cmd = 'mrmath {} mean {} -axis 3 -force'.format(subj_dir + '/6_CSDpreproc/S1_Response/DEC.nii.gz', mean_DEC_file)
+        utils.run_cmd(dec_cmd)
+        atlas2subj_file, cc_center_voxel = stats.scalar_info(mean_DEC_file, tmp_dir, template_dir)
+        return cc_center_voxel, False
+    return None, []
+
+def vis_glyph_page(subj_dir, fa_file, odf_file, cc_center_voxel, out_dir):
+
+    # P.11 CSD_vis_file (skipped when the CC was not found: no center, or NaN center of an empty CC label)
+    if cc_center_voxel is None or not np.all(np.isfinite(cc_center_voxel)):
+        print('CC NOT FOUND, SKIPPING THE GLYPH PAGE')
+        return ''
+    if os.path.exists(subj_dir + '/6_CSDpreproc') and os.path.exists(subj_dir + '/5_DTIFIT'):
+        return iDIOvis.vis_glyphs(fa_file, odf_file, cc_center_voxel, out_dir)
+    elif os.path.exists(subj_dir + '/6_CSDpreproc/S1_Response/mean_DEC.nii.gz'):
+        return iDIOvis.vis_glyphs([subj_dir + '/6_CSDpreproc/S1_Response/mean_DEC.nii.gz'], odf_file, cc_center_voxel, out_dir)
+    return ''
+
+def vis_dec_page(subj_dir, fa_file, v1_file, out_dir):
+
+    # P.12 DEC_vis_file
+    basename = os.path.basename(subj_dir)
+    if len(glob.glob(subj_dir + '/5_DTIFIT/*_DEC.nii.gz')) != 0:
+        dec_file = glob.glob(subj_dir + '/5_DTIFIT/*_DEC.nii.gz')[0]
+        return iDIOvis.vis_slice(dec_file, out_dir, 'DEC')
+    elif len(fa_file) != 0:
+        # Generate DEC data    
+        dec_file = subj_dir + '/5_DTIFIT/' + basename +'_DEC.nii.gz'
+        dec_cmd = 'fslmaths {} -mul {} {}'.format(fa_file[0], v1_file[0], dec_file)
+        utils.run_cmd(dec_cmd)
+        return iDIOvis.vis_slice(dec_file, out_dir, 'DEC')
+    return ''
+
+def vis_sse_page(subj_dir, fa_file, mask_file, tmp_dir, out_dir):
+
+    # P.13 SSE_vis_file
+    basename = os.path.basename(subj_dir)
+    if len(glob.glob(subj_dir + '/5_DTIFIT/*_sse.nii.gz')) != 0:
+        sse_file = glob.glob(subj_dir + '/5_DTIFIT/*_sse.nii.gz')[0]
+        return iDIOvis.vis_slice(sse_file, out_dir, 'SSE')
+    elif os.path.exists(fa_file[0]):
+        # Generate SSE data in TMP dir
+        sse_file = subj_dir + '/5_DTIFIT/' + basename +'_sse.nii.gz'
+        sse_cmd = 'dtifit -k {} -o {} -m {} -r {} -b {} --sse'.format(subj_dir + '/5_DTIFIT/' + basename + '-preproc-lowb-data.nii.gz', tmp_dir + '/' + basename, mask_file, subj_dir + '/5_DTIFIT/' + basename + '-preproc-lowb-data.bvec', subj_dir + '/5_DTIFIT/' + basename + '-preproc-lowb-data.bval')
+        move_cmd = 'mv {} {}'.format(tmp_dir + '/' + basename +'_sse.nii.gz', subj_dir + '/5_DTIFIT/')
+        utils.run_cmd(sse_cmd)
+        utils.run_cmd(move_cmd)
+        return iDIOvis.vis_slice(sse_file, out_dir, 'SSE')
+    return ''
+
+def vis_improbable_voxel_page(subj_dir, fa_file, improbable_voxels_file, percent_improbable, out_dir):
+
+    # P.14 Improbable_voxel_file
+    if len(fa_file) != 0:
+        return iDIOvis.vis_overlap_slice(fa_file[0], improbable_voxels_file, out_dir, percent_improbable)
+    elif os.path.exists(subj_dir + '/6_CSDpreproc/S1_Response/mean_DEC.nii.gz'):
+        mean_DEC_file = subj_dir + '/6_CSDpreproc/S1_Response/mean_DEC.nii.gz'
+        return iDIOvis.vis_overlap_slice(mean_DEC_file, improbable_voxels_file, out_dir, percent_improbable)
+    return ''
+
 # run pipeline
-def iDIO_QC(subj_dir, template_dir, Bzerothr):
+def iDIO_QC(subj_dir, template_dir, Bzerothr, keep_res=False, num_procs=1, report='pdf', dpi=None):
 
     print('*************************************************')
     print('***      iDIO QC: QC STATISTICAL ANALYSES     ***')
     print('*************************************************')
     # print('Processing Dir: {}'.format(subj_dir))
     ti = time.time()
+    if report == 'pdf' and dpi is not None:
+        SHARED_VARS.PDF_DPI = dpi
     # initialize iDIO output dictionary
     iDIO_Output ={
         'Denoise':[],
@@ -63,7 +161,7 @@ def iDIO_QC(subj_dir, template_dir, Bzerothr):
         bvals_preproc_file = subj_dir + '/Preprocessed_data/dwi_preprocessed_resized.bval'
         bvecs_preproc_file = subj_dir + '/Preprocessed_data/dwi_preprocessed_resized.bvec'
         iDIO_Output['Resize'] = True
-        _, a, _ = utils.load_nii(dwi_preproc_file)
+        _, _, a, _ = utils.load_nii_info(dwi_preproc_file)
         iDIO_Output['ResizeVoxelSize'] = int(abs(a[0][0]))
     else:
         dwi_preproc_file = subj_dir + '/Preprocessed_data/dwi_preprocessed.nii.gz'
@@ -71,7 +169,7 @@ def iDIO_QC(subj_dir, template_dir, Bzerothr):
         bvecs_preproc_file = subj_dir + '/Preprocessed_data/dwi_preprocessed.bvec'
         iDIO_Output['Resize'] = False;
     
-    _, a, _ = utils.load_nii(dwi_preproc_file)
+    _, _, a, _ = utils.load_nii_info(dwi_preproc_file)
     if (int(abs(a[0][0]))==int(abs(a[1][1]))) & (int(abs(a[0][0]))==int(abs(a[2][2]))):
         pass
     else:
@@ -115,44 +213,59 @@ def iDIO_QC(subj_dir, template_dir, Bzerothr):
     # load raw data (for visualization comparison)
     dwi_files, bvals_files, bvecs_files, pe_dirs, pe_axis, raw_merge_dwi_file = utils.load_config(subj_dir)
 
-    # Create BPV mask by T1 FAST result
-    BPV_mask_file = stats.BPV_mask(mask_file, subj_dir, tmp_dir)
-
-    # load eddy results
-    motion_dict, motion_stats_out_list = stats.motion(eddy_dir, tmp_dir)
-    EC_dict, EC_stats_out_list = stats.eddy_current(eddy_dir, tmp_dir)
+    # load eddy results (text outputs parsed once, cached next to them)
+    eddy = utils.EddyResults(eddy_dir)
+    motion_dict, motion_stats_out_list = stats.motion(eddy, tmp_dir)
+    EC_dict, EC_stats_out_list = stats.eddy_current(eddy, tmp_dir)
     # Due to the resize, mask is not in the same space as eddy output
     # Regrid if needed
-    a, _, _ = utils.load_nii(eddy_mask_file)
-    b, _, _ = utils.load_nii(mask_file)
-    if a.shape == b.shape:
+    a_shape, _, _, _ = utils.load_nii_info(eddy_mask_file)
+    b_shape, _, _, _ = utils.load_nii_info(mask_file)
+    if a_shape == b_shape:
         cnr_mask = mask_file
     else:
-        regrid_cmd = 'mrgrid {} regrid {} -size {},{},{}'.format(mask_file, tmp_dir + '/cnr_mask.nii.gz', a.shape[0], a.shape[1], a.shape[2])
+        regrid_cmd = 'mrgrid {} regrid {} -size {},{},{}'.format(mask_file, tmp_dir + '/cnr_mask.nii.gz', a_shape[0], a_shape[1], a_shape[2])
         utils.run_cmd(regrid_cmd)
         cnr_mask = tmp_dir + '/cnr_mask.nii.gz'
 
-    # # CNR form eddy    
+    if glob.glob(subj_dir + '/3_EddyCo/*zeropad-EddyCo.nii.gz'):
+        m_cmd = 'mrgrid {} pad -all_axes -axis 2 0,-1 {}'.format(cnr_mask, tmp_dir + '/cnr_mask_2.nii.gz')
+        utils.run_cmd(m_cmd)
+        cnr_u_mask = tmp_dir + '/cnr_mask_2.nii.gz'
+    else:
+        cnr_u_mask = cnr_mask
+
     bvals_preproc_shelled, shell_b, shell_ind = utils.shell_bvals(dwi_preproc_file, bvecs_preproc_file, bvals_preproc_file, Bzerothr)
-    cnr_dict, bvals_cnr_shelled, cnr_stats_out_list, cnr_warning = stats.cnr(bvals_preproc_file, cnr_mask, eddy_dir, tmp_dir, shells=shell_b)
-    iDIO_Output['CNRwarning'] = cnr_warning
+    bvals = np.sort(np.unique(bvals_preproc_shelled))
 
     #########################
     # Generate component PDFs
+    # Each task declares its inputs (utils.TaskOutput of other tasks), ready tasks run in a pool of num_procs processes
+
+    tasks = {}
+
+    # Create BPV mask by T1 FAST result
+    tasks['BPV_mask'] = utils.task(stats.BPV_mask, mask_file, subj_dir, tmp_dir)
+
+    # # CNR form eddy
+    tasks['cnr'] = utils.task(stats.cnr, bvals_preproc_file, cnr_mask, eddy, tmp_dir, shells=shell_b)
 
     # P.2 pedir.pdf : show the phase encoding images (suppose two (phase) in same axis only image)
-    pedir_vis_file = iDIOvis.vis_pedir(dwi_files, bvecs_files, bvals_files, pe_axis, pe_dirs, out_dir, Bzerothr)
+    tasks['pedir'] = utils.task(iDIOvis.vis_pedir, dwi_files, bvecs_files, bvals_files, pe_axis, pe_dirs, out_dir, Bzerothr)
 
     # P.3 Denoise : show the noise residual map (seperate with b shell)
     if len(glob.glob(subj_dir + '/2_BiasCo/*-denoise.nii.gz')) !=0:
         denoise_file = glob.glob(subj_dir + '/2_BiasCo/*-denoise.nii.gz')[0]
-        Residual_file = subj_dir + '/2_BiasCo/Res.nii.gz'
-        res_file = utils.Residual(raw_merge_dwi_file, denoise_file, Residual_file)
-        res_vis_file = iDIOvis.vis_noise_comp(raw_merge_dwi_file, res_file, denoise_file, bvals_preproc_shelled, out_dir)
+        if keep_res:
+            Residual_file = subj_dir + '/2_BiasCo/Res.nii.gz'
+            tasks['residual'] = utils.task(utils.Residual, raw_merge_dwi_file, denoise_file, Residual_file)
+            res_file = utils.TaskOutput('residual')
+        else:
+            res_file = ''
+        tasks['noise'] = utils.task(iDIOvis.vis_noise_comp, raw_merge_dwi_file, res_file, denoise_file, bvals_preproc_shelled, out_dir)
         iDIO_Output['Denoise'] = True
     else:
         # print('No denoise image were found')
-        res_vis_file = ''
         iDIO_Output['Denoise'] = False
 
     # P.4 degibbs.pdf
@@ -167,86 +280,98 @@ def iDIO_QC(subj_dir, template_dir, Bzerothr):
         dwi_merge_files = [raw_merge_dwi_file]
 
     prenorm_dir = utils.make_dir(tmp_dir, 'GAIN_CHECK')
-    dwi_prenorm_files, dwi_prenorm_gains, dwi_prenorm_bins, dwi_input_hists, dwi_prenormed_hists = utils.dwi_norm(dwi_degibbs_files, dwi_merge_bvec, dwi_merge_bval, prenorm_dir, Bzerothr)
-    degibbs_vis_file = iDIOvis.vis_degibbs(dwi_merge_files, bvals_preproc_shelled, dwi_degibbs_files, dwi_prenorm_gains, out_dir)
+    tasks['prenorm'] = utils.task(utils.dwi_norm, dwi_degibbs_files, dwi_merge_bvec, dwi_merge_bval, prenorm_dir, Bzerothr)
+    tasks['degibbs'] = utils.task(iDIOvis.vis_degibbs, dwi_merge_files, bvals_preproc_shelled, dwi_degibbs_files, utils.TaskOutput('prenorm', 1), out_dir)
 
     # P.5 DriftCo 
     if os.path.exists(subj_dir + '/2_BiasCo/Drifting_Correction_B0only.png'):
         png_path = subj_dir + '/2_BiasCo/'
-        drift_vis_file = iDIOvis.vis_drift(png_path, out_dir)
+        tasks['drift'] = utils.task(iDIOvis.vis_drift, png_path, out_dir)
         iDIO_Output['Drift'] = True
     else:
         # print('No drift correction image were found')
-        drift_vis_file = ''
         iDIO_Output['Drift'] = False
 
     # P.7 mask visualization
-    probable_mask_file, improbable_voxels_file, percent_improbable = utils.dwi_improbable_mask(mask_file, dwi_preproc_file, bvals_preproc_shelled, tmp_dir + '/MASK')
-    preproc_vis_file = iDIOvis.vis_preproc_mask(dwi_files, bvecs_files, bvals_files, dwi_preproc_file, bvals_preproc_shelled, eddy_mask_file, mask_file, percent_improbable, BPV_mask_file, pe_axis, pe_dirs, out_dir, Bzerothr)
+    tasks['improbable'] = utils.task(utils.dwi_improbable_mask, mask_file, dwi_preproc_file, bvals_preproc_shelled, tmp_dir + '/MASK')
+    tasks['preproc'] = utils.task(iDIOvis.vis_preproc_mask, dwi_files, bvecs_files, bvals_files, dwi_preproc_file, bvals_preproc_shelled, eddy_mask_file, mask_file, utils.TaskOutput('improbable', 2), utils.TaskOutput('BPV_mask'), pe_axis, pe_dirs, out_dir, Bzerothr)
 
     # P.8 Bias field correction
     if  glob.glob(subj_dir + '/3_EddyCo/*zeropad-EddyCo.nii.gz') and glob.glob(subj_dir + '/3_EddyCo/*zeropad-EddyCo-unbiased.nii.gz') and glob.glob(subj_dir + '/3_EddyCo/*BiasField.nii.gz'):
         wobias_file = glob.glob(subj_dir + '/3_EddyCo/*zeropad-EddyCo.nii.gz')[0]
         unbiased_file = glob.glob(subj_dir + '/3_EddyCo/*zeropad-EddyCo-unbiased.nii.gz')[0]
         BiasField = glob.glob(subj_dir + '/3_EddyCo/*BiasField.nii.gz')[0]
-        bias_vis_file = iDIOvis.vis_bias(wobias_file, BiasField, unbiased_file, bvals_preproc_shelled, out_dir) 
+        tasks['bias'] = utils.task(iDIOvis.vis_bias, wobias_file, BiasField, unbiased_file, bvals_preproc_shelled, out_dir)
     elif glob.glob(subj_dir + '/3_EddyCo/*-EddyCo.nii.gz') and glob.glob(subj_dir + '/3_EddyCo/*-EddyCo-unbiased.nii.gz') and glob.glob(subj_dir + '/3_EddyCo/*BiasField.nii.gz'):
         wobias_file = glob.glob(subj_dir + '/3_EddyCo/*-EddyCo.nii.gz')[0]
         unbiased_file = glob.glob(subj_dir + '/3_EddyCo/*-EddyCo-unbiased.nii.gz')[0]
         BiasField = glob.glob(subj_dir + '/3_EddyCo/*BiasField.nii.gz')[0]
-        bias_vis_file = iDIOvis.vis_bias(wobias_file, BiasField, unbiased_file, bvals_preproc_shelled, out_dir)
+        tasks['bias'] = utils.task(iDIOvis.vis_bias, wobias_file, BiasField, unbiased_file, bvals_preproc_shelled, out_dir)
     else:
         print('No BiasField image were found')
-        bias_vis_file = ''
-
 
     # P.9 gradeient check 
-    gradcheck_vis_file = iDIOvis.vis_gradcheck(bvals_checked_files, bvecs_checked_files, bvals_preproc_file, bvecs_preproc_file, out_dir)
+    tasks['gradcheck'] = utils.task(iDIOvis.vis_gradcheck, bvals_checked_files, bvecs_checked_files, bvals_preproc_file, bvecs_preproc_file, out_dir)
 
     # P.10 SNR/CNR map with Raw b0 SNR output
-    dwi_cnr_files, cnr_stats_out_list = iDIOvis.vis_dwi(dwi_preproc_file, bvals_preproc_shelled, mask_file, cnr_dict, out_dir)
+    tasks['dwi'] = utils.task(iDIOvis.vis_dwi, dwi_preproc_file, bvals_preproc_shelled, mask_file, utils.TaskOutput('cnr', 0), out_dir)
 
-    # Calculate Raw data SNR and outlier percentage
-    bvals = np.sort(np.unique(bvals_preproc_shelled))
-    stats_out_list = []
+    # Calculate Raw data SNR
+    if 0 in bvals:
+        mask_img, _, _ = utils.load_nii(cnr_u_mask, dtype='bool', ndim=3)
+        tasks['raw_snr'] = utils.task(utils.dwi_snr, raw_merge_dwi_file, bvals_preproc_shelled, mask_img=mask_img, target_bval=0)
 
-    if glob.glob(subj_dir + '/3_EddyCo/*zeropad-EddyCo.nii.gz'):
-        m_cmd = 'mrgrid {} pad -all_axes -axis 2 0,-1 {}'.format(cnr_mask, tmp_dir + '/cnr_mask_2.nii.gz')
-        utils.run_cmd(m_cmd)
-        cnr_u_mask = tmp_dir + '/cnr_mask_2.nii.gz'
-    else:
-        cnr_u_mask = cnr_mask
+    # P.6 motion results by eddy (with preprocessed image)
+    tasks['stats'] = utils.task(iDIOvis.vis_stats, dwi_preproc_file, bvals_preproc_shelled, motion_dict, EC_dict, eddy, out_dir)
+
+    # P.11 CSD_vis_file
+    # Registration for visualizaion and localize CC for visualization (using resgitration info when S7 is done)
+    tasks['cc_center'] = utils.task(cc_center, subj_dir, template_dir, tmp_dir, fa_file, dwi_preproc_file)
+    tasks['glyph'] = utils.task(vis_glyph_page, subj_dir, fa_file, odf_file, utils.TaskOutput('cc_center', 0), out_dir)
+
+    # P.12 DEC_vis_file 
+    tasks['dec'] = utils.task(vis_dec_page, subj_dir, fa_file, v1_file, out_dir)
+
+    # P.13 SSE_vis_file
+    tasks['sse'] = utils.task(vis_sse_page, subj_dir, fa_file, mask_file, tmp_dir, out_dir)
+
+    # P.14 Improbable_voxel_file (mean DEC may be generated by cc_center)
+    tasks['improbable_voxel'] = utils.task(vis_improbable_voxel_page, subj_dir, fa_file, utils.TaskOutput('improbable', 1), utils.TaskOutput('improbable', 2), out_dir, deps=['cc_center'])
+
+    # pages are added to the report as soon as their task is done, title and reference pages (keys 0 and 1) follow at the end
+    # (pages are rendered by this process, see utils.ReportWriter)
+    page_keys = {name: (i + 2, item) for i, (name, item) in enumerate(QC_PAGES) if name in tasks}
+    qc_report = utils.ReportWriter('QC', out_dir, report=report, dpi=dpi if dpi is not None else SHARED_VARS.HTML_DPI, keys=[0, 1] + [key for key, _ in page_keys.values()])
+
+    def write_pages(name, output):
+        if name in page_keys:
+            key, item = page_keys[name]
+            qc_report.add(key, output if item is None else output[item])
+
+    outputs = utils.run_tasks(tasks, num_procs, on_done=write_pages)
+
+    probable_mask_file, improbable_voxels_file, percent_improbable = outputs['improbable']
+    _, cnr_stats_out_list = outputs['dwi']
+    _, outlier_percentage, outlier_warning, o_n_percentage, bvol = outputs['stats']
+    cc_center_voxel, iDIO_Output['Tracking'] = outputs['cc_center']
+    cnr_dict, bvals_cnr_shelled, _, cnr_warning = outputs['cnr']
+    iDIO_Output['CNRwarning'] = cnr_warning
+
+    # Raw data SNR and outlier percentage
+    stats_out_list = []
 
     for i in range(len(bvals)):
         bX = bvals[i]
         if bX == 0:
-            bXs_file, num_bXs, _ = utils.dwi_extract_iDIO(raw_merge_dwi_file, bvals_preproc_shelled, tmp_dir, target_bval=bX, first_only=False)
-            std_cmd = 'fslmaths {} -Tmean {}'.format(bXs_file, tmp_dir + '/Raw_b0mean.nii.gz')
-            utils.run_cmd(std_cmd)
-            std_cmd = 'fslmaths {} -Tstd {}'.format(bXs_file, tmp_dir + '/Raw_b0std.nii.gz')
-            utils.run_cmd(std_cmd)
-            snr_cmd = 'fslmaths {} -div {} {}'.format(tmp_dir + '/Raw_b0mean.nii.gz', tmp_dir + '/Raw_b0std.nii.gz', tmp_dir + '/Raw_SNR.nii.gz')
-            utils.run_cmd(snr_cmd)
-            snr_img, _, _ = utils.load_nii(tmp_dir + '/Raw_SNR.nii.gz', ndim=3)
-            mask_img, _, _ = utils.load_nii(cnr_u_mask, dtype='bool', ndim=3)
-            snr = np.nanmedian(snr_img[mask_img])
-            # bvals_shelled_file.close()
+            _, snr, _ = outputs['raw_snr']
             stats_out_list.append('Raw_b{}_median_{},{}'.format(bX, 'snr' , snr))
 
     # save stats cvs results
     for index, cnrlish in enumerate(cnr_stats_out_list):
         stats_out_list.append(cnrlish)
 
-    # P.6 motion results by eddy (with preprocessed image)
-    stats_vis_file, outlier_percentage, outlier_warning, o_n_percentage, bvol = iDIOvis.vis_stats(dwi_preproc_file, bvals_preproc_shelled, motion_dict, EC_dict, eddy_dir, out_dir)
-
     # Load S2V information 
-    f = open(glob.glob(subj_dir + '/3_EddyCo/*.eddy_values_of_all_input_parameters')[0],'r')
-    for line in f:
-        if re.search('--mporder',line):
-            s2v = line
-            s2v = s2v.split('=')[1]
-            s2v = int(s2v.split('\n')[0])
+    s2v = int(eddy.input_parameters.get('mporder', '0'))
 
     iDIO_Output['S2V'] = s2v>0
 
@@ -273,121 +398,27 @@ def iDIO_QC(subj_dir, template_dir, Bzerothr):
             iDIO_Output['HighBonly'] = True
             iDIO_Output['LowBonly'] = False
 
-    # P.11 CSD_vis_file
-    # Registration for visualizaion and localize CC for visualization (using resgitration info when S7 is done)
-    if os.path.exists(subj_dir + '/7_NetworkProc/Reg_matrix/T12MNI_1InverseWarp.nii.gz'):
-        warp_cmd = 'WarpImageMultiTransform 3 {} {} -R {} -i {} {} --use-NN'.format(template_dir + '/JHU-ICBM152-labels-1mm.nii.gz', tmp_dir + '/TractAtlas_inT1.nii.gz',subj_dir + '/Preprocessed_data/T1w_preprocessed.nii.gz', subj_dir + '/7_NetworkProc/Reg_matrix/T12MNI_0GenericAffine.mat', subj_dir + '/7_NetworkProc/Reg_matrix/T12MNI_1InverseWarp.nii.gz' )
-        utils.run_cmd(warp_cmd)
-        warp_cmd = 'mrtransform {} {} -linear {} -template {} -interp nearest -force'.format(tmp_dir + '/TractAtlas_inT1.nii.gz', tmp_dir + '/TractAtlas_inDWI.nii.gz', subj_dir + '/4_T1preproc/Reg_matrix/str2epi.txt', dwi_preproc_file)
-        utils.run_cmd(warp_cmd)
-        atlas2subj_img, _, _ = utils.load_nii(tmp_dir + '/TractAtlas_inDWI.nii.gz', ndim=3)
-        # cc_genu_val = 3;cc_splenium_val = 5 # taken from label.txt
-        cc_index = np.logical_or(atlas2subj_img == 3, atlas2subj_img == 5)
-        cc_locs = np.column_stack(np.where(cc_index))
-        cc_center_voxel = (np.nanmean(cc_locs[:, 0]), np.nanmean(cc_locs[:, 1]), np.nanmean(cc_locs[:, 2]))
-        iDIO_Output['Tracking'] = True
-    elif len(fa_file) != 0:
-        atlas2subj_file, cc_center_voxel = stats.scalar_info(fa_file[0], tmp_dir, template_dir)
-        iDIO_Output['Tracking'] = False
-    elif os.path.exists(subj_dir + '/6_CSDpreproc/S1_Response/odf_wm_norm.mif'):
-        # Generate DEC data and mean DEC
-        dec_file = subj_dir + '/6_CSDpreproc/S1_Response/DEC.nii.gz'
-        dec_cmd = 'fod2dec {} {}'.format(subj_dir + '/6_CSDpreproc/S1_Response/odf_wm_norm.mif -force', dec_file)
-        utils.run_cmd(dec_cmd)
-        mean_DEC_file = subj_dir + '/6_CSDpreproc/S1_Response/mean_DEC.nii.gz'
-        dec_cmd = 'mrmath {} mean {} -axis 3 -force'.format(subj_dir + '/6_CSDpreproc/S1_Response/DEC.nii.gz', mean_DEC_file)
-        utils.run_cmd(dec_cmd)
-        atlas2subj_file, cc_center_voxel = stats.scalar_info(mean_DEC_file, tmp_dir, template_dir)
-        iDIO_Output['Tracking'] = False
-
-    if 'cc_center_voxel' in locals():
-        if os.path.exists(subj_dir + '/6_CSDpreproc') and os.path.exists(subj_dir + '/5_DTIFIT'):
-            glyphODF_vis_file = iDIOvis.vis_glyphs(fa_file, odf_file, cc_center_voxel, out_dir)
-        elif os.path.exists(subj_dir + '/6_CSDpreproc/S1_Response/mean_DEC.nii.gz'):
-            glyphODF_vis_file = iDIOvis.vis_glyphs([subj_dir + '/6_CSDpreproc/S1_Response/mean_DEC.nii.gz'], odf_file, cc_center_voxel, out_dir)
-        else:
-            glyphODF_vis_file = ''
-    else:
-        glyphODF_vis_file = ''
-
-    basename = os.path.basename(subj_dir)
-
-    # P.12 DEC_vis_file 
-    if len(glob.glob(subj_dir + '/5_DTIFIT/*_DEC.nii.gz')) != 0:
-        dec_file = glob.glob(subj_dir + '/5_DTIFIT/*_DEC.nii.gz')[0]
-        dec_vis_file = iDIOvis.vis_slice(dec_file, out_dir, 'DEC')
-    elif len(fa_file) != 0:
-        # Generate DEC data    
-        
-        dec_file = subj_dir + '/5_DTIFIT/' + basename +'_DEC.nii.gz'
-        dec_cmd = 'fslmaths {} -mul {} {}'.format(fa_file[0], v1_file[0], dec_file)
-        utils.run_cmd(dec_cmd)
-        dec_vis_file = iDIOvis.vis_slice(dec_file, out_dir, 'DEC')
-    else:
-        dec_vis_file=''
-
-    # P.13 SSE_vis_file
-    if len(glob.glob(subj_dir + '/5_DTIFIT/*_sse.nii.gz')) != 0:
-        sse_file = glob.glob(subj_dir + '/5_DTIFIT/*_sse.nii.gz')[0]
-        sse_vis_file = iDIOvis.vis_slice(sse_file, out_dir, 'SSE')
-    elif os.path.exists(fa_file[0]):
-        # Generate SSE data in TMP dir
-        sse_file = subj_dir + '/5_DTIFIT/' + basename +'_sse.nii.gz'
-        sse_cmd = 'dtifit -k {} -o {} -m {} -r {} -b {} --sse'.format(subj_dir + '/5_DTIFIT/' + basename + '-preproc-lowb-data.nii.gz', tmp_dir + '/' + basename, mask_file, subj_dir + '/5_DTIFIT/' + basename + '-preproc-lowb-data.bvec', subj_dir + '/5_DTIFIT/' + basename + '-preproc-lowb-data.bval')
-        move_cmd = 'mv {} {}'.format(tmp_dir + '/' + basename +'_sse.nii.gz', subj_dir + '/5_DTIFIT/')
-        utils.run_cmd(sse_cmd)
-        utils.run_cmd(move_cmd)
-        sse_vis_file = iDIOvis.vis_slice(sse_file, out_dir, 'SSE')
-    else:
-        sse_vis_file=''
-
-    # P.14 Improbable_voxel_file
-    if len(fa_file) != 0:
-        Improbable_voxel_vis_file = iDIOvis.vis_overlap_slice(fa_file[0], improbable_voxels_file, out_dir, percent_improbable)
-    elif os.path.exists(subj_dir + '/6_CSDpreproc/S1_Response/mean_DEC.nii.gz'):
-        mean_DEC_file = subj_dir + '/6_CSDpreproc/S1_Response/mean_DEC.nii.gz'
-        Improbable_voxel_vis_file = iDIOvis.vis_overlap_slice(mean_DEC_file, improbable_voxels_file, out_dir, percent_improbable)
-    else:
-        Improbable_voxel_vis_file=''
-
     # Output P.1 - Reference/Option summary
     # Check Preprocessed steps
     
     title_vis_file, Ref_vis_file = iDIOvis.vis_title(iDIO_Output, outlier_warning, o_n_percentage, bvol, out_dir)
 
 
-    # Combine component PDFs
-    vis_files = []
-    vis_files.append(title_vis_file)
-    for ref_vis in Ref_vis_file:
-        vis_files.append(ref_vis)
-    vis_files.append(pedir_vis_file)
-    for res_vis in res_vis_file:
-        vis_files.append(res_vis)
-    vis_files.append(degibbs_vis_file)
-    vis_files.append(drift_vis_file)
-    vis_files.append(stats_vis_file)
-    vis_files.append(bias_vis_file)
-    vis_files.append(preproc_vis_file)
-    vis_files.append(gradcheck_vis_file)
-    for dwi_vis in dwi_cnr_files:
-        vis_files.append(dwi_vis)
-    vis_files.append(glyphODF_vis_file)
-    vis_files.append(dec_vis_file)
-    vis_files.append(sse_vis_file)
-    vis_files.append(Improbable_voxel_vis_file)
-    pdf_file = utils.merge_pdfs(vis_files, 'QC', out_dir)
+    # Complete the report
+    qc_report.add(0, title_vis_file)
+    qc_report.add(1, Ref_vis_file)
+    report_file = qc_report.close(stats_file=out_dir + '/stats.csv', title='iDIO QC: {}'.format(os.path.basename(subj_dir)))
     utils.remove_dir(tmp_dir)
 
     tf = time.time()
     dt = round(tf - ti)
 
     print('************************************')
-    print('***      PDF SAVED ({:05d}s)     ***'.format(dt))
+    print('***     {:>4} SAVED ({:05d}s)     ***'.format(report.upper(), dt))
     print('************************************\n')
 
 if __name__ == '__main__':
    # for help function
     args = parseArguments()
    # Run function
-    iDIO_QC(args.subj_dir, args.template_dir, args.Bzerothr)
\ No newline at end of file
+    iDIO_QC(args.subj_dir, args.template_dir, args.Bzerothr, keep_res=args.keep_res, num_procs=args.jobs, report=args.report, dpi=args.dpi)
\ No newline at end of file
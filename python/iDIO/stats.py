@@ -3,7 +3,7 @@
 # Credit : Modify from PreQual: https://github.com/MASILab/PreQual (by Leon Cai and Qi Yang, MASI Lab, Vanderbilt University)
 # iDIO QC stats function
 
-import os, glob
+import os
 
 import nibabel as nib
 import numpy as np
@@ -46,15 +46,12 @@ def BPV_mask(mask_file, subj_dir, temp_dir):
 
     return BPV_mask_file
 
-def motion(eddy_dir, stats_dir):
+def motion(eddy, stats_dir):
 
-    # Load motion data
+    # Load motion data (eddy: utils.EddyResults)
 
-    eddy_params_file = glob.glob(eddy_dir + '/*.eddy_parameters')
-    eddy_rms_file = glob.glob(eddy_dir + '/*.eddy_movement_rms')
-
-    eddy_params = utils.load_txt(eddy_params_file[0])
-    eddy_rms = utils.load_txt(eddy_rms_file[0])
+    eddy_params = eddy.parameters
+    eddy_rms = eddy.movement_rms
     # Calculate movement metrics
 
     rotations = eddy_params[:, 3:6] / np.pi * 180
@@ -103,13 +100,12 @@ def motion(eddy_dir, stats_dir):
 
     return motion_dict, stats_out_list
 
-def eddy_current(eddy_dir, stats_dir):
+def eddy_current(eddy, stats_dir):
 
-    # Load motion data
+    # Load motion data (eddy: utils.EddyResults)
+
+    eddy_params = eddy.parameters
 
-    eddy_params_file = glob.glob(eddy_dir + '/*.eddy_parameters')
-    eddy_params = utils.load_txt(eddy_params_file[0])
-    
     # Calculate movement metrics
     EC_linear = eddy_params[:,6:9]
     EC_linear_std = np.std(eddy_params[:,6:9], axis=0)
@@ -132,13 +128,14 @@ def eddy_current(eddy_dir, stats_dir):
     return EC_dict, stats_out_list
 
 
-def cnr(bvals_file, mask_file, eddy_dir, stats_dir, shells=[]):
+def cnr(bvals_file, mask_file, eddy, stats_dir, shells=[]):
 
-    # Load CNR data
+    # Load CNR data (eddy: utils.EddyResults)
     bvals = utils.load_txt(bvals_file, txt_type='bvals')
     bvals_unique = np.sort(np.unique(bvals))
-    eddy_cnr_file = glob.glob(eddy_dir + '/*.eddy_cnr_maps.nii.gz')
-    eddy_cnr_img, _, _ = utils.load_nii(eddy_cnr_file[0], ndim=4)
+    if eddy.cnr_maps_file == '':
+        raise utils.DTIQAError('EDDY OUTPUT *.eddy_cnr_maps.nii.gz NOT FOUND IN {}.'.format(eddy.eddy_dir))
+    eddy_cnr_img, _, _ = utils.load_nii(eddy.cnr_maps_file, ndim=4)
     mask_img, _, _ = utils.load_nii(mask_file, dtype='bool', ndim=3)
 
     # Check that the number of shells in eddy CNR output and bvals are the same
@@ -263,6 +260,7 @@ def gradcheck(dwi_file, bvals_file, bvecs_file, mask_file, corr_dir):
 
 def _erode_mask(mask_img):
 
+    mask_img = mask_img.copy()
     for i in range(mask_img.shape[2]):
         mask_img[:, :, i] = ndimage.binary_erosion(mask_img[:, :, i], structure=np.ones((3, 3)))
     return mask_img
\ No newline at end of file
@@ -4,18 +4,31 @@
 # iDIO QC utils function
 
 # system lib
-import sys, os, subprocess
+import sys, os, glob, subprocess, html, zipfile
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from multiprocessing import get_context
 
 import nibabel as nib
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_pdf import PdfPages
 
+from math import factorial
 from skimage import measure
 from scipy.optimize import fmin
+from scipy.special import lpmv
 
 # iDIO combined PreQual libraries
 from vars import SHARED_VARS
 
+# random access into .nii.gz files (used by nibabel when installed)
+try:
+    import indexed_gzip
+    HAVE_INDEXED_GZIP = True
+except ImportError:
+    HAVE_INDEXED_GZIP = False
+
 # Class Definitions: dtiQA Error
 
 class DTIQAError(Exception):
@@ -64,8 +77,7 @@ def remove_dir(in_dir):
 def make_dir(parent_dir, child_dir):
 
     new_dir = os.path.join(parent_dir, child_dir)
-    if not os.path.exists(new_dir):
-        os.mkdir(new_dir)
+    os.makedirs(new_dir, exist_ok=True) # pages running in parallel share the TMP directories
     return new_dir
 
 def get_prefix(file_path, file_ext='nii'):
@@ -104,10 +116,61 @@ def save_txt(txt_data, txt_file):
         txt_data = np.array([txt_data]) # 0D (i.e. number) or 2D data all fine, concern when data is 1D, it needs to be made 2D.
     np.savetxt(txt_file, txt_data, fmt='%1.7f', delimiter=' ', newline='\n')
 
+# Process-wide LRU cache of loaded NIFTI images (budget: SHARED_VARS.NII_CACHE_MB)
+# keyed by (path, mtime, size, dtype, ndim); cached images are returned as read-only views
+
+_NII_CACHE = OrderedDict()
+_NII_CACHE_NBYTES = [0]
+
+def _nii_cache_key(nii_file, dtype, ndim):
+
+    nii_path = os.path.realpath(nii_file)
+    st = os.stat(nii_path)
+    dtype = str(np.dtype(dtype)) if not dtype == '' else ''
+    return (nii_path, st.st_mtime_ns, st.st_size, dtype, ndim)
+
+def _nii_cache_pop(key):
+
+    img, _, _ = _NII_CACHE.pop(key)
+    _NII_CACHE_NBYTES[0] -= img.nbytes
+
+def _nii_cache_put(key, img, aff, hdr):
+
+    budget = SHARED_VARS.NII_CACHE_MB * 1024**2
+    for old_key in [k for k in _NII_CACHE if k[0] == key[0]]: # file changed on disk
+        if old_key[1:3] != key[1:3]:
+            _nii_cache_pop(old_key)
+    if img.nbytes > budget:
+        return False
+    while _NII_CACHE and _NII_CACHE_NBYTES[0] + img.nbytes > budget:
+        _nii_cache_pop(next(iter(_NII_CACHE)))
+    img.flags.writeable = False
+    _NII_CACHE[key] = (img, aff, hdr)
+    _NII_CACHE_NBYTES[0] += img.nbytes
+    return True
+
+def clear_nii_cache():
+
+    _NII_CACHE.clear()
+    _NII_CACHE_NBYTES[0] = 0
+
 def load_nii(nii_file, dtype='', ndim=-1):
 
+    key = _nii_cache_key(nii_file, dtype, ndim)
+    if key in _NII_CACHE:
+        _NII_CACHE.move_to_end(key)
+    else:
+        img, aff, hdr = _load_nii(nii_file, dtype=dtype, ndim=ndim)
+        if not _nii_cache_put(key, img, aff, hdr):
+            return img, aff, hdr
+    img, aff, hdr = _NII_CACHE[key]
+
+    return img.view(), aff.copy(), hdr.copy()
+
+def _load_nii(nii_file, dtype='', ndim=-1):
+
     nii = nib.load(nii_file)
-    img = nii.get_data()
+    img = np.asanyarray(nii.dataobj)
 
     if not dtype == '':
         img = img.astype(dtype)
@@ -124,10 +187,18 @@ def load_nii(nii_file, dtype='', ndim=-1):
 
     img = np.array(img)
     aff = nii.affine
-    hdr = nii.get_header()
+    hdr = nii.header
 
     return img, aff, hdr
 
+def load_nii_info(nii_file):
+
+    # Header-only: shape, voxel dimensions, affine and on-disk data type, without reading voxel data
+    nii = nib.load(nii_file)
+    hdr = nii.header
+
+    return nii.shape, hdr.get_zooms(), nii.affine, hdr.get_data_dtype()
+
 def save_nii(img, aff, nii_file, dtype='', ndim=-1):
 
     if not dtype == '':
@@ -146,18 +217,241 @@ def save_nii(img, aff, nii_file, dtype='', ndim=-1):
     nii = nib.Nifti1Image(img, aff)
     nib.save(nii, nii_file)
 
+# MRtrix image format (.mif): 'key: value' text header up to END, data at the byte offset given by 'file: . <offset>'
+_MIF_DTYPES = {'Int8': 'i1', 'UInt8': 'u1', 'Int16': 'i2', 'UInt16': 'u2', 'Int32': 'i4', 'UInt32': 'u4', 'Float32': 'f4', 'Float64': 'f8'}
+
+def load_mif(mif_file):
+
+    # function to map an (uncompressed) MRtrix image without reading its data
+    # Outputs:
+    # - image (memory-mapped, indexed along the MRtrix image axes), voxel to scanner affine
+    ##
+
+    hdr = {}
+    transform = []
+    with open(mif_file, 'rb') as f:
+        if f.readline().strip() != b'mrtrix image':
+            raise DTIQAError('{} IS NOT AN (UNCOMPRESSED) MRTRIX IMAGE.'.format(mif_file))
+        for line in f:
+            line = line.decode('latin-1').strip()
+            if line == 'END':
+                break
+            key, _, value = line.partition(':')
+            if key.strip() == 'transform':
+                transform.append([float(v) for v in value.split(',')])
+            else:
+                hdr[key.strip()] = value.strip()
+
+    dims = [int(v) for v in hdr['dim'].split(',')]
+    vox = [float(v) for v in hdr['vox'].split(',')]
+    layout = hdr['layout'].split(',')
+    datatype = hdr['datatype']
+    if datatype[-2:] in ['LE', 'BE']:
+        byteorder = '<' if datatype[-2:] == 'LE' else '>'
+        datatype = datatype[:-2]
+    else:
+        byteorder = '='
+    if datatype not in _MIF_DTYPES:
+        raise DTIQAError('MRTRIX DATATYPE {} OF {} IS NOT SUPPORTED.'.format(hdr['datatype'], mif_file))
+    data_file, offset = hdr['file'].split()
+    if data_file == '.':
+        data_file = mif_file
+    else:
+        data_file = os.path.join(os.path.dirname(mif_file), data_file)
+
+    # layout: storage rank of each axis (0 = fastest), '-' when stored in reverse order
+    ranks = [int(v.lstrip('+-')) for v in layout]
+    storage_order = np.argsort(ranks)[::-1]
+    img = np.memmap(data_file, dtype=byteorder + _MIF_DTYPES[datatype], mode='r', offset=int(offset), shape=tuple(dims[i] for i in storage_order))
+    img = np.transpose(img, np.argsort(storage_order))
+    for i, v in enumerate(layout):
+        if v.startswith('-'):
+            img = np.flip(img, axis=i)
+
+    # transform maps voxel positions in mm to scanner space
+    aff = np.eye(4)
+    aff[:3, :] = np.array(transform)
+    aff[:3, :3] = aff[:3, :3] * np.array(vox[:3])
+
+    return img, aff
+
+# FSL eddy text outputs (<prefix>.eddy_<output>, one row per volume) and the header rows to skip.
+# EddyResults parses them once and caches the arrays in SHARED_VARS.EDDY_CACHE_FILE (.npz in the eddy directory),
+# which is reused as long as the name, mtime and size of every text output are unchanged
+_EDDY_OUTPUTS = OrderedDict([('parameters', 0), ('movement_rms', 0), ('outlier_map', 1), ('outlier_n_stdev_map', 1)])
+
+class EddyResults():
+
+    # eddy outputs used by the QC (stats.motion, stats.eddy_current, stats.cnr and iDIOvis.vis_stats)
+    # - parameters: volumes x 16+ (translations (mm), rotations (rad), EC linear terms (Hz/mm), ...)
+    # - movement_rms: volumes x 2 (absolute, relative displacement)
+    # - outlier_map: volumes x slices (uint8, 1 = outlier slice)
+    # - outlier_n_stdev_map: volumes x slices (no. of std. off mean difference)
+    # - input_parameters: eddy command line options ({'mporder': '0', ...})
+    # - cnr_maps_file: *.eddy_cnr_maps.nii.gz ('' when eddy ran without --cnr_maps)
+    ##
+
+    def __init__(self, eddy_dir):
+
+        self.eddy_dir = eddy_dir
+        txt_files = [_eddy_file(eddy_dir, output) for output in list(_EDDY_OUTPUTS) + ['values_of_all_input_parameters']]
+        results = _load_eddy_cache(eddy_dir, txt_files)
+        if results is None:
+            results = {output: _read_eddy_txt(txt_file, skip_rows, dtype='u1' if output == 'outlier_map' else 'f8') for (output, skip_rows), txt_file in zip(_EDDY_OUTPUTS.items(), txt_files)}
+            input_parameters = _read_eddy_input_parameters(txt_files[-1])
+            results['input_keys'] = np.array(list(input_parameters.keys()), dtype=str)
+            results['input_values'] = np.array(list(input_parameters.values()), dtype=str)
+            _save_eddy_cache(eddy_dir, txt_files, results)
+
+        for output in _EDDY_OUTPUTS:
+            setattr(self, output, results[output])
+        self.input_parameters = dict(zip(results['input_keys'].tolist(), results['input_values'].tolist()))
+        cnr_maps_files = sorted(glob.glob(os.path.join(eddy_dir, '*.eddy_cnr_maps.nii.gz')))
+        self.cnr_maps_file = cnr_maps_files[0] if cnr_maps_files else ''
+
+def _eddy_file(eddy_dir, output):
+
+    txt_files = sorted(glob.glob(os.path.join(eddy_dir, '*.eddy_' + output)))
+    if not txt_files:
+        raise DTIQAError('EDDY OUTPUT *.eddy_{} NOT FOUND IN {}.'.format(output, eddy_dir))
+    return txt_files[0]
+
+def _eddy_cache_key(txt_files):
+
+    # name, mtime and size of the eddy text outputs
+    return np.array(['{} {} {}'.format(os.path.basename(txt_file), os.stat(txt_file).st_mtime_ns, os.stat(txt_file).st_size) for txt_file in txt_files], dtype=str)
+
+def _load_eddy_cache(eddy_dir, txt_files):
+
+    cache_file = os.path.join(eddy_dir, SHARED_VARS.EDDY_CACHE_FILE)
+    try:
+        with np.load(cache_file, allow_pickle=False) as cache:
+            if np.array_equal(cache['key'], _eddy_cache_key(txt_files)):
+                return {name: cache[name] for name in cache.files if not name == 'key'}
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        pass
+    return None
+
+def _save_eddy_cache(eddy_dir, txt_files, results):
+
+    # written to a temporary file and renamed, so concurrent QC runs never read a partial cache;
+    # a read-only eddy directory just means no cache
+    cache_file = os.path.join(eddy_dir, SHARED_VARS.EDDY_CACHE_FILE)
+    tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+    try:
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, key=_eddy_cache_key(txt_files), **results)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+def _read_eddy_txt(txt_file, skip_rows=0, dtype='f8'):
+
+    # function to read an eddy text matrix with one vectorized parse ('u1': 0/1 maps, one digit per value)
+    # Outputs:
+    # - rows x values array
+    ##
+
+    with open(txt_file, 'rb') as f:
+        rows = [row for row in f.read().splitlines()[skip_rows:] if row.strip()]
+    txt = b' '.join(rows)
+    if dtype == 'u1':
+        chars = np.frombuffer(txt, dtype='u1')
+        values = chars[chars > ord(' ')] - ord('0')
+    else:
+        values = np.fromstring(txt.decode('latin-1'), dtype=dtype, sep=' ')
+    if len(rows) == 0 or not values.size % len(rows) == 0:
+        raise DTIQAError('EDDY OUTPUT {} IS NOT A MATRIX ({} VALUES IN {} ROWS).'.format(txt_file, values.size, len(rows)))
+    return values.reshape(len(rows), -1)
+
+def _read_eddy_input_parameters(txt_file):
+
+    # '--option=value' lines of *.eddy_values_of_all_input_parameters
+    input_parameters = OrderedDict()
+    with open(txt_file, 'r') as f:
+        for line in f:
+            key, _, value = line.strip().partition('=')
+            if key.startswith('--'):
+                input_parameters[key[2:]] = value
+    return input_parameters
+
 
 # Function Definitions: Visualization
 def slice_nii(nii_file, offsets=[0], custom_aff=[], min_percentile=0, max_percentile=100, min_intensity=np.nan, max_intensity=np.nan):
 
-    img, aff, hdr = load_nii(nii_file, ndim=3)
+    # Same outputs as slice_img on the loaded volume, but only the requested slices are read (through the array proxy),
+    # and the intensity percentiles are estimated on a strided subsample of about SHARED_VARS.VIS_PERCENTILE_SAMPLES voxels
+
+    nii = nib.load(nii_file)
+    shape = nii.shape
+    if len(shape) < 3 or len(shape) > 4 or (len(shape) == 4 and shape[-1] != 1):
+        raise DTIQAError('CANNOT SLICE NIFTI IMAGE {} WITH SHAPE {}, EXPECTED A 3D VOLUME.'.format(nii_file, shape))
+    aff = custom_aff if len(custom_aff) > 0 else nii.affine
+    vol_index = [0] if len(shape) == 4 else []
+    data = nii.dataobj
+    if nii_file.endswith('.gz') and not HAVE_INDEXED_GZIP:
+        data = np.asanyarray(data) # every read of a gzip stream decompresses it from the start: read it once
+
+    # Radiological view (see _radiological_view): permutation and flips from the affine only
+
+    permute_axis_order, flips = _radiological_transform(aff)
+    vox_dim = np.array(nii.header.get_zooms()[:3])[permute_axis_order]
+    rad_shape = [shape[axis] for axis in permute_axis_order]
+
+    # Extract min and max of entire volume (estimated) so slices can be plotted with homogenous scaling
+
+    if np.isnan(min_intensity) or np.isnan(max_intensity):
+        step = max(1, int(np.ceil((np.prod(shape[:3]) / SHARED_VARS.VIS_PERCENTILE_SAMPLES) ** (1/3))))
+        sample = np.asanyarray(data[tuple([slice(None, None, step)]*3 + vol_index)])
+    if np.isnan(min_intensity):
+        img_min = np.nanpercentile(sample, min_percentile)
+    else:
+        img_min = min_intensity
+    if np.isnan(max_intensity):
+        img_max = np.nanpercentile(sample, max_percentile)
+    else:
+        img_max = max_intensity
+
+    # Extract center triplanar slices with offsets, read one slice at a time in the original orientation.
+
+    slices = []
+    for rad_axis in range(3):
+        n = rad_shape[rad_axis]
+        center = int(round(n / 2, 1))
+        axis_slices = []
+        for offset in offsets:
+            i = center + offset
+            if i < 0: # as numpy indexing of the reoriented volume
+                i += n
+            if i < 0 or i >= n:
+                raise IndexError('index {} is out of bounds for axis {} with size {}'.format(center + offset, rad_axis, n))
+            if flips[rad_axis]:
+                i = n - 1 - i
+            index = [slice(None)]*3 + vol_index
+            index[permute_axis_order[rad_axis]] = slice(i, i+1)
+            axis_slices.append(np.asanyarray(data[tuple(index)]))
+        s = np.concatenate(axis_slices, axis=permute_axis_order[rad_axis])
+        s = np.transpose(s, axes=permute_axis_order)
+        for flip_axis in range(3):
+            if flips[flip_axis] and flip_axis != rad_axis:
+                s = np.flip(s, axis=flip_axis)
+        slices.append(s)
+
+    return tuple(slices), vox_dim, img_min, img_max
+
+def slice_img(img, aff, vox_dim=[], offsets=[0], min_percentile=0, max_percentile=100, min_intensity=np.nan, max_intensity=np.nan):
+
+    # In-memory version of slice_nii: img is a 3D array (or 4D with one volume), vox_dim defaults to the voxel sizes of aff
+
+    if len(img.shape) == 4 and img.shape[-1] == 1:
+        img = img[..., 0]
 
     # Extract voxel dimensions and reorient image in radiological view
 
-    vox_dim = hdr.get_zooms()
-    if len(custom_aff) > 0:
-        aff = custom_aff
-    img, vox_dim = _radiological_view(img, aff, vox_dim)
+    if len(vox_dim) == 0:
+        vox_dim = nib.affines.voxel_sizes(aff)
+    img, vox_dim = _radiological_view(img, aff, vox_dim[:3])
 
     # Extract min and max of entire volume so slices can be plotted with homogenous scaling
 
@@ -264,19 +558,122 @@ def plot_slice_contour_iDIO(slices, img_dim, offset_index):
 
     return slice_contours
 
-def merge_pdfs(pdf_files, merged_prefix, pdf_dir):
+def save_page(page_file, dpi=None):
+
+    # function to finish the current pyplot figure as a report page, kept in memory instead of written to page_file
+    # Inputs:
+    # - page_file: page file name, its prefix names the page (e.g. 'dec.pdf' -> 'dec')
+    # - dpi: resolution of the rasterized content (default: figure dpi)
+    # Outputs:
+    # - page figure (picklable, so pages can be returned by parallel workers)
+    # Note: pages are not rendered here; the (PDF_DPI) rendering happens once, in the process that writes the report
+    # (ReportWriter), so it is serial even when the pages are prepared in parallel (run_tasks)
+    ##
+
+    fig = plt.gcf()
+    fig.set_label(get_prefix(page_file, file_ext='pdf'))
+    fig.page_dpi = dpi if dpi is not None else 'figure' # figure dpi itself is not kept when pickled
+    plt.close(fig)
+    return fig
+
+class ReportWriter():
+
+    # report writer: pages (save_page figures) can be added in any order (e.g. as the parallel page tasks finish),
+    # the report is assembled in page key order
+    # - report: 'pdf' (one multi-page pdf, pages rendered straight into it) or 'html' (png pages with a static html index:
+    #   downsampled thumbnails of all pages, the full resolution pages below them (lazy-loaded) and the stats csv as table)
+    # - dpi: resolution of the html page images (pdf pages keep the dpi given to save_page)
+    # - thumb_factor: downsampling factor of the html thumbnails
+    # - keys: all page keys of the report; a pdf page is written as soon as the pages of every smaller key were added
+    #   (pages are appended to the document in order), html pages are rendered as soon as they are added
+    # Note: pages are rendered in this process, one after the other. Pages rendered by the workers could not be merged
+    # without re-encoding (PdfPages only renders figures, and there is no pdf merger among the dependencies), so the
+    # workers only load data and build the figures; the rendering time adds to the longest task chain
+    ##
+
+    def __init__(self, report_prefix, report_dir, report='pdf', dpi=100, thumb_factor=5, keys=()):
+
+        self.report_prefix = report_prefix
+        self.report = report
+        self.dpi = dpi
+        self.thumb_factor = thumb_factor
+        self.keys = sorted(keys) # pdf: keys not written yet
+        self.waiting = {} # pdf: key -> pages added before the pages of a smaller key
+        self.pages = [] # html: (key, label, png file) of the rendered pages, in the order they were added
+        if report == 'pdf':
+            self.report_file = os.path.join(report_dir, '{}.pdf'.format(report_prefix))
+            self.pdf = PdfPages(self.report_file)
+        else:
+            self.report_file = os.path.join(report_dir, '{}.html'.format(report_prefix))
+            self.page_dir = make_dir(report_dir, '{}_pages'.format(report_prefix))
+
+    def add(self, key, pages):
+
+        # pages: save_page figure or list of them ('' for missing pages), placed after the pages of smaller keys
+        if not isinstance(pages, list):
+            pages = [pages]
+        if self.report == 'pdf':
+            self.waiting[key] = pages
+            while len(self.keys) != 0 and self.keys[0] in self.waiting:
+                self._write_pdf_pages(self.waiting.pop(self.keys.pop(0)))
+            return
+        for i, page in enumerate(pages):
+            if isinstance(page, str):
+                continue
+            png_file = os.path.join(self.page_dir, 'tmp_{}.png'.format(len(self.pages))) # renamed to the page number on close
+            _save_png_page(page, png_file, self.dpi, self.thumb_factor)
+            plt.close(page)
+            self.pages.append(((key, i), page.get_label(), png_file))
+
+    def close(self, stats_file='', title=''):
+
+        # Outputs:
+        # - report file
+        ##
+
+        if self.report == 'pdf':
+            print('MERGING PDFS')
+            for key in sorted(self.waiting): # pages after a key that was never added
+                self._write_pdf_pages(self.waiting.pop(key))
+            self.pdf.close()
+        else:
+            print('WRITING HTML REPORT')
+            page_entries = []
+            for (key, i), label, png_file in sorted(self.pages, key=lambda page: page[0]):
+                name = '{:02d}_{}'.format(len(page_entries) + 1, label)
+                os.replace(png_file, os.path.join(self.page_dir, '{}.png'.format(name)))
+                os.replace(png_file[:-4] + '_thumb.png', os.path.join(self.page_dir, '{}_thumb.png'.format(name)))
+                page_entries.append((name, label))
+            write_str(_html_report(page_entries, os.path.basename(self.page_dir), title or self.report_prefix, stats_file), self.report_file)
+
+        return self.report_file
+
+    def _write_pdf_pages(self, pages):
+
+        for page in pages:
+            if isinstance(page, str):
+                continue
+            self.pdf.savefig(page, dpi=page.page_dpi)
+            plt.close(page)
+
+def merge_pdfs(pages, merged_prefix, pdf_dir):
 
-    print('MERGING PDFS')
+    # function to write the report pages (save_page figures, '' for missing pages) in order into one multi-page pdf,
+    # each page rendered once, straight into the document
+    report = ReportWriter(merged_prefix, pdf_dir, keys=[0])
+    report.add(0, pages)
+    return report.close()
 
-    pdf_files_str = ' '.join(pdf_files)
-    merged_pdf_file = os.path.join(pdf_dir, '{}.pdf'.format(merged_prefix))
-    gs_cmd = 'gs -dNOPAUSE -sDEVICE=pdfwrite -sOUTPUTFILE={} -dBATCH {}'.format(merged_pdf_file, pdf_files_str)
-    run_cmd(gs_cmd)
+def write_html_report(pages, report_prefix, report_dir, dpi=100, thumb_factor=5, stats_file='', title=''):
 
-    # print('CLEANING UP COMPONENT PDFS')
-    remove_file(pdf_files_str)
+    # function to write the report pages (save_page figures, '' for missing pages) as png images with a static html index
+    # Outputs:
+    # - html file
+    ##
 
-    return merged_pdf_file
+    report = ReportWriter(report_prefix, report_dir, report='html', dpi=dpi, thumb_factor=thumb_factor)
+    report.add(0, pages)
+    return report.close(stats_file=stats_file, title=title)
 
 def radiological_order(aff):
     
@@ -298,6 +695,45 @@ def Residual(in_file, sub_file, res_file):
     # run_cmd(res_mean_cmd)
     return res_file #, res_mean_file
 
+def Residual_stats(in_file, sub_file, bvals):
+
+    # Streaming alternative to Residual: per shell mean and (sample) variance of in_file - sub_file,
+    # accumulated volume by volume (float64 Welford) without writing the 4D residual.
+    # Also keeps the first volume of each shell of both inputs (for plotting).
+    # Returns {bval: {'in_first', 'sub_first', 'res_mean', 'res_var', 'num'}}, in_file affine, sub_file affine
+
+    in_nii = nib.load(in_file, keep_file_open=True)
+    sub_nii = nib.load(sub_file, keep_file_open=True)
+    if in_nii.shape != sub_nii.shape:
+        raise DTIQAError('CANNOT CALCULATE RESIDUALS OF IMAGES WITH DIFFERENT SHAPES: {} AND {}'.format(in_nii.shape, sub_nii.shape))
+    if len(in_nii.shape) == 3:
+        in_nii = in_nii.slicer[..., np.newaxis]
+        sub_nii = sub_nii.slicer[..., np.newaxis]
+
+    res_stats = {}
+    for i in range(in_nii.shape[3]):
+        in_vol = in_nii.dataobj[:, :, :, i]
+        sub_vol = sub_nii.dataobj[:, :, :, i]
+        res_vol = np.asarray(in_vol, dtype=np.float64) - np.asarray(sub_vol, dtype=np.float64)
+        if bvals[i] not in res_stats:
+            res_stats[bvals[i]] = {
+                'in_first': in_vol,
+                'sub_first': sub_vol,
+                'res_mean': np.zeros(res_vol.shape),
+                'res_var': np.zeros(res_vol.shape),
+                'num': 0
+            }
+        shell = res_stats[bvals[i]]
+        shell['num'] += 1
+        delta = res_vol - shell['res_mean']
+        shell['res_mean'] += delta / shell['num']
+        shell['res_var'] += delta * (res_vol - shell['res_mean']) # sum of squares, scaled below
+
+    for shell in res_stats.values():
+        shell['res_var'] /= max(shell['num'] - 1, 1)
+
+    return res_stats, in_nii.affine, sub_nii.affine
+
 # Function Definitions: Pipeline needs
 
 def load_config(in_dir):
@@ -341,6 +777,82 @@ def load_config(in_dir):
 
     return dwi_files, bvals_files, bvecs_files, pe_dirs, pe_axis, mergename#readout_times
 
+# Dependency graph of pipeline tasks (e.g. QC pages): a task runs fn(*args, **kwargs) once the tasks
+# it depends on are done; TaskOutput(name, index) in args/kwargs is replaced by (item index of) the output of task name
+Task = namedtuple('Task', ['fn', 'args', 'kwargs', 'deps'])
+TaskOutput = namedtuple('TaskOutput', ['name', 'index'], defaults=[None])
+
+def task(fn, *args, deps=(), **kwargs):
+
+    # deps: tasks to wait for without using their output (e.g. files they write)
+    return Task(fn, args, kwargs, tuple(deps))
+
+def _task_deps(t):
+
+    deps = set(t.deps)
+    for arg in list(t.args) + list(t.kwargs.values()):
+        if isinstance(arg, TaskOutput):
+            deps.add(arg.name)
+    return deps
+
+def _task_input(arg, outputs):
+
+    if not isinstance(arg, TaskOutput):
+        return arg
+    if arg.index is None:
+        return outputs[arg.name]
+    return outputs[arg.name][arg.index]
+
+def run_tasks(tasks, num_procs=1, on_done=None):
+
+    # function to run a dependency graph of tasks, ready tasks are run in a pool of num_procs processes
+    # Inputs:
+    # - tasks: dictionary of name -> task(...)
+    # - num_procs: number of worker processes (1 = run in this process, in the order tasks were declared)
+    # - on_done: on_done(name, output) is called in this process as soon as a task is done (e.g. to write its report pages)
+    # Outputs:
+    # - dictionary of name -> output of the task
+    ##
+
+    deps = {name: _task_deps(t) for name, t in tasks.items()}
+    for name in deps:
+        unknown = deps[name] - set(tasks)
+        if len(unknown) != 0:
+            raise DTIQAError('TASK {} DEPENDS ON UNKNOWN TASK(S) {}.'.format(name, ', '.join(sorted(unknown))))
+
+    pending = dict(tasks)
+    running = {}
+    outputs = {}
+    # forked workers start with the modules (and NIFTI cache) of this process already loaded
+    pool = ProcessPoolExecutor(max_workers=num_procs, mp_context=get_context('fork')) if num_procs > 1 else None
+    try:
+        while len(pending) != 0 or len(running) != 0:
+            ready = [name for name in pending if deps[name] <= outputs.keys()]
+            if len(ready) == 0 and len(running) == 0:
+                raise DTIQAError('CYCLIC DEPENDENCIES BETWEEN TASKS {}.'.format(', '.join(sorted(pending))))
+            for name in ready:
+                t = pending.pop(name)
+                args = [_task_input(arg, outputs) for arg in t.args]
+                kwargs = {key: _task_input(arg, outputs) for key, arg in t.kwargs.items()}
+                if pool is None:
+                    outputs[name] = t.fn(*args, **kwargs)
+                    if on_done is not None:
+                        on_done(name, outputs[name])
+                else:
+                    running[pool.submit(t.fn, *args, **kwargs)] = name
+            if len(running) != 0:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    outputs[name] = future.result()
+                    if on_done is not None:
+                        on_done(name, outputs[name])
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    return outputs
+
 # Function Definitions: Math Helper Functions
 def nearest(value, array):
 
@@ -356,6 +868,46 @@ def round(num, base):
     else:
         return base*np.floor(d)
 
+def sphere_dirs(num_dirs):
+
+    # function to spread num_dirs unit vectors evenly over the sphere (Fibonacci lattice)
+    i = np.arange(num_dirs) + 0.5
+    z = 1 - 2*i/num_dirs
+    r = np.sqrt(1 - z**2)
+    phi = np.pi*(1 + np.sqrt(5))*i
+    return np.column_stack((r*np.cos(phi), r*np.sin(phi), z))
+
+def sh_lmax(num_coefs):
+
+    # maximum order of an even SH series with num_coefs = (lmax+1)(lmax+2)/2 coefficients
+    lmax = (int(np.sqrt(8*num_coefs + 1)) - 3)//2
+    if (lmax+1)*(lmax+2)//2 != num_coefs:
+        raise DTIQAError('{} COEFFICIENTS DO NOT FORM AN EVEN SH SERIES.'.format(num_coefs))
+    return lmax
+
+def sh_basis(dirs, lmax):
+
+    # function to evaluate the MRtrix3 real even SH basis at unit vectors (scanner space)
+    # coefficient l(l+1)/2+m: sqrt(2)*P_lm*cos(m*az) for m > 0, P_l0 for m = 0, sqrt(2)*P_l|m|*sin(|m|*az) for m < 0
+    # (P_lm: normalized associated Legendre function of cos(elevation), Condon-Shortley phase included)
+    # Outputs:
+    # - num_dirs x num_coefs matrix, SH amplitudes = coefs @ basis.T
+    ##
+
+    cos_el = np.clip(dirs[:, 2], -1, 1)
+    az = np.arctan2(dirs[:, 1], dirs[:, 0])
+    basis = np.zeros((dirs.shape[0], (lmax+1)*(lmax+2)//2))
+    for l in range(0, lmax+1, 2):
+        center = l*(l+1)//2
+        for m in range(0, l+1):
+            P = np.sqrt((2*l+1)/(4*np.pi)*factorial(l-m)/factorial(l+m)) * lpmv(m, l, cos_el)
+            if m == 0:
+                basis[:, center] = P
+            else:
+                basis[:, center+m] = np.sqrt(2)*P*np.cos(m*az)
+                basis[:, center-m] = np.sqrt(2)*P*np.sin(m*az)
+    return basis
+
 # Function Definitions: DWI Manipulation
 def dwi_extract(dwi_file, bvecs_file, bvals_file, extract_dir, target_bval=0, first_only=False):
 
@@ -400,6 +952,15 @@ def dwi_extract_iDIO(dwi_file, bvals, extract_dir, target_bval=0, first_only=Fal
 
     dwi_img, dwi_aff, _ = load_nii(dwi_file, ndim=4)
 
+    dwi_extracted_file = os.path.join(extract_dir, '{}_b{}_{}.nii.gz'.format(dwi_prefix, target_bval, 'first' if first_only else 'all'))
+    _, num_extracted_vols, num_total_vols = dwi_extract_img(dwi_img, dwi_aff, bvals, target_bval=target_bval, first_only=first_only, out_file=dwi_extracted_file)
+
+    return dwi_extracted_file, num_extracted_vols, num_total_vols
+
+def dwi_extract_img(dwi_img, dwi_aff, bvals, target_bval=0, first_only=False, out_file=''):
+
+    # In-memory version of dwi_extract_iDIO: returns the extracted array, saved to out_file only if given
+
     num_total_vols = dwi_img.shape[3]
     index = np.array(range(0, num_total_vols))
     index = index[bvals == target_bval]
@@ -418,10 +979,10 @@ def dwi_extract_iDIO(dwi_file, bvals, extract_dir, target_bval=0, first_only=Fal
 
     print('EXTRACTED IMAGE HAS SHAPE {}'.format(dwi_extracted_img.shape))
 
-    dwi_extracted_file = os.path.join(extract_dir, '{}_b{}_{}.nii.gz'.format(dwi_prefix, target_bval, 'first' if first_only else 'all'))
-    save_nii(dwi_extracted_img, dwi_aff, dwi_extracted_file, ndim=4)
+    if not out_file == '':
+        save_nii(dwi_extracted_img, dwi_aff, out_file, ndim=4)
 
-    return dwi_extracted_file, num_extracted_vols, num_total_vols
+    return dwi_extracted_img, num_extracted_vols, num_total_vols
 
 def dwi_avg(dwi_file, avg_dir):
 
@@ -430,12 +991,49 @@ def dwi_avg(dwi_file, avg_dir):
     print('AVERAGING {}'.format(dwi_prefix))
 
     dwi_img, dwi_aff, _ = load_nii(dwi_file, ndim=4)
-    dwi_avg_img = np.nanmean(dwi_img, axis=3)
     dwi_avg_file = os.path.join(avg_dir, '{}_avg.nii.gz'.format(dwi_prefix))
-    save_nii(dwi_avg_img, dwi_aff, dwi_avg_file, ndim=3)
+    dwi_avg_img(dwi_img, dwi_aff, out_file=dwi_avg_file)
 
     return dwi_avg_file
 
+def dwi_avg_img(dwi_img, dwi_aff=None, out_file=''):
+
+    # In-memory version of dwi_avg: mean over volumes (a 3D input is one volume), saved to out_file only if given
+
+    dwi_img = dwi_img.reshape(dwi_img.shape[:3] + (-1,))
+    avg_img = np.nanmean(dwi_img, axis=3)
+
+    if not out_file == '':
+        save_nii(avg_img, dwi_aff, out_file, ndim=3)
+
+    return avg_img
+
+def dwi_snr(dwi, bvals, mask_img=None, target_bval=0):
+
+    # Temporal SNR (mean / sample std) of the target_bval volumes, replaces fslmaths -Tmean/-Tstd/-div
+    # dwi: 4D array or NIFTI file; volumes are streamed one at a time through a float64 Welford accumulator
+    # Returns the SNR map (0 where std is 0, as fslmaths -div), its median within mask_img and the number of volumes
+
+    if isinstance(dwi, str):
+        dwi = nib.load(dwi, keep_file_open=True).dataobj
+    index = np.array(range(0, dwi.shape[3]))[bvals == target_bval]
+
+    num_vols = 0
+    mean_img = np.zeros(dwi.shape[:3])
+    m2_img = np.zeros(dwi.shape[:3])
+    for i in index:
+        vol = np.asarray(dwi[:, :, :, i], dtype=np.float64)
+        num_vols += 1
+        delta = vol - mean_img
+        mean_img += delta / num_vols
+        m2_img += delta * (vol - mean_img)
+
+    std_img = np.sqrt(m2_img / max(num_vols - 1, 1))
+    snr_img = np.divide(mean_img, std_img, out=np.zeros(mean_img.shape), where=std_img > 0)
+    snr = np.nan if mask_img is None else np.nanmedian(snr_img[mask_img])
+
+    return snr_img, snr, num_vols
+
 def dwi_merge(dwi_files, merged_prefix, merge_dir):
 
     merged_dwi_file = os.path.join(merge_dir, '{}.nii.gz'.format(merged_prefix))
@@ -502,14 +1100,25 @@ def dwi_improbable_mask(mask_file, dwi_file, bvals, mask_dir):
     # Load mask, DWI, and b-values 
 
     mask_img, mask_aff, _ = load_nii(mask_file, dtype='bool', ndim=3)
-    dwi_img, _, _ = load_nii(dwi_file, ndim=4)
+    dwi_nii = nib.load(dwi_file, keep_file_open=True)
+    if len(dwi_nii.shape) == 3:
+        dwi_nii = dwi_nii.slicer[..., np.newaxis]
     # bvals = load_txt(bvals_file, txt_type='bvals')
 
     # Keep voxels where the minimum value across b0s is greater than the minimum value across dwis
     # and its in the original mask
-
-    b0_min_img = np.amin(dwi_img[:, :, :, bvals == 0], axis=3)
-    dwi_min_img = np.amin(dwi_img[:, :, :, bvals != 0], axis=3)
+    # (running minimum over the volumes, read one at a time)
+
+    b0_min_img = None
+    dwi_min_img = None
+    for i in range(dwi_nii.shape[3]):
+        vol = np.asanyarray(dwi_nii.dataobj[:, :, :, i])
+        if bvals[i] == 0:
+            b0_min_img = np.array(vol) if b0_min_img is None else np.minimum(b0_min_img, vol, out=b0_min_img)
+        else:
+            dwi_min_img = np.array(vol) if dwi_min_img is None else np.minimum(dwi_min_img, vol, out=dwi_min_img)
+    if b0_min_img is None or dwi_min_img is None:
+        raise DTIQAError('CANNOT COMPUTE IMPROBABLE MASK WITHOUT BOTH B0 AND DIFFUSION-WEIGHTED VOLUMES.')
     improbable_voxels = np.logical_and(b0_min_img < dwi_min_img, mask_img)
     probable_mask_img = np.logical_and(b0_min_img > dwi_min_img, mask_img)
 
@@ -528,7 +1137,7 @@ def dwi_improbable_mask(mask_file, dwi_file, bvals, mask_dir):
 
     return probable_mask_file, improbable_voxels_file, percent_improbable
 
-def dwi_norm(dwi_files, bvecs_files, bvals_files, norm_dir, B0thr):
+def dwi_norm(dwi_files, bvecs_files, bvals_files, norm_dir, B0thr, gain_method='search'):
 
     temp_dir = make_dir(norm_dir, 'TEMP')
 
@@ -559,7 +1168,7 @@ def dwi_norm(dwi_files, bvecs_files, bvals_files, norm_dir, B0thr):
             gain = 1
         else:
             img_in = img
-            gain = _calc_gain(img_ref, img_in)
+            gain = _calc_gain(img_ref, img_in, method=gain_method)
 
         print('GAIN: {}'.format(gain))
 
@@ -667,6 +1276,58 @@ def pescheme2axis(pe_axis, pe_dir, aff):
     return axis_str
 
 # Helper function
+def _save_png_page(page, png_file, dpi, thumb_factor):
+
+    # report page as png, with its thumbnail (block average of the full page) as <png_file>_thumb.png
+    page.savefig(png_file, dpi=dpi)
+    img = plt.imread(png_file)
+    rows = img.shape[0] // thumb_factor * thumb_factor
+    cols = img.shape[1] // thumb_factor * thumb_factor
+    thumb = img[:rows, :cols].reshape(rows // thumb_factor, thumb_factor, cols // thumb_factor, thumb_factor, -1).mean(axis=(1, 3))
+    plt.imsave(png_file[:-4] + '_thumb.png', np.clip(thumb, 0, 1))
+
+def _html_report(page_entries, page_url, title, stats_file):
+
+    # html index of the report pages ((name, label) of <page_url>/<name>.png)
+    html_str = ['<!DOCTYPE html>', '<html>', '<head>', '<meta charset="utf-8">',
+                '<title>{}</title>'.format(html.escape(title)),
+                '<style>body{font-family:sans-serif;margin:1em} .thumbs a{display:inline-block;margin:4px;text-align:center;font-size:small}'
+                ' .page img{max-width:100%} table{border-collapse:collapse} td{border:1px solid #ccc;padding:2px 8px}</style>',
+                '</head>', '<body>', '<h1>{}</h1>'.format(html.escape(title)), '<div class="thumbs">']
+    for name, label in page_entries:
+        html_str.append('<a href="#{0}"><img src="{1}/{0}_thumb.png" alt="{2}"><br>{2}</a>'.format(name, page_url, html.escape(label)))
+    html_str.append('</div>')
+
+    if os.path.exists(stats_file):
+        html_str.append('<h2>Stats</h2>')
+        html_str.append('<table>')
+        with open(stats_file, 'r') as f:
+            for line in f:
+                if line.strip() == '':
+                    continue
+                html_str.append('<tr>{}</tr>'.format(''.join('<td>{}</td>'.format(html.escape(v)) for v in line.strip().rsplit(',', 1))))
+        html_str.append('</table>')
+
+    for name, label in page_entries:
+        html_str.append('<div class="page" id="{0}"><h2>{1}</h2><a href="{2}/{0}.png"><img src="{2}/{0}.png" loading="lazy" alt="{1}"></a></div>'.format(name, html.escape(label), page_url))
+    html_str += ['</body>', '</html>']
+
+    return '\n'.join(html_str)
+
+def _radiological_transform(aff):
+
+    # Axis permutation and per-axis flips (after permutation) that bring an image into radiological view (see _radiological_view)
+
+    permute_axis_order = radiological_order(aff) # Permute to get RL, AP, IS axes in right order
+    orientations_permute = nib.orientations.io_orientation(aff)[permute_axis_order] # Orientations relative to RAS in nibabel
+
+    flips = [False, False, False]
+    for orientation in orientations_permute: # Flip axes as needed to get R/A/S as positive end of axis (into radiological view)
+        if (orientation[1] == 1 and orientation[0] == 0) or (orientation[1] == -1 and orientation[0] > 0):
+            flips[orientation[0].astype('int')] = True
+
+    return permute_axis_order, flips
+
 def _radiological_view(img, aff, vox_dim=(1, 1, 1)):
 
     # RAS defined by nibabel as L->R, P->A, I->S. Orientation functions from nibabel assume this.
@@ -677,31 +1338,78 @@ def _radiological_view(img, aff, vox_dim=(1, 1, 1)):
     # https://users.fmrib.ox.ac.uk/~paulmc/fsleyes/userdoc/latest/display_space.html#radiological-vs-neurological
     # https://fsl.fmrib.ox.ac.uk/fsl/fslwiki/Orientation%20Explained
 
-    orientations = nib.orientations.io_orientation(aff) # Get orientations relative to RAS in nibabel
-
-    old_axis_order = np.array(orientations[:, 0]) # Permute to get RL, AP, IS axes in right order
-    new_axis_order = np.array([0, 1, 2])
-    permute_axis_order = list(np.array([new_axis_order[old_axis_order == 0],
-                                        new_axis_order[old_axis_order == 1],
-                                        new_axis_order[old_axis_order == 2]]).flatten())
-    img = np.transpose(img, axes=permute_axis_order)
-    orientations_permute = orientations[permute_axis_order]
+    permute_axis_order, flips = _radiological_transform(aff)
+    img = np.transpose(img, axes=permute_axis_order + list(range(3, img.ndim))) # trailing axes (e.g. RGB) are kept
 
     vox_dim = np.array(vox_dim)[permute_axis_order] # Do the same to reorder pixel dimensions
 
-    for orientation in orientations_permute: # Flip axes as needed to get R/A/S as positive end of axis (into radiological view)
-        if (orientation[1] == 1 and orientation[0] == 0) or (orientation[1] == -1 and orientation[0] > 0):
-            img = nib.orientations.flip_axis(img, axis=orientation[0].astype('int'))
+    for axis in range(3):
+        if flips[axis]:
+            img = np.flip(img, axis=axis)
     
     return img, vox_dim
 
-def _calc_gain(img_ref, img_in):
-
-    gain_inits = np.linspace(0.5, 1.5, 10)
-    gains = np.zeros(len(gain_inits))
-    errors = np.zeros(len(gain_inits))
-    for i in range(len(gain_inits)):
-        gain, error, _, _, _ = fmin(_err, gain_inits[i], args=(img_ref, img_in), full_output=True)
-        gains[i] = gain[0]
-        errors[i] = error
-    return gains[np.argmin(errors)]
\ No newline at end of file
+def _calc_gain(img_ref, img_in, method='search'):
+
+    # Gain matching the intensity histogram of img_in*gain to img_ref (see _err)
+    # method = 'search': coarse-to-fine grid search, all candidate gains of a level evaluated at once on the sorted voxels
+    #          'quantile': closed-form least-squares match of the 5th-95th intensity percentiles
+    #          'fmin': reference, Nelder-Mead from 10 initial gains on the full voxel arrays
+
+    if method == 'fmin':
+        gain_inits = np.linspace(0.5, 1.5, 10)
+        gains = np.zeros(len(gain_inits))
+        errors = np.zeros(len(gain_inits))
+        for i in range(len(gain_inits)):
+            gain, error, _, _, _ = fmin(_err, gain_inits[i], args=(img_ref, img_in), full_output=True)
+            gains[i] = gain[0]
+            errors[i] = error
+        return gains[np.argmin(errors)]
+
+    img_ref = np.sort(img_ref[~np.isnan(img_ref)])
+    img_in = np.sort(img_in[~np.isnan(img_in)])
+
+    if method == 'quantile':
+        q = np.linspace(5, 95, 91)
+        q_ref = np.percentile(img_ref, q)
+        q_in = np.percentile(img_in, q)
+        return np.sum(q_ref * q_in) / np.sum(q_in * q_in)
+    if not method == 'search':
+        raise DTIQAError('UNKNOWN GAIN ESTIMATION METHOD {}.'.format(method))
+
+    bins = _err_bins(img_ref)
+    hist_ref, _ = np.histogram(img_ref, bins=bins, density=True)
+
+    # Coarse level spans gains 0.25-4 (log spaced), each finer level zooms in around the best gain
+    candidates = np.geomspace(0.25, 4, 201)
+    for level in range(4):
+        errors = _err_sorted(candidates, hist_ref, img_in, bins)
+        best = np.argmin(errors)
+        lo = candidates[max(best - 1, 0)]
+        hi = candidates[min(best + 1, len(candidates) - 1)]
+        candidates = np.linspace(lo, hi, 101)
+    return candidates[np.argmin(_err_sorted(candidates, hist_ref, img_in, bins))]
+
+def _err_bins(img_ref):
+
+    return np.linspace(0, np.nanmax(img_ref), 100)
+
+def _err(gain, img_ref, img_in):
+
+    # Sum of squared differences between the density histograms of img_ref and img_in*gain on the img_ref intensity grid
+    bins = _err_bins(img_ref)
+    hist_ref, _ = np.histogram(img_ref, bins=bins, density=True)
+    hist_in, _ = np.histogram(img_in * gain, bins=bins, density=True)
+    return np.sum(np.square(hist_ref - hist_in))
+
+def _err_sorted(gains, hist_ref, img_in_sorted, bins):
+
+    # _err for many gains at once: bin counts of img_in*gain are differences of the positions of bins/gain in the sorted img_in
+    edges = bins[np.newaxis, :] / gains[:, np.newaxis]
+    cum = np.searchsorted(img_in_sorted, edges, side='left')
+    cum[:, -1] = np.searchsorted(img_in_sorted, edges[:, -1], side='right') # last bin is closed, as np.histogram
+    counts = np.diff(cum, axis=1)
+    num = counts.sum(axis=1, keepdims=True)
+    hist_in = np.divide(counts, num * np.diff(bins)[np.newaxis, :], out=np.full(counts.shape, np.nan), where=num > 0)
+    errors = np.sum(np.square(hist_ref[np.newaxis, :] - hist_in), axis=1)
+    return np.where(np.isnan(errors), np.inf, errors)
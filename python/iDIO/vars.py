@@ -15,6 +15,8 @@ class SharedVars():
     def __init__(self):
 
         self.VERSION = '1.0'
+        self.NII_CACHE_MB = 4096 # Memory budget of the NIFTI cache behind utils.load_nii (LRU eviction); 0 disables caching
+        self.EDDY_CACHE_FILE = 'iDIO_eddy_results.npz' # Binary sidecar (in the eddy directory) caching the parsed eddy text outputs, see utils.EddyResults
         self.NUM_THREADS = 1 # Note: This value must be >= 1. Use 1 for spider on ACCRE. In MRTrix3, nthreads = 0 disables multithreading, so we use NUM_THREADS-1 for MRTrix3 commands
 
         # Define visualization variables
@@ -22,7 +24,10 @@ class SharedVars():
         self.TITLE_FONTSIZE = 16
         self.LABEL_FONTSIZE = 10
         self.PDF_DPI = 300
+        self.HTML_DPI = 100 # Resolution of the png pages of the html report (run_iDIOQC --report html)
         self.VIS_PERCENTILE_MAX = 99.9
+        self.VIS_PERCENTILE_SAMPLES = 1000000 # Voxels (strided subsample) used by utils.slice_nii to estimate the intensity percentiles of a volume
+        self.VIS_RENDERER = 'native' # Lightbox pages (vis_slice): 'native' renders with NumPy/matplotlib, 'mrview' captures with mrview (needs a display/GL stack)
 
 # Define instance of SharedVars class that will be accessible to (and editable by) other modules
 
@@ -1,7 +1,9 @@
 #!/usr/bin/python
-# version 2021/02/08
+# version 2026/10/18
 import argparse
-import pandas as pd
+import glob
+import os
+import numpy as np
 
 def parseArguments():
     # Create argument parser
@@ -9,26 +11,61 @@ def parseArguments():
     parser = argparse.ArgumentParser(description='This script multiplies the connectivity matrix and mu (generated by SIFT)')
 
     # Positional mandatory arguments
-    parser.add_argument("OriMat", help="input Original Matrix file", type=str)
+    parser.add_argument("OriMat", help="input Original Matrix file(s), or a directory with *_SIFT2.csv matrices", type=str, nargs='+')
     parser.add_argument("Mu", help="SIFT Mu text file", type=str)
-    parser.add_argument("SavePath", help="Output path", type=str)
+    parser.add_argument("SavePath", help="Output path (file for a single matrix file, otherwise output directory for *_ScaleMu.csv)", type=str)
 
     # Parse arguments
     args = parser.parse_args()
 
     return args
 
+def load_csv(path):
+    # load a (comma separated) connectivity matrix
+    # values are parsed correctly rounded; the former pandas reader (default float parser, not round-trip)
+    # was off in the last digits, so the scaled output differs from it by up to ~1e-12 relative
+    return np.loadtxt(path, delimiter=',', ndmin=2)
+
+def save_csv(mat, path):
+    # save a connectivity matrix, values written as shortest round-trip floats
+    with open(path, 'w') as fobj:
+        fobj.writelines(','.join(map(repr, row)) + '\n' for row in mat.tolist())
+
+def load_mu(Mu):
+    # load the SIFT proportionality coefficient (mu)
+    return float(np.loadtxt(Mu))
+
 def ScaleMu(OriMat, Mu, SavePath):
-	#load csv file
-	Ori = pd.read_csv(OriMat,header=None).values
-	MuV = pd.read_csv(Mu,header=None).values
+	#load csv file (Mu: SIFT Mu text file or value)
+	Ori = load_csv(OriMat)
+	MuV = Mu if isinstance(Mu, float) else load_mu(Mu)
 	Wei = Ori*MuV
-	output = pd.DataFrame(Wei).to_csv(SavePath, header=None, index=None)
+	save_csv(Wei, SavePath)
 	# return Wei
 
+def ScaleMu_batch(OriMats, Mu, SaveDir):
+	# scale all matrices with one mu; *_SIFT2.csv is written as *_ScaleMu.csv in SaveDir
+	MuV = load_mu(Mu)
+	for OriMat in OriMats:
+		name = os.path.basename(OriMat)
+		if name.endswith('_SIFT2.csv'):
+			name = name[:-len('_SIFT2.csv')]
+		else:
+			name = os.path.splitext(name)[0]
+		ScaleMu(OriMat, MuV, os.path.join(SaveDir, name + '_ScaleMu.csv'))
+
 # ouput arguments
 if __name__ == '__main__':
     # for help function
     args = parseArguments()
     # Run function
-    ScaleMu(args.OriMat, args.Mu, args.SavePath)
\ No newline at end of file
+    if len(args.OriMat) == 1 and not os.path.isdir(args.OriMat[0]) and not os.path.isdir(args.SavePath):
+        ScaleMu(args.OriMat[0], args.Mu, args.SavePath)
+    else:
+        OriMats = []
+        for path in args.OriMat:
+            if os.path.isdir(path):
+                OriMats += sorted(glob.glob(os.path.join(path, '*_SIFT2.csv')))
+            else:
+                OriMats.append(path)
+        ScaleMu_batch(OriMats, args.Mu, args.SavePath)
@@ -0,0 +1,6 @@
+import os, sys
+
+# the scripts in python/ (and python/iDIO/) are run as top-level modules (python driftco.py ..., python run_iDIOQC.py ...)
+python_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, python_dir)
+sys.path.insert(0, os.path.join(python_dir, 'iDIO'))
@@ -0,0 +1,83 @@
+import numpy as np
+import nibabel as nib
+
+import driftco
+
+
+def test_largest_component_empty():
+    mask = np.zeros((5, 5, 5), dtype=bool)
+    lcc, NUM = driftco.largest_component(mask)
+    assert NUM == 0
+    assert lcc.dtype == np.bool_
+    assert lcc.shape == mask.shape
+    assert not lcc.any()
+
+def test_largest_component_single():
+    mask = np.zeros((5, 5, 5), dtype=bool)
+    mask[1:3, 1:4, 2] = True
+    lcc, NUM = driftco.largest_component(mask)
+    assert NUM == 1
+    assert np.array_equal(lcc, mask)
+
+def test_largest_component_keeps_largest():
+    mask = np.zeros((7, 7, 7), dtype=bool)
+    mask[0:2, 0:2, 0:2] = True
+    mask[4:7, 4:7, 4:7] = True
+    lcc, NUM = driftco.largest_component(mask)
+    assert NUM == 2
+    assert lcc.sum() == 27
+    assert lcc[5, 5, 5] and not lcc[0, 0, 0]
+
+def _phantom_b0(n, nz, seed):
+    # ellipsoid head with a brighter core, a dark lesion, noise and bright specks outside
+    rng = np.random.default_rng(seed)
+    x, y, z = np.meshgrid(np.linspace(-1, 1, n), np.linspace(-1, 1, n), np.linspace(-1, 1, nz), indexing='ij')
+    r = (x/0.7)**2 + (y/0.8)**2 + (z/0.9)**2
+    b0 = np.where(r < 1, 800.0, 0.0)
+    b0 += np.where((x/0.15)**2 + (y/0.3)**2 + (z/0.4)**2 < 1, 1200.0, 0.0)
+    b0 -= np.where(((x-0.3)/0.1)**2 + (y/0.1)**2 < 1, 700.0, 0.0) * (r < 1)
+    b0[-4:-2, -4:-2, :] += 1500.0
+    return np.abs(b0 + rng.normal(0, 20, b0.shape))
+
+def test_drift_threshold_sorted_matches_ref_median():
+    rng = np.random.default_rng(0)
+    ims = [_phantom_b0(32, 16, seed) for seed in range(3)]
+    ims += [rng.gamma(2.0, 300.0, (12, 12, 8)) for _ in range(5)]
+    ims += [_phantom_b0(24, 12, seed).astype(np.int16) for seed in range(3, 6)]  # integer b0s: many ties
+    for im in ims:
+        assert driftco.drift_threshold(im) == driftco.drift_threshold(im, ref_median=True)
+
+def test_drift_brainmask_sorted_matches_ref_median():
+    for seed in range(3):
+        im = _phantom_b0(32, 16, seed)
+        mask = driftco.drift_brainmask(im, 0.8, 5, 3)
+        mask_ref = driftco.drift_brainmask(im, 0.8, 5, 3, ref_median=True)
+        assert mask.any()
+        assert np.array_equal(mask, mask_ref)
+
+def test_stream_correct_matches_in_memory(tmp_path):
+    rng = np.random.default_rng(1)
+    nr_ims = 6
+    b0 = _phantom_b0(16, 8, 0)
+    series = np.stack([b0*(1 - 0.01*i) + rng.normal(0, 5, b0.shape) for i in range(nr_ims)], axis=3)
+    series = np.clip(series, 0, None).astype(np.int16)
+    in_file = str(tmp_path / 'dwi.nii')
+    nib.save(nib.Nifti1Image(series, np.eye(4)), in_file)
+    corr_fac = 1/(1 - 0.01*np.arange(nr_ims))
+    mask_ind = driftco.mask_indices(np.ones(b0.shape + (1,)))
+
+    # in-memory path: nibabel scales the corrected series into the input (int16) type
+    raw_info = nib.load(in_file)
+    mem_file = str(tmp_path / 'dwi_mem.nii')
+    nib.save(nib.Nifti1Image(np.asanyarray(raw_info.dataobj)*corr_fac, raw_info.affine, raw_info.header), mem_file)
+
+    stream_file = str(tmp_path / 'dwi_stream.nii')
+    ints_raw = driftco.stream_correct(nib.load(in_file, keep_file_open=True), corr_fac, stream_file, mask_ind, [0]*nr_ims)
+
+    exact = series*corr_fac
+    out = nib.load(stream_file)
+    step = out.dataobj.slope
+    assert out.get_data_dtype() == np.int16
+    assert np.max(np.abs(out.get_fdata() - exact)) <= step/2 + 1e-9
+    assert np.max(np.abs(out.get_fdata() - nib.load(mem_file).get_fdata())) <= step
+    assert np.allclose(ints_raw, series.reshape(-1, nr_ims).mean(axis=0))
@@ -0,0 +1,91 @@
+import os
+
+import numpy as np
+import pytest
+
+import utils
+
+
+def _b0_voxels(rng, n):
+    # b0 intensity mixture: gamma (tissue/background) and normal (CSF) voxels
+    return np.concatenate([rng.gamma(4, 100, n), rng.normal(1200, 80, n//2)])
+
+@pytest.mark.parametrize('gain', [0.7, 1.0, 1.3, 2.5])
+def test_calc_gain_search_matches_fmin(gain):
+    rng = np.random.default_rng(0)
+    img_ref = _b0_voxels(rng, 20000)
+    img_in = _b0_voxels(rng, 20000) / gain
+    gain_search = utils._calc_gain(img_ref, img_in, method='search')
+    gain_fmin = utils._calc_gain(img_ref, img_in, method='fmin')
+    assert abs(gain_search - gain_fmin) <= 1e-4 * gain
+    assert abs(gain_search - gain) <= 0.01 * gain
+
+def test_calc_gain_ignores_nan():
+    rng = np.random.default_rng(1)
+    img_ref = _b0_voxels(rng, 20000)
+    img_in = _b0_voxels(rng, 20000) / 1.3
+    img_in[::50] = np.nan
+    assert abs(utils._calc_gain(img_ref, img_in) - 1.3) <= 0.01 * 1.3
+
+def _old_outlier_map(path):
+    # parser replaced by utils.EddyResults (header line, then '0 1 0 ... ' rows)
+    with open(path, 'r') as f:
+        rows = [[int(c) for i, c in enumerate(line.strip('\n')) if not i % 2] for line in f.readlines()[1:]]
+    return np.array(rows)
+
+def _old_num_std_map(path):
+    with open(path, 'r') as f:
+        rows = [[float(s) for s in line.strip('\n ').split(' ')] for line in f.readlines()[1:]]
+    return np.array(rows)
+
+def _write_eddy_dir(eddy_dir, rng, num_vols=7, num_slices=5):
+    prefix = str(eddy_dir / 'eddy_unwarped_images')
+    np.savetxt(prefix + '.eddy_parameters', rng.normal(0, 1, (num_vols, 16)), fmt='%.6e', delimiter='  ')
+    np.savetxt(prefix + '.eddy_movement_rms', rng.uniform(0, 2, (num_vols, 2)), fmt='%.6f', delimiter='  ')
+    outliers = (rng.uniform(size=(num_vols, num_slices)) < 0.2).astype(int)
+    with open(prefix + '.eddy_outlier_map', 'w') as f:
+        f.write('One row per scan, one column per slice. Outlier: 1, Non-outlier: 0\n')
+        f.writelines(''.join('{} '.format(v) for v in row) + '\n' for row in outliers)
+    with open(prefix + '.eddy_outlier_n_stdev_map', 'w') as f:
+        f.write('One row per scan, one column per slice. No. of standard deviations off mean difference\n')
+        f.writelines(' '.join('{:.6g}'.format(v) for v in row) + ' \n' for row in rng.normal(0, 2, (num_vols, num_slices)))
+    with open(prefix + '.eddy_values_of_all_input_parameters', 'w') as f:
+        f.write('--imain=dwi.nii.gz\n--mporder=6\n--repol=true\n')
+    return prefix
+
+def test_eddy_results_match_old_parsers(tmp_path):
+    prefix = _write_eddy_dir(tmp_path, np.random.default_rng(2))
+    eddy = utils.EddyResults(str(tmp_path))
+    np.testing.assert_array_equal(eddy.parameters, np.loadtxt(prefix + '.eddy_parameters'))
+    np.testing.assert_array_equal(eddy.movement_rms, np.loadtxt(prefix + '.eddy_movement_rms'))
+    np.testing.assert_array_equal(eddy.outlier_map, _old_outlier_map(prefix + '.eddy_outlier_map'))
+    np.testing.assert_array_equal(eddy.outlier_n_stdev_map, _old_num_std_map(prefix + '.eddy_outlier_n_stdev_map'))
+    assert eddy.outlier_map.dtype == np.uint8
+    assert eddy.input_parameters == {'imain': 'dwi.nii.gz', 'mporder': '6', 'repol': 'true'}
+    assert eddy.cnr_maps_file == ''
+
+def test_eddy_results_cache(tmp_path, monkeypatch):
+    prefix = _write_eddy_dir(tmp_path, np.random.default_rng(3))
+    eddy = utils.EddyResults(str(tmp_path))
+    assert (tmp_path / utils.SHARED_VARS.EDDY_CACHE_FILE).exists()
+
+    # unchanged outputs: everything comes from the cache
+    def no_parse(*args, **kwargs):
+        raise AssertionError('eddy outputs parsed despite a valid cache')
+    with monkeypatch.context() as m:
+        m.setattr(utils, '_read_eddy_txt', no_parse)
+        cached = utils.EddyResults(str(tmp_path))
+    for output in ['parameters', 'movement_rms', 'outlier_map', 'outlier_n_stdev_map']:
+        np.testing.assert_array_equal(getattr(cached, output), getattr(eddy, output))
+        assert getattr(cached, output).dtype == getattr(eddy, output).dtype
+    assert cached.input_parameters == eddy.input_parameters
+
+    # a rewritten output invalidates the cache
+    np.savetxt(prefix + '.eddy_movement_rms', np.ones((9, 2)), fmt='%.1f')
+    np.testing.assert_array_equal(utils.EddyResults(str(tmp_path)).movement_rms, np.ones((9, 2)))
+
+def test_eddy_results_missing_output(tmp_path):
+    prefix = _write_eddy_dir(tmp_path, np.random.default_rng(4))
+    os.remove(prefix + '.eddy_outlier_map')
+    with pytest.raises(utils.DTIQAError):
+        utils.EddyResults(str(tmp_path))